@@ -4,7 +4,7 @@ sys.path.append(os.path.abspath(os.path.dirname(__file__)))
 import datetime
 import shutil
 import queue
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, Response, current_app, session, send_file, make_response, g
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, Response, stream_with_context, current_app, session, send_file, make_response, g, has_request_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_wtf import FlaskForm
@@ -35,10 +35,20 @@ from services import (
     fetch_packages_from_registries,
     normalize_package_data,
     cache_packages,
+    sync_cached_packages,
+    publish_package_catalog,
+    PackageDependencyGraph,
+    get_http_session,
+    get_http_client_stats,
+    build_upstream_headers,
+    get_proxy_cache,
+    proxy_cache_key,
+    build_proxy_cache_entry,
+    get_package_catalog,
     HAS_PACKAGING_LIB,
     pkg_version,
     get_package_description,
-    safe_parse_version
+    version_sort_key
 )
 from forms import IgImportForm, ValidationForm, FSHConverterForm, TestDataUploadForm, RetrieveSplitDataForm
 from wtforms import SubmitField
@@ -60,6 +70,34 @@ app.config['DISPLAY_PROFILE_RELATIONSHIPS'] = True
 app.config['UPLOAD_FOLDER'] = '/app/static/uploads'  # For GoFSH output
 app.config['APP_BASE_URL'] = os.environ.get('APP_BASE_URL', 'http://localhost:5000')
 app.config['HAPI_FHIR_URL'] = os.environ.get('HAPI_FHIR_URL', 'http://localhost:8080/fhir')
+app.config['PACKAGE_STORE_ENABLED'] = os.environ.get('PACKAGE_STORE_ENABLED', 'true').lower() == 'true'
+app.config['SD_CACHE_MAX_BYTES'] = int(os.environ.get('SD_CACHE_MAX_BYTES', 128 * 1024 * 1024))
+app.config['VALIDATION_MAX_WORKERS'] = int(os.environ.get('VALIDATION_MAX_WORKERS', 4))
+app.config['HAPI_VALIDATE_BATCH_SIZE'] = int(os.environ.get('HAPI_VALIDATE_BATCH_SIZE', 50))
+app.config['PACKAGE_DOWNLOAD_MAX_WORKERS'] = int(os.environ.get('PACKAGE_DOWNLOAD_MAX_WORKERS', 4))
+app.config['PUSH_MAX_WORKERS'] = int(os.environ.get('PUSH_MAX_WORKERS', 4))
+app.config['FHIR_SHARED_PACKAGE_CACHE'] = os.environ.get('FHIR_SHARED_PACKAGE_CACHE', '')  # e.g. ~/.fhir/packages; empty disables
+app.config['REGISTRY_FEED_MAX_WORKERS'] = int(os.environ.get('REGISTRY_FEED_MAX_WORKERS', 8))
+app.config['REGISTRY_FEED_TIMEOUT'] = int(os.environ.get('REGISTRY_FEED_TIMEOUT', 30))
+app.config['REGISTRY_FEED_STREAMING'] = os.environ.get('REGISTRY_FEED_STREAMING', 'true').lower() == 'true'
+app.config['HTTP_POOL_MAXSIZE'] = int(os.environ.get('HTTP_POOL_MAXSIZE', 20))
+app.config['HTTP_MAX_RETRIES'] = int(os.environ.get('HTTP_MAX_RETRIES', 3))
+app.config['HTTP_CONNECT_TIMEOUT'] = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 10))
+app.config['FHIR_PROXY_STREAMING'] = os.environ.get('FHIR_PROXY_STREAMING', 'true').lower() == 'true'
+app.config['FHIR_PROXY_CHUNK_SIZE'] = int(os.environ.get('FHIR_PROXY_CHUNK_SIZE', 64 * 1024))
+app.config['FHIR_PROXY_CACHE_ENABLED'] = os.environ.get('FHIR_PROXY_CACHE_ENABLED', 'false').lower() == 'true'
+app.config['FHIR_PROXY_CACHE_MAX_BYTES'] = int(os.environ.get('FHIR_PROXY_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+app.config['FHIR_PROXY_CACHE_MAX_ENTRY_BYTES'] = int(os.environ.get('FHIR_PROXY_CACHE_MAX_ENTRY_BYTES', 2 * 1024 * 1024))
+app.config['FHIR_PROXY_CACHE_DEFAULT_TTL'] = int(os.environ.get('FHIR_PROXY_CACHE_DEFAULT_TTL', 0))
+app.config['FHIR_PROXY_CACHE_DIR'] = os.environ.get('FHIR_PROXY_CACHE_DIR', '')  # empty keeps evicted entries out of disk
+app.config['FHIR_PROXY_CACHE_DIR_MAX_BYTES'] = int(os.environ.get('FHIR_PROXY_CACHE_DIR_MAX_BYTES', 256 * 1024 * 1024))
+app.config['RETRIEVE_PAGE_SIZE'] = int(os.environ.get('RETRIEVE_PAGE_SIZE', 100))
+app.config['RETRIEVE_MAX_PAGES'] = int(os.environ.get('RETRIEVE_MAX_PAGES', 1000))
+app.config['RETRIEVE_PAGE_FORMAT'] = os.environ.get('RETRIEVE_PAGE_FORMAT', 'bundle')  # 'bundle' or 'ndjson'
+app.config['RETRIEVE_NDJSON_GZIP'] = os.environ.get('RETRIEVE_NDJSON_GZIP', 'false').lower() == 'true'
+app.config['RETRIEVE_REFERENCE_BATCH_SIZE'] = int(os.environ.get('RETRIEVE_REFERENCE_BATCH_SIZE', 50))
+app.config['RETRIEVE_REFERENCE_MAX_WORKERS'] = int(os.environ.get('RETRIEVE_REFERENCE_MAX_WORKERS', 4))
+app.config['RETRIEVE_DIRECT_UPSTREAM'] = os.environ.get('RETRIEVE_DIRECT_UPSTREAM', 'true').lower() == 'true'
 CONFIG_PATH = '/usr/local/tomcat/conf/application.yaml'
 
 # Basic Swagger configuration
@@ -308,6 +346,14 @@ class CachedPackage(db.Model):
     registry = db.Column(db.String(256))
     __table_args__ = (db.UniqueConstraint('package_name', 'version', name='uq_cached_package_version'),)
 
+class PackageDependency(db.Model):
+    """One edge of the package dependency graph, persisted alongside CachedPackage."""
+    id = db.Column(db.Integer, primary_key=True)
+    package_name = db.Column(db.String(128), nullable=False, index=True)
+    dependency_name = db.Column(db.String(128), nullable=False, index=True)
+    dependency_version = db.Column(db.String(64), nullable=True)
+    __table_args__ = (db.UniqueConstraint('package_name', 'dependency_name', name='uq_package_dependency'),)
+
 class RegistryCacheInfo(db.Model):
     id = db.Column(db.Integer, primary_key=True) # Simple primary key
     last_fetch_timestamp = db.Column(db.DateTime(timezone=True), nullable=True) # Store UTC timestamp
@@ -315,6 +361,18 @@ class RegistryCacheInfo(db.Model):
     def __repr__(self):
         return f'<RegistryCacheInfo id={self.id} last_fetch={self.last_fetch_timestamp}>'
 
+class RegistryFeedState(db.Model):
+    """Conditional-request validators and last parsed entries of one registry feed (or the master feed list)."""
+    id = db.Column(db.Integer, primary_key=True)
+    feed_url = db.Column(db.String(512), nullable=False, unique=True)
+    etag = db.Column(db.String(256), nullable=True)
+    last_modified = db.Column(db.String(64), nullable=True)
+    data = db.Column(db.JSON, nullable=True) # Parsed feed list or package entries from the last 200 response
+    last_checked = db.Column(db.DateTime(timezone=True), nullable=True)
+
+    def __repr__(self):
+        return f'<RegistryFeedState {self.feed_url} etag={self.etag}>'
+
 # --- Make sure to handle database migration if you use Flask-Migrate ---
 # (e.g., flask db migrate -m "Add search_param_conformance to ProcessedIg", flask db upgrade)
 # If not using migrations, you might need to drop and recreate the table (losing existing processed data)
@@ -354,20 +412,15 @@ def list_downloaded_packages(packages_dir):
                 logger.warning(f"Could not parse version from {filename}, using default name.")
                 errors.append(f"Could not parse {filename}")
             try:
-                with tarfile.open(full_path, "r:gz") as tar:
-                    # Ensure correct path within tarfile
-                    pkg_json_member_path = "package/package.json"
-                    try:
-                        pkg_json_member = tar.getmember(pkg_json_member_path)
-                        fileobj = tar.extractfile(pkg_json_member)
-                        if fileobj:
-                            pkg_data = json.loads(fileobj.read().decode('utf-8-sig'))
-                            name = pkg_data.get('name', name)
-                            version = pkg_data.get('version', version)
-                            fileobj.close()
-                    except KeyError:
-                        logger.warning(f"{pkg_json_member_path} not found in {filename}")
-                        # Keep parsed name/version if package.json is missing
+                # Ensure correct path within the package
+                pkg_json_member_path = "package/package.json"
+                try:
+                    pkg_data = json.loads(services.read_package_file(full_path, pkg_json_member_path).decode('utf-8-sig'))
+                    name = pkg_data.get('name', name)
+                    version = pkg_data.get('version', version)
+                except KeyError:
+                    logger.warning(f"{pkg_json_member_path} not found in {filename}")
+                    # Keep parsed name/version if package.json is missing
             except (tarfile.TarError, json.JSONDecodeError, UnicodeDecodeError) as e:
                 logger.warning(f"Could not read package.json from {filename}: {e}")
                 errors.append(f"Error reading {filename}: {str(e)}")
@@ -428,6 +481,43 @@ def debug_routes():
         routes.append(f"Endpoint: {rule.endpoint}, URL: {rule}")
     return jsonify(routes)
 
+@app.route('/api/http-client-stats', methods=['GET'])
+@swag_from({
+    'tags': ['Debugging'],
+    'summary': 'Get outbound HTTP client metrics.',
+    'description': 'Per-host request counts, error counts (failed requests and 5xx responses) and average/maximum latency of the shared pooled HTTP client used for registry, HAPI and FHIR server calls.',
+    'responses': {
+        '200': {
+            'description': 'Metrics keyed by host.',
+            'schema': {'type': 'object', 'additionalProperties': {'type': 'object', 'properties': {
+                'requests': {'type': 'integer'}, 'errors': {'type': 'integer'},
+                'avg_ms': {'type': 'number'}, 'max_ms': {'type': 'number'}}}}
+        }
+    }
+})
+def http_client_stats():
+    return jsonify(get_http_client_stats())
+
+@app.route('/api/proxy-cache-stats', methods=['GET'])
+@swag_from({
+    'tags': ['Debugging'],
+    'summary': 'Get FHIR proxy response cache metrics.',
+    'description': 'Hit, miss, revalidation, store, eviction and invalidation counts plus memory and spill usage of the /fhir proxy response cache. Returns enabled=false when FHIR_PROXY_CACHE_ENABLED is off.',
+    'responses': {
+        '200': {
+            'description': 'Proxy cache metrics.',
+            'schema': {'type': 'object', 'properties': {
+                'enabled': {'type': 'boolean'}, 'hits': {'type': 'integer'}, 'misses': {'type': 'integer'},
+                'revalidated': {'type': 'integer'}, 'entries': {'type': 'integer'}, 'current_bytes': {'type': 'integer'}}}
+        }
+    }
+})
+def proxy_cache_stats():
+    proxy_cache = get_proxy_cache()
+    if proxy_cache is None:
+        return jsonify({'enabled': False})
+    return jsonify(dict(proxy_cache.get_stats(), enabled=True))
+
 @app.route('/api/config', methods=['GET'])
 @csrf.exempt
 @swag_from({
@@ -573,39 +663,154 @@ def import_ig():
             return jsonify({"status": "error", "message": "Form validation failed", "errors": form.errors}), 400
         return render_template('import_ig.html', form=form, site_name='FHIRFLARE IG Toolkit', now=datetime.datetime.now())
 
+def load_registry_feed_state():
+    """Loads the stored per-feed validators and parsed data as the feed_state dict used by services."""
+    return {
+        row.feed_url: {'etag': row.etag, 'last_modified': row.last_modified, 'data': row.data}
+        for row in RegistryFeedState.query.all()
+    }
+
+def save_registry_feed_state(feed_state, checked_at):
+    """Upserts feed state rows for feeds that were re-downloaded and marks all polled feeds as checked."""
+    rows = {row.feed_url: row for row in RegistryFeedState.query.all()}
+    for feed_url, state in feed_state.items():
+        if 'changed' not in state:
+            continue # Not polled during this refresh
+        row = rows.get(feed_url)
+        if row is None:
+            row = RegistryFeedState(feed_url=feed_url)
+            db.session.add(row)
+        if state['changed'] or row.data is None:
+            row.etag = state.get('etag')
+            row.last_modified = state.get('last_modified')
+            row.data = state.get('data')
+        row.last_checked = checked_at
+
+def save_package_dependency_graph(graph):
+    """
+    Brings the persisted dependency edges in line with graph by diffing against the existing rows:
+    new edges are inserted, changed dependency versions updated and dropped edges deleted.
+    Unchanged edges are not touched. The caller commits. Returns the added/updated/removed/unchanged counts.
+    """
+    counts = {'added': 0, 'updated': 0, 'removed': 0, 'unchanged': 0}
+    existing_rows = {(row.package_name, row.dependency_name): row for row in PackageDependency.query.all()}
+    seen = set()
+    inserts = []
+    for package_name, dependency_name, dependency_version in graph.edges():
+        key = (package_name, dependency_name)
+        if key in seen:
+            continue
+        seen.add(key)
+        row = existing_rows.get(key)
+        if row is None:
+            inserts.append({'package_name': package_name, 'dependency_name': dependency_name, 'dependency_version': dependency_version})
+            counts['added'] += 1
+        elif row.dependency_version != dependency_version:
+            row.dependency_version = dependency_version
+            counts['updated'] += 1
+        else:
+            counts['unchanged'] += 1
+    removed_ids = [row.id for key, row in existing_rows.items() if key not in seen]
+    if inserts:
+        db.session.execute(PackageDependency.__table__.insert(), inserts)
+    for start in range(0, len(removed_ids), services.CACHED_PACKAGE_UPSERT_CHUNK_SIZE):
+        db.session.execute(PackageDependency.__table__.delete().where(PackageDependency.id.in_(removed_ids[start:start + services.CACHED_PACKAGE_UPSERT_CHUNK_SIZE])))
+    counts['removed'] = len(removed_ids)
+    logger.info(f"Synced package dependency graph: {counts['added']} added, {counts['updated']} updated, {counts['removed']} removed, {counts['unchanged']} unchanged.")
+    return counts
+
+def load_package_dependency_graph():
+    """Rebuilds the dependency graph from the persisted edges."""
+    return PackageDependencyGraph((row.package_name, row.dependency_name, row.dependency_version) for row in PackageDependency.query.all())
+
+def load_package_cache_from_db():
+    """
+    Reconstructs the normalized package list from the CachedPackage table, grouping rows by
+    package name. Returns an empty list if the table is empty.
+    """
+    cached_packages = CachedPackage.query.all()
+    normalized_packages = []
+    packages_by_name = {}
+    for pkg in cached_packages:
+        # Use getattr to provide defaults for potentially missing fields
+        pkg_data = {
+            'name': pkg.package_name,
+            'version': pkg.version,
+            'latest_absolute_version': getattr(pkg, 'latest_absolute_version', pkg.version),
+            'latest_official_version': getattr(pkg, 'latest_official_version', None),
+            'author': getattr(pkg, 'author', ''),
+            'fhir_version': getattr(pkg, 'fhir_version', ''),
+            'url': getattr(pkg, 'url', ''),
+            'canonical': getattr(pkg, 'canonical', ''),
+            'dependencies': getattr(pkg, 'dependencies', []) or [],
+            'version_count': getattr(pkg, 'version_count', 1),
+            'all_versions': getattr(pkg, 'all_versions', [{'version': pkg.version, 'pubDate': ''}]) or [],
+            'versions_data': [],
+            'registry': getattr(pkg, 'registry', '')
+        }
+        # Group by package name to handle version aggregation
+        if pkg_data['name'] not in packages_by_name:
+            packages_by_name[pkg_data['name']] = pkg_data
+            normalized_packages.append(pkg_data)
+        else:
+            # Update all_versions for the existing package
+            existing_pkg = packages_by_name[pkg_data['name']]
+            if pkg_data['all_versions']:
+                existing_pkg['all_versions'].extend(pkg_data['all_versions'])
+            # Update version_count
+            existing_pkg['version_count'] = len(existing_pkg['all_versions'])
+
+    # Sort all_versions within each package
+    for pkg in normalized_packages:
+        pkg['all_versions'].sort(key=lambda x: version_sort_key(x.get('version', '0.0.0a0')), reverse=True)
+    return normalized_packages
+
+def publish_cached_package_catalog():
+    """
+    Publishes the in-memory catalog from CachedPackage and the persisted dependency graph,
+    so a restarted process can serve search and dependents without refetching the registries.
+    Returns the package list, or an empty list if nothing is cached.
+    """
+    normalized_packages = load_package_cache_from_db()
+    if normalized_packages:
+        graph = load_package_dependency_graph()
+        publish_package_catalog(normalized_packages, graph if len(graph) else None)
+    return normalized_packages
+
 # Function to perform the actual refresh logic in the background
-def perform_cache_refresh_and_log():
-    """Clears caches, fetches, normalizes, and caches packages, logging progress."""
+def perform_cache_refresh_and_log(full_refresh=False):
+    """
+    Refreshes the package cache from the registries, logging progress.
+    Feeds are requested conditionally (ETag/Last-Modified) so unchanged feeds are neither
+    downloaded nor reparsed, and CachedPackage is updated by diff instead of being rebuilt.
+    full_refresh ignores the stored validators and refetches every feed.
+    """
     # Ensure this runs within an app context to access db, config etc.
     with app.app_context():
-        logger.info("--- Starting Background Cache Refresh ---")
+        logger.info(f"--- Starting Background Cache Refresh ({'full' if full_refresh else 'incremental'}) ---")
         try:
-            # 1. Clear In-Memory Cache
-            app.config['MANUAL_PACKAGE_CACHE'] = None
-            app.config['MANUAL_CACHE_TIMESTAMP'] = None
-            logger.info("In-memory cache cleared.")
+            # 1. Keep serving the current catalog; it is swapped once the new one is built
 
-            # 2. Clear DB Timestamp and CachedPackage Table
+            # 2. Load stored feed validators
             try:
                 timestamp_info = RegistryCacheInfo.query.first()
-                if timestamp_info:
-                    timestamp_info.last_fetch_timestamp = None
-                    # Don't commit yet, commit at the end
-                num_deleted = db.session.query(CachedPackage).delete()
-                db.session.flush() # Apply delete within transaction
-                logger.info(f"Cleared {num_deleted} entries from CachedPackage table (DB).")
-            except Exception as db_clear_err:
+                feed_state = {} if full_refresh else load_registry_feed_state()
+                logger.info(f"Loaded stored state for {len(feed_state)} registry feeds.")
+            except Exception as db_load_err:
                 db.session.rollback()
-                logger.error(f"Failed to clear DB cache tables: {db_clear_err}", exc_info=True)
-                log_queue.put(f"ERROR: Failed to clear DB - {db_clear_err}")
-                log_queue.put("[DONE]") # Signal completion even on error
+                logger.error(f"Failed to load registry feed state: {db_load_err}", exc_info=True)
+                log_queue.put(f"ERROR: Failed to read DB - {db_load_err}")
                 return # Stop processing
 
-            # 3. Fetch from Registries
-            logger.info("Fetching fresh package list from registries...")
+            # 3. Fetch from Registries (conditional requests; unchanged feeds reuse stored entries)
+            logger.info("Fetching package list from registries...")
             fetch_failed = False
             try:
-                raw_packages = fetch_packages_from_registries(search_term='') # Uses services logger internally
+                raw_packages = fetch_packages_from_registries(search_term='', feed_state=feed_state) # Uses services logger internally
+                changed_feeds = [url for url, state in feed_state.items() if state.get('changed')]
+                unchanged_feeds = [url for url, state in feed_state.items() if state.get('changed') is False]
+                logger.info(f"Registry feeds: {len(changed_feeds)} changed, {len(unchanged_feeds)} not modified.")
+                log_queue.put(f"Registry feeds: {len(changed_feeds)} changed, {len(unchanged_feeds)} not modified.")
                 if not raw_packages:
                     logger.warning("No packages returned from registries during refresh.")
                     fetch_failed = True
@@ -622,23 +827,26 @@ def perform_cache_refresh_and_log():
                  log_queue.put(f"ERROR: Failed during fetch/normalization - {fetch_norm_err}")
 
 
-            # 5. Update In-Memory Cache (always update, even if empty on failure)
+            # 5. Update In-Memory Cache and catalog (always update, even if empty on failure)
             now_ts = datetime.datetime.now(datetime.timezone.utc)
-            app.config['MANUAL_PACKAGE_CACHE'] = normalized_packages
+            catalog = publish_package_catalog(normalized_packages)
             app.config['MANUAL_CACHE_TIMESTAMP'] = now_ts
-            session['fetch_failed'] = fetch_failed # Update session flag reflecting fetch outcome
+            if has_request_context():
+                session['fetch_failed'] = fetch_failed # Update session flag reflecting fetch outcome
             logger.info(f"Updated in-memory cache with {len(normalized_packages)} packages. Fetch failed: {fetch_failed}")
 
-            # 6. Cache in Database (if successful fetch)
+            # 6. Sync Database by diff (if successful fetch)
             if not fetch_failed and normalized_packages:
                 try:
-                    logger.info("Caching packages in database...")
-                    cache_packages(normalized_packages, db, CachedPackage) # Uses services logger
+                    logger.info("Syncing packages into database...")
+                    sync_counts = sync_cached_packages(normalized_packages, db, CachedPackage) # Uses services logger
+                    save_package_dependency_graph(catalog.graph)
+                    save_registry_feed_state(feed_state, now_ts)
+                    log_queue.put(f"Package cache: {sync_counts['added']} added, {sync_counts['updated']} updated, {sync_counts['removed']} removed.")
                 except Exception as cache_err:
                     db.session.rollback() # Rollback DB changes on caching error
                     logger.error(f"Failed to cache packages in database: {cache_err}", exc_info=True)
                     log_queue.put(f"ERROR: Failed to cache packages in DB - {cache_err}")
-                    log_queue.put("[DONE]") # Signal completion
                     return # Stop processing
             elif fetch_failed:
                  logger.warning("Skipping database caching due to fetch failure.")
@@ -655,9 +863,6 @@ def perform_cache_refresh_and_log():
                     db.session.add(timestamp_info)
                 logger.info(f"Set DB timestamp to {now_ts}.")
             else:
-                 # Ensure timestamp_info is not added if fetch failed and it was new
-                 if timestamp_info and timestamp_info in db.new:
-                     db.session.expunge(timestamp_info)
                  logger.warning("Skipping DB timestamp update due to fetch failure.")
 
 
@@ -684,8 +889,11 @@ def perform_cache_refresh_and_log():
 @swag_from({
     'tags': ['Package Management'],
     'summary': 'Refresh FHIR package cache.',
-    'description': 'Triggers an asynchronous background task to clear and refresh the FHIR package cache from configured registries.',
+    'description': 'Triggers an asynchronous background task to refresh the FHIR package cache from configured registries. Feeds are requested conditionally, so unchanged feeds are not downloaded again; pass full=true to refetch every feed.',
     'security': [{'ApiKeyAuth': []}], # Requires API Key
+    'parameters': [
+        {'name': 'full', 'in': 'query', 'type': 'boolean', 'required': False, 'default': False, 'description': 'Ignore stored ETag/Last-Modified validators and refetch every feed.'}
+    ],
     'responses': {
         '202': {'description': 'Cache refresh process started in the background.'},
         # Consider if other error codes are possible before task starts
@@ -700,8 +908,9 @@ def refresh_cache_task():
         try: log_queue.get_nowait()
         except queue.Empty: break
 
-    logger.info("Received API request to refresh cache.")
-    thread = threading.Thread(target=perform_cache_refresh_and_log, daemon=True)
+    full_refresh = request.args.get('full', 'false').lower() == 'true'
+    logger.info(f"Received API request to refresh cache (full={full_refresh}).")
+    thread = threading.Thread(target=perform_cache_refresh_and_log, kwargs={'full_refresh': full_refresh}, daemon=True)
     thread.start()
     logger.info("Background cache refresh thread started.")
     # Return 202 Accepted: Request accepted, processing in background.
@@ -907,6 +1116,8 @@ def delete_ig():
                 logger.error(f"Error deleting {tgz_path}: {e}")
         else:
             flash(f"Package file not found: {filename}", "warning")
+        services.invalidate_package_member_index(tgz_path)
+        services.invalidate_sd_cache(tgz_path)
         if os.path.exists(metadata_path):
             try:
                 os.remove(metadata_path)
@@ -1028,29 +1239,23 @@ def get_example():
         logger.error(f"Package file not found: {tgz_path}")
         return jsonify({"error": f"Package {package_name}#{version} not found"}), 404
     try:
-        with tarfile.open(tgz_path, "r:gz") as tar:
-            try:
-                example_member = tar.getmember(filename)
-                with tar.extractfile(example_member) as example_fileobj:
-                    content_bytes = example_fileobj.read()
-                content_string = content_bytes.decode('utf-8-sig')
-                content = json.loads(content_string)
-                if not include_narrative:
-                    content = services.remove_narrative(content, include_narrative=False)
-                filtered_content_string = json.dumps(content, separators=(',', ':'), sort_keys=False)
-                return Response(filtered_content_string, mimetype='application/json')
-            except KeyError:
-                logger.error(f"Example file '{filename}' not found within {tgz_filename}")
-                return jsonify({"error": f"Example file '{os.path.basename(filename)}' not found in package."}), 404
-            except json.JSONDecodeError as e:
-                logger.error(f"JSON parsing error for example '{filename}' in {tgz_filename}: {e}")
-                return jsonify({"error": f"Invalid JSON in example file: {str(e)}"}), 500
-            except UnicodeDecodeError as e:
-                logger.error(f"Encoding error reading example '{filename}' from {tgz_filename}: {e}")
-                return jsonify({"error": f"Error decoding example file (invalid UTF-8?): {str(e)}"}), 500
-            except tarfile.TarError as e:
-                logger.error(f"TarError reading example '{filename}' from {tgz_filename}: {e}")
-                return jsonify({"error": f"Error reading package archive: {str(e)}"}), 500
+        try:
+            content_bytes = services.read_package_file(tgz_path, filename)
+            content_string = content_bytes.decode('utf-8-sig')
+            content = json.loads(content_string)
+            if not include_narrative:
+                content = services.remove_narrative(content, include_narrative=False)
+            filtered_content_string = json.dumps(content, separators=(',', ':'), sort_keys=False)
+            return Response(filtered_content_string, mimetype='application/json')
+        except KeyError:
+            logger.error(f"Example file '{filename}' not found within {tgz_filename}")
+            return jsonify({"error": f"Example file '{os.path.basename(filename)}' not found in package."}), 404
+        except json.JSONDecodeError as e:
+            logger.error(f"JSON parsing error for example '{filename}' in {tgz_filename}: {e}")
+            return jsonify({"error": f"Invalid JSON in example file: {str(e)}"}), 500
+        except UnicodeDecodeError as e:
+            logger.error(f"Encoding error reading example '{filename}' from {tgz_filename}: {e}")
+            return jsonify({"error": f"Error decoding example file (invalid UTF-8?): {str(e)}"}), 500
     except tarfile.TarError as e:
         logger.error(f"Error opening package file {tgz_path}: {e}")
         return jsonify({"error": f"Error reading package archive: {str(e)}"}), 500
@@ -1066,28 +1271,17 @@ def collect_all_structure_definitions(tgz_path):
     """Collect all StructureDefinitions from a .tgz package."""
     structure_definitions = {}
     try:
-        with tarfile.open(tgz_path, "r:gz") as tar:
-            for member in tar:
-                if not (member.isfile() and member.name.startswith('package/') and member.name.lower().endswith('.json')):
-                    continue
-                if os.path.basename(member.name).lower() in ['package.json', '.index.json', 'validation-summary.json', 'validation-oo.json']:
-                    continue
-                fileobj = None
-                try:
-                    fileobj = tar.extractfile(member)
-                    if fileobj:
-                        content_bytes = fileobj.read()
-                        content_string = content_bytes.decode('utf-8-sig')
-                        data = json.loads(content_string)
-                        if isinstance(data, dict) and data.get('resourceType') == 'StructureDefinition':
-                            sd_url = data.get('url')
-                            if sd_url:
-                                structure_definitions[sd_url] = data
-                except Exception as e:
-                    logger.warning(f"Could not read/parse potential SD {member.name}, skipping: {e}")
-                finally:
-                    if fileobj:
-                        fileobj.close()
+        member_index = services.get_package_member_index(tgz_path)
+        if not member_index:
+            return structure_definitions
+        sd_entries = [
+            e for e in member_index['members']
+            if e.get('resourceType') == 'StructureDefinition' and e.get('url')
+            and os.path.basename(e['path']).lower() not in services.PACKAGE_METADATA_FILES
+        ]
+        for entry, data in services.iter_package_members(tgz_path, sd_entries):
+            if isinstance(data, dict) and data.get('url'):
+                structure_definitions[data['url']] = data
     except Exception as e:
         logger.error(f"Unexpected error collecting StructureDefinitions from {tgz_path}: {e}", exc_info=True)
     return structure_definitions
@@ -1107,7 +1301,7 @@ def generate_snapshot(structure_def, core_package_path, local_package_path):
         return structure_def
 
     resource_type = structure_def.get('type')
-    base_sd_data, _ = services.find_and_extract_sd(core_package_path, resource_type, profile_url=base_url)
+    base_sd_data, _ = services.get_cached_sd(core_package_path, resource_type, profile_url=base_url)
     if not base_sd_data or 'snapshot' not in base_sd_data:
         logger.error(f"Could not fetch or find snapshot in base StructureDefinition: {base_url}")
         return structure_def
@@ -1607,6 +1801,9 @@ def api_push_ig():
         credentials = f"{username}:{password}"
         auth_token = f"Basic {base64.b64encode(credentials.encode('utf-8')).decode('utf-8')}"
 
+    # The generator runs after the request context is gone, so read the worker count now
+    push_max_workers = current_app.config.get('PUSH_MAX_WORKERS', services.PUSH_DEFAULT_MAX_WORKERS)
+
     # --- Streaming Response ---
     def generate_stream_wrapper():
         yield from services.generate_push_stream(
@@ -1614,7 +1811,8 @@ def api_push_ig():
             include_dependencies=include_dependencies, auth_type=auth_type,
             auth_token=auth_token, resource_types_filter=resource_types_filter,
             skip_files=skip_files, dry_run=dry_run, verbose=verbose,
-            force_upload=force_upload, packages_dir=packages_dir
+            force_upload=force_upload, packages_dir=packages_dir,
+            max_workers=push_max_workers
         )
     return Response(generate_stream_wrapper(), mimetype='application/x-ndjson')
 
@@ -1675,6 +1873,15 @@ def create_db():
 
 with app.app_context():
     create_db()
+    # Serve search and dependents from the last cached package list until the next refresh
+    try:
+        warmed_packages = publish_cached_package_catalog()
+        if warmed_packages:
+            app.config['MANUAL_CACHE_TIMESTAMP'] = getattr(RegistryCacheInfo.query.first(), 'last_fetch_timestamp', None)
+            logger.info(f"Loaded package catalog with {len(warmed_packages)} packages from database.")
+    except Exception as warm_err:
+        db.session.rollback()
+        logger.warning(f"Could not load package catalog from database: {warm_err}")
 
 
 class FhirRequestForm(FlaskForm):
@@ -1692,6 +1899,47 @@ def fhir_ui_operations():
 
 # --- CORRECTED PROXY FUNCTION DEFINITION (Simplified Decorator) ---
 
+class _ProxyRequestBody:
+    """
+    File-like view over the incoming request stream with a known length, so requests
+    forwards it with the original Content-Length while reading it in blocks.
+    """
+    def __init__(self, stream, length, chunk_size):
+        self.stream = stream
+        self.len = length
+        self.chunk_size = chunk_size
+
+    def read(self, size=-1):
+        return self.stream.read(self.chunk_size if size is None or size < 0 else size)
+
+    def __iter__(self):
+        return iter(lambda: self.stream.read(self.chunk_size), b'')
+
+
+def _proxy_cached_response(entry, cache_status):
+    """Replays a cached proxied response, reporting the cache status and entry age."""
+    resp = make_response(entry['body'])
+    resp.status_code = entry['status']
+    for key, value in entry['headers'].items(): resp.headers[key] = value
+    resp.headers['Content-Length'] = str(len(entry['body']))
+    resp.headers['Age'] = str(int(time.time() - entry['stored_at']))
+    resp.headers['X-Cache'] = cache_status
+    return resp
+
+
+def _proxy_request_body(chunk_size):
+    """
+    Returns the body of the current request for forwarding without buffering it:
+    None when there is no body, a sized file-like when the client sent Content-Length,
+    and a chunk generator (forwarded with chunked transfer encoding) otherwise.
+    """
+    if request.content_length is not None:
+        return _ProxyRequestBody(request.stream, request.content_length, chunk_size) if request.content_length else None
+    if 'chunked' in request.headers.get('Transfer-Encoding', '').lower():
+        return iter(lambda: request.stream.read(chunk_size), b'')
+    return None
+
+
 # Use a single route to capture everything after /fhir/
 # The 'path' converter handles slashes. 'subpath' can be empty.
 @app.route('/fhir', defaults={'subpath': ''}, methods=['GET', 'POST', 'PUT', 'DELETE'])
@@ -1732,50 +1980,104 @@ def proxy_hapi(subpath):
     # Construct the final URL for the target server request
     # Append the cleaned subpath only if it's not empty
     final_url = f"{final_base_url}/{clean_subpath}" if clean_subpath else final_base_url
+    # Search parameters and paging links (e.g. _count, _getpages) travel in the query string
+    if request.query_string:
+        final_url = f"{final_url}?{request.query_string.decode('latin-1')}"
 
     # Prepare headers to forward
-    headers_to_forward = {
-        k: v for k, v in request.headers.items()
-        if k.lower() not in [
-            'host', 'x-target-fhir-server', 'content-length', 'connection',
-            'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'te',
-            'trailers', 'transfer-encoding', 'upgrade'
-            ]
-    }
-    if 'Content-Type' in request.headers:
-        headers_to_forward['Content-Type'] = request.headers['Content-Type']
-    if 'Accept' in request.headers:
-         headers_to_forward['Accept'] = request.headers['Accept']
-    elif 'Accept' not in headers_to_forward:
-         headers_to_forward['Accept'] = 'application/fhir+json, application/fhir+xml;q=0.9, */*;q=0.8'
+    headers_to_forward = build_upstream_headers(request.headers)
 
     logger.info(f"Proxying request: {request.method} {final_url}")
-    request_data = request.get_data()
+    streaming = current_app.config.get('FHIR_PROXY_STREAMING', True)
+    chunk_size = current_app.config.get('FHIR_PROXY_CHUNK_SIZE', 64 * 1024)
+    request_data = _proxy_request_body(chunk_size) if streaming else request.get_data()
+
+    # Answer idempotent reads from the response cache when it is enabled, revalidating stale entries
+    proxy_cache = get_proxy_cache()
+    cache_key = cached_entry = cache_status = None
+    if proxy_cache is not None and request.method == 'GET':
+        request_cache_control = request.headers.get('Cache-Control', '').lower()
+        if 'no-store' in request_cache_control or 'If-None-Match' in request.headers or 'If-Modified-Since' in request.headers:
+            cache_status = 'BYPASS'
+        else:
+            cache_key = proxy_cache_key(final_url, headers_to_forward)
+            cached_entry = proxy_cache.lookup(cache_key, headers_to_forward)
+            if cached_entry is not None and proxy_cache.is_fresh(cached_entry) and 'no-cache' not in request_cache_control and 'max-age=0' not in request_cache_control:
+                proxy_cache.record_hit()
+                logger.debug(f"Proxy cache hit for {final_url}")
+                return _proxy_cached_response(cached_entry, 'HIT')
+            if cached_entry is not None:
+                if cached_entry['etag']:
+                    headers_to_forward['If-None-Match'] = cached_entry['etag']
+                if cached_entry['last_modified']:
+                    headers_to_forward['If-Modified-Since'] = cached_entry['last_modified']
+            cache_status = 'MISS'
 
     try:
-        # Make the request
-        response = requests.request(
+        # Make the request; a streamed body is consumed as it is sent, so it must not be retried
+        response = get_http_session(retry=request_data is None or isinstance(request_data, bytes)).request(
             method=request.method,
             url=final_url,
             headers=headers_to_forward,
             data=request_data,
             cookies=request.cookies,
             allow_redirects=False,
+            stream=streaming,
             timeout=60
         )
         logger.info(f"Target server '{final_base_url}' responded with status: {response.status_code}")
+        if cached_entry is not None and response.status_code == 304:
+            response.close()
+            return _proxy_cached_response(proxy_cache.refresh(cache_key, cached_entry, response.headers), 'REVALIDATED')
         response.raise_for_status()
+        if proxy_cache is not None and request.method != 'GET':
+            # A write may change the resource and any search over its type
+            resource_type = clean_subpath.split('/')[0]
+            proxy_cache.invalidate(f"{final_base_url}/{resource_type}" if resource_type else final_base_url)
+        cache_lifetime = proxy_cache.lifetime_for(response.status_code, response.headers) if cache_key is not None else None
 
         # Filter hop-by-hop headers
         response_headers = { k: v for k, v in response.headers.items() if k.lower() not in ('transfer-encoding', 'connection', 'content-encoding', 'content-length', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'te', 'trailers', 'upgrade', 'server', 'date', 'x-powered-by', 'via', 'x-forwarded-for', 'x-forwarded-proto', 'x-request-id') }
-        response_content = response.content
-        response_headers['Content-Length'] = str(len(response_content))
+        cached_headers = dict(response_headers)
+        if streaming:
+            # Relay the body chunk by chunk; the upstream length only still holds when requests does not decode it
+            if 'Content-Length' in response.headers and 'Content-Encoding' not in response.headers:
+                response_headers['Content-Length'] = response.headers['Content-Length']
+
+            def generate():
+                # Keep a copy of cacheable bodies while relaying them, giving up once over the entry limit
+                captured = [] if cache_lifetime is not None else None
+                captured_bytes = 0
+                try:
+                    for chunk in response.iter_content(chunk_size=chunk_size):
+                        if chunk:
+                            if captured is not None:
+                                captured_bytes += len(chunk)
+                                if captured_bytes <= proxy_cache.max_entry_bytes:
+                                    captured.append(chunk)
+                                else:
+                                    captured = None
+                            yield chunk
+                    if captured is not None:
+                        proxy_cache.store(cache_key, build_proxy_cache_entry(final_url, response.status_code, response.headers, cached_headers, b''.join(captured), headers_to_forward, cache_lifetime))
+                finally:
+                    response.close()
 
-        # Create Flask response
-        resp = make_response(response_content)
-        resp.status_code = response.status_code
+            resp = Response(stream_with_context(generate()), status=response.status_code)
+        else:
+            response_content = response.content
+            response_headers['Content-Length'] = str(len(response_content))
+
+            if cache_lifetime is not None:
+                proxy_cache.store(cache_key, build_proxy_cache_entry(final_url, response.status_code, response.headers, cached_headers, response_content, headers_to_forward, cache_lifetime))
+
+            # Create Flask response
+            resp = make_response(response_content)
+            resp.status_code = response.status_code
         for key, value in response_headers.items(): resp.headers[key] = value
         if 'Content-Type' in response.headers: resp.headers['Content-Type'] = response.headers['Content-Type']
+        if cache_status:
+            resp.headers['X-Cache'] = cache_status
         return resp
 
     # --- Exception Handling (same as previous version) ---
@@ -1803,6 +2105,8 @@ def proxy_hapi(subpath):
               logger.error(f"Failed to process target server's error response: {inner_e}")
               diag_text = f'Target server returned status {e.response.status_code}, but failed to forward its error details.'
               return jsonify({'resourceType': 'OperationOutcome', 'issue': [{'severity': 'error', 'code': 'exception', 'diagnostics': diag_text, 'details': {'text': str(e)}}]}), e.response.status_code or 502
+         finally:
+              e.response.close()
     except requests.exceptions.RequestException as e:
         logger.error(f"Proxy request error for {final_url}: {str(e)}")
         return jsonify({'resourceType': 'OperationOutcome', 'issue': [{'severity': 'error', 'code': 'exception', 'diagnostics': 'Error communicating with the target FHIR server.', 'details': {'text': str(e)}}]}), 502
@@ -1857,7 +2161,7 @@ def load_ig_to_hapi():
                     resource_type = resource.get('resourceType')
                     resource_id = resource.get('id')
                     if resource_type and resource_id:
-                        response = requests.put(
+                        response = get_http_session().put(
                             f"{current_app.config['HAPI_FHIR_URL'].rstrip('/')}/{resource_type}/{resource_id}",
                             json=resource,
                             headers={'Content-Type': 'application/fhir+json'}
@@ -2142,14 +2446,13 @@ def api_upload_test_data():
 
         temp_dir = tempfile.mkdtemp(prefix='fhirflare_upload_')
         saved_file_paths = []
-        allowed_extensions = {'.json', '.xml', '.zip'}
+        allowed_extensions = ('.json', '.xml', '.zip') + services.NDJSON_SUFFIXES
         try:
             for file_storage in uploaded_files:
                 if file_storage and file_storage.filename:
                     filename = secure_filename(file_storage.filename)
-                    file_ext = os.path.splitext(filename)[1].lower()
-                    if file_ext not in allowed_extensions:
-                        raise ValueError(f"Invalid file type: '{filename}'. Only JSON, XML, ZIP allowed.")
+                    if not filename.lower().endswith(allowed_extensions):
+                        raise ValueError(f"Invalid file type: '{filename}'. Only JSON, NDJSON, XML, ZIP allowed.")
                     save_path = os.path.join(temp_dir, filename)
                     file_storage.save(save_path)
                     saved_file_paths.append(save_path)
@@ -2260,7 +2563,11 @@ def retrieve_split_data():
         {'name': 'auth_type', 'in': 'formData', 'type': 'string', 'enum': ['none', 'bearer', 'basic'], 'default': 'none'},
         {'name': 'bearer_token', 'in': 'formData', 'type': 'string', 'description': 'Bearer token if auth_type is bearer.'},
         {'name': 'username', 'in': 'formData', 'type': 'string', 'description': 'Username if auth_type is basic.'},
-        {'name': 'password', 'in': 'formData', 'type': 'string', 'format': 'password', 'description': 'Password if auth_type is basic.'}
+        {'name': 'password', 'in': 'formData', 'type': 'string', 'format': 'password', 'description': 'Password if auth_type is basic.'},
+        {'name': 'page_size', 'in': 'formData', 'type': 'integer', 'description': 'Search page size (_count). Defaults to RETRIEVE_PAGE_SIZE.'},
+        {'name': 'max_pages', 'in': 'formData', 'type': 'integer', 'description': 'Maximum Bundle.link next pages followed per resource type. Defaults to RETRIEVE_MAX_PAGES.'},
+        {'name': 'page_format', 'in': 'formData', 'type': 'string', 'enum': ['bundle', 'ndjson'], 'description': 'Save one Bundle file per page, or one <ResourceType>.ndjson file per type (FHIR Bulk Data layout). Defaults to RETRIEVE_PAGE_FORMAT.'},
+        {'name': 'ndjson_gzip', 'in': 'formData', 'type': 'boolean', 'description': 'With page_format=ndjson, gzip each file (<ResourceType>.ndjson.gz). Defaults to RETRIEVE_NDJSON_GZIP.'}
     ],
     'responses': {
         '200': {
@@ -2304,6 +2611,17 @@ def api_retrieve_bundles():
         return jsonify({"status": "error", "message": "Bearer token required for bearer authentication."}), 400
     if auth_type == 'basic' and (not username or not password):
         return jsonify({"status": "error", "message": "Username and password required for basic authentication."}), 400
+    try:
+        page_size = int(params['page_size']) if params.get('page_size') else None
+        max_pages = int(params['max_pages']) if params.get('max_pages') else None
+    except ValueError:
+        return jsonify({"status": "error", "message": "page_size and max_pages must be integers."}), 400
+    if (page_size is not None and page_size < 1) or (max_pages is not None and max_pages < 1):
+        return jsonify({"status": "error", "message": "page_size and max_pages must be positive."}), 400
+    page_format = params.get('page_format') or None
+    ndjson_gzip = params['ndjson_gzip'].lower() == 'true' if params.get('ndjson_gzip') else None
+    if page_format and page_format not in services.RETRIEVE_PAGE_FORMATS:
+        return jsonify({"status": "error", "message": f"Invalid page_format. Must be one of {list(services.RETRIEVE_PAGE_FORMATS)}."}), 400
 
     # Handle authentication
     auth_token = None
@@ -2329,7 +2647,11 @@ def api_retrieve_bundles():
                 validate_references=validate_references,
                 fetch_reference_bundles=fetch_reference_bundles,
                 auth_type=auth_type,
-                auth_token=auth_token
+                auth_token=auth_token,
+                page_size=page_size,
+                max_pages=max_pages,
+                page_format=page_format,
+                ndjson_gzip=ndjson_gzip
             )
         except Exception as e:
             logger.error(f"Error in retrieve_bundles: {e}", exc_info=True)
@@ -2523,46 +2845,9 @@ def search_and_import():
     else:
         # Check if there are cached packages in the database
         try:
-            cached_packages = CachedPackage.query.all()
+            cached_packages = publish_cached_package_catalog()
             if cached_packages:
-                logger.info(f"Loading {len(cached_packages)} packages from CachedPackage table.")
-                # Reconstruct the normalized package format from the database entries
-                normalized_packages = []
-                packages_by_name = {}
-                for pkg in cached_packages:
-                    # Use getattr to provide defaults for potentially missing fields
-                    pkg_data = {
-                        'name': pkg.package_name,
-                        'version': pkg.version,
-                        'latest_absolute_version': getattr(pkg, 'latest_absolute_version', pkg.version),
-                        'latest_official_version': getattr(pkg, 'latest_official_version', None),
-                        'author': getattr(pkg, 'author', ''),
-                        'fhir_version': getattr(pkg, 'fhir_version', ''),
-                        'url': getattr(pkg, 'url', ''),
-                        'canonical': getattr(pkg, 'canonical', ''),
-                        'dependencies': getattr(pkg, 'dependencies', []) or [],
-                        'version_count': getattr(pkg, 'version_count', 1),
-                        'all_versions': getattr(pkg, 'all_versions', [{'version': pkg.version, 'pubDate': ''}]) or [],
-                        'versions_data': [],
-                        'registry': getattr(pkg, 'registry', '')
-                    }
-                    # Group by package name to handle version aggregation
-                    if pkg_data['name'] not in packages_by_name:
-                        packages_by_name[pkg_data['name']] = pkg_data
-                        normalized_packages.append(pkg_data)
-                    else:
-                        # Update all_versions for the existing package
-                        existing_pkg = packages_by_name[pkg_data['name']]
-                        if pkg_data['all_versions']:
-                            existing_pkg['all_versions'].extend(pkg_data['all_versions'])
-                        # Update version_count
-                        existing_pkg['version_count'] = len(existing_pkg['all_versions'])
-
-                # Sort all_versions within each package
-                for pkg in normalized_packages:
-                    pkg['all_versions'].sort(key=lambda x: safe_parse_version(x.get('version', '0.0.0a0')), reverse=True)
-
-                app.config['MANUAL_PACKAGE_CACHE'] = normalized_packages
+                normalized_packages = cached_packages
                 app.config['MANUAL_CACHE_TIMESTAMP'] = db_timestamp or datetime.datetime.now(datetime.timezone.utc)
                 display_timestamp = app.config['MANUAL_CACHE_TIMESTAMP']
                 fetch_failed_flag = session.get('fetch_failed', False)
@@ -2601,14 +2886,17 @@ def search_and_import():
                 normalized_packages = normalize_package_data(raw_packages)
                 logger.debug(f"Normalization resulted in {len(normalized_packages)} unique packages.")
                 now_ts = datetime.datetime.now(datetime.timezone.utc)
-                app.config['MANUAL_PACKAGE_CACHE'] = normalized_packages
+                catalog = publish_package_catalog(normalized_packages)
                 app.config['MANUAL_CACHE_TIMESTAMP'] = now_ts
                 logger.info(f"Stored {len(normalized_packages)} packages in manual cache (memory).")
 
-                # Save to CachedPackage table
+                # Save to CachedPackage table along with the dependency graph
                 try:
                     cache_packages(normalized_packages, db, CachedPackage)
+                    save_package_dependency_graph(catalog.graph)
+                    db.session.commit()
                 except Exception as cache_err:
+                    db.session.rollback()
                     logger.error(f"Failed to cache packages in database: {cache_err}", exc_info=True)
                     flash("Error saving package cache to database.", "warning")
 
@@ -2651,11 +2939,9 @@ def search_and_import():
     end = start + per_page
     packages_processed_for_page = []
     if normalized_packages:
-        for pkg_data in normalized_packages:
-            # Fall back to latest_absolute_version if latest_official_version is None
-            display_version = pkg_data.get('latest_official_version') or pkg_data.get('latest_absolute_version') or 'N/A'
-            pkg_data['display_version'] = display_version
-            packages_processed_for_page.append(pkg_data)
+        # Catalog entries carry display_version (latest official, else latest absolute)
+        catalog = get_package_catalog()
+        packages_processed_for_page = catalog.packages if catalog is not None else []
 
     packages_on_page = packages_processed_for_page[start:end]
     total_pages_calc = max(1, (total_packages + per_page - 1) // per_page)
@@ -2717,7 +3003,7 @@ def search_and_import():
 })
 def api_search_packages():
     """
-    Handles HTMX search requests. Filters packages from the in-memory cache.
+    Handles HTMX search requests. Filters packages through the indexed in-memory catalog.
     Returns an HTML fragment (_search_results_table.html) displaying the
     latest official version if available, otherwise falls back to latest absolute version.
     """
@@ -2726,30 +3012,17 @@ def api_search_packages():
     per_page = 50
     logger.debug(f"API search request: term='{search_term}', page={page}")
 
-    all_cached_packages = app.config.get('MANUAL_PACKAGE_CACHE')
-    if all_cached_packages is None:
+    catalog = get_package_catalog()
+    if catalog is None:
         logger.warning("API search called but in-memory cache is empty. Returning no results.")
         return render_template('_search_results_table.html', packages=[], pagination=None)
 
+    # Catalog entries already carry display_version (latest official, else latest absolute)
+    filtered_packages_processed = catalog.search(search_term)
     if search_term:
-        filtered_packages_raw = [
-            pkg for pkg in all_cached_packages
-            if isinstance(pkg, dict) and (
-                search_term in pkg.get('name', '').lower() or
-                search_term in pkg.get('author', '').lower()
-            )
-        ]
-        logger.debug(f"Filtered {len(all_cached_packages)} cached packages down to {len(filtered_packages_raw)} for term '{search_term}'")
+        logger.debug(f"Filtered {len(catalog)} cached packages down to {len(filtered_packages_processed)} for term '{search_term}'")
     else:
-        filtered_packages_raw = all_cached_packages
-        logger.debug(f"No search term provided, using all {len(filtered_packages_raw)} cached packages.")
-
-    filtered_packages_processed = []
-    for pkg_data in filtered_packages_raw:
-        # Fall back to latest_absolute_version if latest_official_version is None
-        display_version = pkg_data.get('latest_official_version') or pkg_data.get('latest_absolute_version') or 'N/A'
-        pkg_data['display_version'] = display_version
-        filtered_packages_processed.append(pkg_data)
+        logger.debug(f"No search term provided, using all {len(filtered_packages_processed)} cached packages.")
 
     total_filtered = len(filtered_packages_processed)
     start = (page - 1) * per_page
@@ -2793,30 +3066,6 @@ def api_search_packages():
                                     pagination=pagination)
     return html_response
 
-def safe_parse_version_local(v_str): # Use different name
-    """
-    Local copy of safe version parser for package_details_view.
-    """
-    if not v_str or not isinstance(v_str, str):
-        return pkg_version_local.parse("0.0.0a0")
-    try:
-        return pkg_version_local.parse(v_str)
-    except pkg_version_local.InvalidVersion:
-        original_v_str = v_str
-        v_str_norm = v_str.lower()
-        base_part = v_str_norm.split('-', 1)[0] if '-' in v_str_norm else v_str_norm
-        suffix = v_str_norm.split('-', 1)[1] if '-' in v_str_norm else None
-        if re.match(r'^\d+(\.\d+)*$', base_part):
-            try:
-                if suffix in ['dev', 'snapshot', 'ci-build']: return pkg_version_local.parse(f"{base_part}a0")
-                elif suffix in ['draft', 'ballot', 'preview']: return pkg_version_local.parse(f"{base_part}b0")
-                elif suffix and suffix.startswith('rc'): return pkg_version_local.parse(f"{base_part}rc{ ''.join(filter(str.isdigit, suffix)) or '0'}")
-                return pkg_version_local.parse(base_part)
-            except pkg_version_local.InvalidVersion: logger_details.warning(f"[DetailsView] Invalid base version '{base_part}' after splitting '{original_v_str}'. Treating as alpha."); return pkg_version_local.parse("0.0.0a0")
-            except Exception as e: logger_details.error(f"[DetailsView] Unexpected error parsing FHIR-suffixed version '{original_v_str}': {e}"); return pkg_version_local.parse("0.0.0a0")
-        else: logger_details.warning(f"[DetailsView] Unparseable version '{original_v_str}' (base '{base_part}' not standard). Treating as alpha."); return pkg_version_local.parse("0.0.0a0")
-    except Exception as e: logger_details.error(f"[DetailsView] Unexpected error in safe_parse_version_local for '{v_str}': {e}"); return pkg_version_local.parse("0.0.0a0")
-# --- End Local Helper Definition ---
 
 @app.route('/package-details/<name>')
 def package_details_view(name):
@@ -2825,47 +3074,9 @@ def package_details_view(name):
     packages = None
     source = "Not Found"
 
-    def safe_parse_version_local(v_str):
-        """
-        Local version parser to handle FHIR package versions.
-        Uses pkg_version from services or falls back to basic comparison.
-        """
-        if not v_str or not isinstance(v_str, str):
-            logger.warning(f"Invalid version string: {v_str}. Treating as 0.0.0a0.")
-            return pkg_version.parse("0.0.0a0")
-        try:
-            return pkg_version.parse(v_str)
-        except pkg_version.InvalidVersion:
-            original_v_str = v_str
-            v_str_norm = v_str.lower()
-            base_part = v_str_norm.split('-', 1)[0] if '-' in v_str_norm else v_str_norm
-            suffix = v_str_norm.split('-', 1)[1] if '-' in v_str_norm else None
-            if re.match(r'^\d+(\.\d+)+$', base_part):
-                try:
-                    if suffix in ['dev', 'snapshot', 'ci-build']:
-                        return pkg_version.parse(f"{base_part}a0")
-                    elif suffix in ['draft', 'ballot', 'preview']:
-                        return pkg_version.parse(f"{base_part}b0")
-                    elif suffix and suffix.startswith('rc'):
-                        rc_num = ''.join(filter(str.isdigit, suffix)) or '0'
-                        return pkg_version.parse(f"{base_part}rc{rc_num}")
-                    return pkg_version.parse(base_part)
-                except pkg_version.InvalidVersion:
-                    logger.warning(f"Invalid base version '{base_part}' after splitting '{original_v_str}'. Treating as alpha.")
-                    return pkg_version.parse("0.0.0a0")
-                except Exception as e:
-                    logger.error(f"Unexpected error parsing FHIR-suffixed version '{original_v_str}': {e}")
-                    return pkg_version.parse("0.0.0a0")
-            else:
-                logger.warning(f"Unparseable version '{original_v_str}' (base '{base_part}' not standard). Treating as alpha.")
-                return pkg_version.parse("0.0.0a0")
-        except Exception as e:
-            logger.error(f"Unexpected error in safe_parse_version_local for '{v_str}': {e}")
-            return pkg_version.parse("0.0.0a0")
-
-    in_memory_cache = app.config.get('MANUAL_PACKAGE_CACHE')
-    if in_memory_cache:
-        cached_data = [pkg for pkg in in_memory_cache if isinstance(pkg, dict) and pkg.get('name', '').lower() == name.lower()]
+    catalog = get_package_catalog()
+    if catalog:
+        cached_data = catalog.get(name)
         if cached_data:
             packages = cached_data
             source = "In-Memory Cache"
@@ -2973,7 +3184,7 @@ def package_details_view(name):
     # Since all_versions now contains dictionaries with version and pubDate, extract just the version for display
     versions_sorted = []
     try:
-        versions_sorted = sorted(all_versions, key=lambda x: safe_parse_version_local(x['version']), reverse=True)
+        versions_sorted = sorted(all_versions, key=lambda x: version_sort_key(x['version']), reverse=True)
     except Exception as sort_err:
         logger.warning(f"Version sorting failed for {name}: {sort_err}. Using basic reverse sort.")
         versions_sorted = sorted(all_versions, key=lambda x: x['pubDate'], reverse=True)
@@ -180,7 +180,7 @@ class TestDataUploadForm(FlaskForm):
     password = PasswordField('Password', validators=[Optional()],
                             render_kw={'placeholder': 'Enter Basic Auth Password'})
     test_data_file = FileField('Select Test Data File(s)', validators=[InputRequired("Please select at least one file.")],
-                              render_kw={'multiple': True, 'accept': '.json,.xml,.zip'})
+                              render_kw={'multiple': True, 'accept': '.json,.ndjson,.gz,.xml,.zip'})
     validate_before_upload = BooleanField('Validate Resources Before Upload?', default=False,
                                           description="Validate resources against selected package profile before uploading.")
     validation_package_id = SelectField('Validation Profile Package (Optional)',
@@ -1,10 +1,10 @@
-from flask import Blueprint, jsonify, current_app, render_template
+from flask import Blueprint, jsonify, current_app, render_template, request
 import os
 import tarfile
 import json
 from datetime import datetime
 import time
-from services import pkg_version, safe_parse_version
+from services import version_sort_key, get_package_catalog
 
 package_bp = Blueprint('package', __name__)
 
@@ -20,12 +20,12 @@ def logs(name):
         Rendered template with logs or an error message.
     """
     try:
-        in_memory_cache = current_app.config.get('MANUAL_PACKAGE_CACHE', [])
-        if not in_memory_cache:
+        catalog = get_package_catalog()
+        if not catalog:
             current_app.logger.error(f"No in-memory cache found for package logs: {name}")
             return "<p class='text-muted'>Package cache not found.</p>"
 
-        package_data = next((pkg for pkg in in_memory_cache if isinstance(pkg, dict) and pkg.get('name', '').lower() == name.lower()), None)
+        package_data = next(iter(catalog.get(name)), None)
         if not package_data:
             current_app.logger.error(f"Package not found in cache: {name}")
             return "<p class='text-muted'>Package not found.</p>"
@@ -80,7 +80,7 @@ def logs(name):
             return "<p class='text-muted'>No version history found for this package.</p>"
 
         # Sort logs by version number (newest first)
-        logs.sort(key=lambda x: safe_parse_version(x.get('version', '0.0.0a0')), reverse=True)
+        logs.sort(key=lambda x: version_sort_key(x.get('version', '0.0.0a0')), reverse=True)
 
         current_app.logger.debug(f"Rendering logs for {name} with {len(logs)} entries")
         return render_template('package.logs.html', logs=logs)
@@ -93,31 +93,15 @@ def logs(name):
 def dependents(name):
     """
     HTMX endpoint to fetch packages that depend on the current package.
-    Returns an HTML fragment with a table of dependent packages.
+    Returns an HTML fragment with a table of dependent packages. With ?transitive=true,
+    packages that depend on it indirectly are listed as well.
     """
-    in_memory_cache = current_app.config.get('MANUAL_PACKAGE_CACHE', [])
-    package_data = next((pkg for pkg in in_memory_cache if isinstance(pkg, dict) and pkg.get('name', '').lower() == name.lower()), None)
-
-    if not package_data:
+    catalog = get_package_catalog()
+    if not catalog or not catalog.get(name):
         return "<p class='text-danger'>Package not found.</p>"
 
-    # Find dependents: packages whose dependencies include the current package
-    dependents = []
-    for pkg in in_memory_cache:
-        if not isinstance(pkg, dict):
-            continue
-        dependencies = pkg.get('dependencies', [])
-        for dep in dependencies:
-            dep_name = dep.get('name', '')
-            if dep_name.lower() == name.lower():
-                dependents.append({
-                    "name": pkg.get('name', 'Unknown'),
-                    "version": pkg.get('latest_absolute_version', 'N/A'),
-                    "author": pkg.get('author', 'N/A'),
-                    "fhir_version": pkg.get('fhir_version', 'N/A'),
-                    "version_count": pkg.get('version_count', 0),
-                    "canonical": pkg.get('canonical', 'N/A')
-                })
-                break
+    # Dependents come from the reverse adjacency of the dependency graph built per refresh
+    transitive = request.args.get('transitive', 'false').lower() == 'true'
+    dependents = catalog.dependents(name, transitive=transitive)
 
     return render_template('package.dependents.html', dependents=dependents)
\ No newline at end of file
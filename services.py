@@ -9,16 +9,37 @@ import sqlite3
 import feedparser
 from flask import current_app, Blueprint, request, jsonify
 from fhirpathpy import evaluate
+from fhirpathpy import compile as compile_fhirpath
 from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from urllib.parse import quote, urlparse
 from types import SimpleNamespace
 import datetime
+import email.utils
+import functools
+import gzip
+import hashlib
+import itertools
+import http.cookiejar
+import threading
+import time
 import subprocess
 import tempfile
 import zipfile
 import xml.etree.ElementTree as ET
 from flasgger import swag_from # Import swag_from here
+from cachetools import LRUCache
+from contextlib import contextmanager
+from urllib3.util.retry import Retry
+try:
+    import fcntl  # POSIX only; shared cache locking is skipped without it
+except ImportError:
+    fcntl = None
+try:
+    import ijson  # Optional: incremental JSON parsing of streamed registry feeds and large Bundles
+except ImportError:
+    ijson = None
 
 # Define Blueprint
 services_bp = Blueprint('services', __name__)
@@ -72,9 +93,57 @@ except ImportError:
 
 # --- Constants ---
 FHIR_REGISTRY_BASE_URL = "https://packages.fhir.org"
+FEED_REGISTRY_URL = "https://raw.githubusercontent.com/FHIR/ig-registry/master/package-feeds.json"
+# CachedPackage columns filled from the normalized package dict of the same key
+CACHED_PACKAGE_COLUMNS = ('author', 'fhir_version', 'version_count', 'url', 'all_versions', 'dependencies',
+                          'latest_absolute_version', 'latest_official_version', 'canonical', 'registry')
+CACHED_PACKAGE_UPSERT_CHUNK_SIZE = 500 # Rows per executemany batch
+PACKAGE_CATALOG_GRAM_SIZE = 3 # Longest name/author substring indexed by the package catalog
+VERSION_KEY_CACHE_SIZE = 65536 # Distinct version strings kept parsed
 DOWNLOAD_DIR_NAME = "fhir_packages"
 CANONICAL_PACKAGE = ("hl7.fhir.r4.core", "4.0.1")
 CANONICAL_PACKAGE_ID = f"{CANONICAL_PACKAGE[0]}#{CANONICAL_PACKAGE[1]}"
+MEMBER_INDEX_FORMAT_VERSION = 2
+PACKAGE_STORE_DIR_NAME = ".extracted"
+SHARED_CACHE_WORK_DIR_NAME = ".fhirflare" # Locks and temporary entries inside the shared package cache
+# Package-level JSON files that are not FHIR resources
+PACKAGE_METADATA_FILES = {'package.json', '.index.json', 'validation-summary.json', 'validation-oo.json'}
+FHIRPATH_COMPILE_CACHE_SIZE = 4096 # Distinct FHIRPath expressions kept in parsed form
+COMPILED_VALIDATOR_CACHE_SIZE = 256 # Compiled profile validators kept per process
+VALIDATION_DEFAULT_MAX_WORKERS = 4 # Concurrent entry validations per bundle request
+REGISTRY_FEED_DEFAULT_MAX_WORKERS = 8 # Registry feeds fetched concurrently
+REGISTRY_FEED_DEFAULT_TIMEOUT = 30 # Seconds per feed request
+FEED_STREAM_CHUNK_SIZE = 64 * 1024
+FHIR_FEED_NAMESPACE = "http://hl7.org/fhir/feed"
+HAPI_VALIDATE_DEFAULT_BATCH_SIZE = 50 # $validate calls packed into one batch Bundle
+HAPI_VALIDATE_BATCH_TIMEOUT = 60
+PACKAGE_DOWNLOAD_DEFAULT_MAX_WORKERS = 4 # Packages fetched concurrently per dependency level
+PUSH_DEFAULT_MAX_WORKERS = 4 # Resources uploaded concurrently within a push wave
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+HTTP_DEFAULT_POOL_CONNECTIONS = 16 # Hosts with a kept-alive connection pool
+HTTP_DEFAULT_POOL_MAXSIZE = 20 # Kept-alive connections per host
+HTTP_DEFAULT_MAX_RETRIES = 3 # Retries of idempotent requests on connection errors and 502/503/504
+HTTP_DEFAULT_RETRY_BACKOFF = 0.5 # Seconds, doubled on each retry
+HTTP_DEFAULT_CONNECT_TIMEOUT = 10 # Seconds; call sites pass the read timeout
+HTTP_RETRY_STATUSES = (502, 503, 504)
+PROXY_CACHE_DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+PROXY_CACHE_DEFAULT_MAX_ENTRY_BYTES = 2 * 1024 * 1024 # Larger responses are streamed through uncached
+PROXY_CACHE_DEFAULT_SPILL_MAX_BYTES = 256 * 1024 * 1024
+PROXY_CACHE_STORABLE_STATUSES = (200, 203)
+# Request headers that select or authorize a representation, so they are part of the cache key
+PROXY_CACHE_KEY_HEADERS = ('Accept', 'Authorization', 'Cookie', 'Prefer')
+PROXY_CACHE_SPILL_SUFFIX = '.proxycache'
+RETRIEVE_DEFAULT_PAGE_SIZE = 100 # _count requested per search page
+RETRIEVE_DEFAULT_MAX_PAGES = 1000 # Pages followed per resource type
+RETRIEVE_PAGE_FORMATS = ('bundle', 'ndjson') # One Bundle file per page, or one NDJSON file per resource type (Bulk Data layout)
+NDJSON_SUFFIXES = ('.ndjson', '.ndjson.gz')
+RETRIEVE_REFERENCE_DEFAULT_BATCH_SIZE = 50 # Ids per _id=a,b,c reference search
+RETRIEVE_REFERENCE_DEFAULT_MAX_WORKERS = 4 # Reference searches in flight at once
+REFERENCE_PENDING = object() # iter_resolved_references marker: the reference's search has been sent
+# Client request headers the /fhir proxy does not pass on to the target FHIR server
+PROXY_EXCLUDED_REQUEST_HEADERS = frozenset({'host', 'x-target-fhir-server', 'content-length', 'connection', 'keep-alive', 'proxy-authenticate',
+                                            'proxy-authorization', 'te', 'trailers', 'transfer-encoding', 'upgrade'})
+FHIR_DEFAULT_ACCEPT = 'application/fhir+json, application/fhir+xml;q=0.9, */*;q=0.8'
 
 # --- Define Canonical Types ---
 CANONICAL_RESOURCE_TYPES = {
@@ -83,6 +152,17 @@ CANONICAL_RESOURCE_TYPES = {
     "OperationDefinition", "MessageDefinition", "CompartmentDefinition",
     "GraphDefinition", "StructureMap", "Questionnaire"
 }
+# Push waves: referenced canonical artifacts are uploaded before what refers to them (code systems before
+# the value sets including them, value sets before the profiles binding them, profiles before the
+# definitions and instances using them). Types not listed form the last wave.
+PUSH_WAVE_ORDER = (
+    ("NamingSystem", "CodeSystem"),
+    ("ValueSet", "ConceptMap"),
+    ("StructureDefinition",),
+    ("SearchParameter", "OperationDefinition", "CompartmentDefinition", "MessageDefinition", "GraphDefinition",
+     "StructureMap", "Questionnaire", "CapabilityStatement", "ImplementationGuide"),
+)
+_PUSH_WAVE_INDEX = {resource_type: index for index, types in enumerate(PUSH_WAVE_ORDER) for resource_type in types}
 # -----------------------------
 
 # Define standard FHIR R4 base types
@@ -121,11 +201,19 @@ FHIR_R4_BASE_TYPES = {
 # -------------------------------------------------------------------
 #Helper function to support normalize:
 
-def safe_parse_version(v_str):
+# FHIR pre-release suffixes mapped to PEP 440 pre-release markers (checked in order, by prefix)
+FHIR_VERSION_SUFFIXES = (
+    ('ci-build', 'a'), ('cibuild', 'a'), ('snapshot', 'a'), ('dev', 'a'),
+    ('draft', 'b'), ('ballot', 'b'), ('preview', 'b'),
+    ('rc', 'rc'),
+)
+_PRE_RELEASE_RANKS = {'a': 0, 'b': 1, 'rc': 2}
+
+def _parse_version(v_str):
     """
     Attempts to parse a version string using packaging.version.
-    Handles common FHIR suffixes like -dev, -ballot, -draft, -preview
-    by treating them as standard pre-releases (-a0, -b0, -rc0) for comparison.
+    Handles common FHIR suffixes like -snapshot, -cibuild, -ballot, -draft, -preview
+    by treating them as standard pre-releases (a, b, rc) for comparison.
     Returns a comparable Version object or a fallback for unparseable strings.
     """
     if not v_str or not isinstance(v_str, str):
@@ -150,17 +238,11 @@ def safe_parse_version(v_str):
         # Check if base looks like a version number
         if re.match(r'^\d+(\.\d+)*$', base_part):
             try:
-                # Map FHIR suffixes to PEP 440 pre-release types for sorting
-                if suffix in ['dev', 'snapshot', 'ci-build']:
-                    # Treat as alpha (earliest pre-release)
-                    return pkg_version.parse(f"{base_part}a0")
-                elif suffix in ['draft', 'ballot', 'preview']:
-                    # Treat as beta (after alpha)
-                    return pkg_version.parse(f"{base_part}b0")
-                # Add more mappings if needed (e.g., -rc -> rc0)
-                elif suffix and suffix.startswith('rc'):
-                     rc_num = ''.join(filter(str.isdigit, suffix)) or '0'
-                     return pkg_version.parse(f"{base_part}rc{rc_num}")
+                # Map FHIR suffixes to PEP 440 pre-release types for sorting (e.g. -ballot2 -> b2)
+                for prefix, marker in FHIR_VERSION_SUFFIXES:
+                    if suffix and suffix.startswith(prefix):
+                        number = ''.join(filter(str.isdigit, suffix[len(prefix):])) or '0'
+                        return pkg_version.parse(f"{base_part}{marker}{number}")
 
                 # If suffix isn't recognized, still try parsing base as final/post
                 # This might happen for odd suffixes like -final (though unlikely)
@@ -184,19 +266,501 @@ def safe_parse_version(v_str):
          logger.error(f"Unexpected error in safe_parse_version for '{v_str}': {e}")
          return pkg_version.parse("0.0.0a0") # Fallback
 
+def _version_key_from_parsed(version):
+    """
+    Builds a plain tuple that orders exactly like the PEP 440 Version it came from:
+    (epoch, release without trailing zeros, pre, post, dev, local).
+    Without the packaging library (BasicVersion), the key is the plain version string,
+    matching BasicVersion's string comparison.
+    """
+    if not HAS_PACKAGING_LIB or not hasattr(version, 'release'):
+        return (str(version),)
+    release = tuple(version.release)
+    while len(release) > 1 and release[-1] == 0:
+        release = release[:-1]
+    if version.pre is not None:
+        pre = (1, _PRE_RELEASE_RANKS.get(version.pre[0], 0), version.pre[1])
+    elif version.post is None and version.dev is not None:
+        pre = (0, 0, 0) # 1.0.dev0 sorts before 1.0a0
+    else:
+        pre = (2, 0, 0)
+    post = (0, 0) if version.post is None else (1, version.post)
+    dev = (1, 0) if version.dev is None else (0, version.dev)
+    local = () if version.local is None else tuple(
+        (1, int(part), '') if part.isdigit() else (0, 0, part) for part in re.split(r'[._-]', version.local))
+    return (version.epoch, release, pre, post, dev, local)
+
+@functools.lru_cache(maxsize=VERSION_KEY_CACHE_SIZE)
+def _interned_version(v_str):
+    """Parses v_str once and returns (Version, sort key); bounded LRU shared by all callers."""
+    version = _parse_version(v_str)
+    return version, _version_key_from_parsed(version)
+
+def safe_parse_version(v_str):
+    """
+    Returns a comparable Version for v_str (see _parse_version for the FHIR suffix rules).
+    Results are memoized, so repeated strings are parsed (and warned about) only once.
+    """
+    return _interned_version(v_str if isinstance(v_str, str) else None)[0]
+
+def version_sort_key(v_str):
+    """
+    Returns a memoized tuple sort key for v_str with the same ordering as safe_parse_version.
+    Tuples compare far faster than Version objects, so use this as a sort/max key.
+    """
+    return _interned_version(v_str if isinstance(v_str, str) else None)[1]
+
+# --- Shared HTTP client ---
+# All outbound calls (registries, package downloads, HAPI, proxied and pushed FHIR requests) go
+# through one pooled, keep-alive session so TCP/TLS connections are reused across requests.
+# A second session without retries carries one-shot (streamed) request bodies.
+_http_sessions = {}
+_http_session_lock = threading.Lock()
+_http_host_stats = {}
+_http_stats_lock = threading.Lock()
+
+def _get_http_setting(key, default, cast=int):
+    """Reads a non-negative HTTP client setting from the app config."""
+    try:
+        value = current_app.config.get(key, default)
+    except RuntimeError:
+        value = default
+    try:
+        return max(0, cast(value))
+    except (TypeError, ValueError):
+        logger.warning(f"Invalid {key} value {value!r}, using {default}.")
+        return default
+
+def _record_http_call(url, seconds, status):
+    """Adds one request to the per-host latency metrics; status is None for a failed request."""
+    host = urlparse(url).netloc or url
+    with _http_stats_lock:
+        stats = _http_host_stats.setdefault(host, {'requests': 0, 'errors': 0, 'total_seconds': 0.0, 'max_seconds': 0.0})
+        stats['requests'] += 1
+        if status is None or status >= 500:
+            stats['errors'] += 1
+        stats['total_seconds'] += seconds
+        stats['max_seconds'] = max(stats['max_seconds'], seconds)
+
+class _PooledSession(requests.Session):
+    """requests.Session that applies the configured connect timeout and records per-host latency."""
+
+    def __init__(self, connect_timeout=HTTP_DEFAULT_CONNECT_TIMEOUT):
+        super().__init__()
+        self.connect_timeout = connect_timeout
+
+    def request(self, method, url, *args, **kwargs):
+        timeout = kwargs.get('timeout')
+        if isinstance(timeout, (int, float)):
+            kwargs['timeout'] = (min(self.connect_timeout, timeout), timeout)
+        started = time.perf_counter()
+        try:
+            response = super().request(method, url, *args, **kwargs)
+        except requests.exceptions.RequestException:
+            _record_http_call(url, time.perf_counter() - started, None)
+            raise
+        _record_http_call(url, time.perf_counter() - started, response.status_code)
+        return response
+
+def get_http_session(retry=True):
+    """
+    Returns the process-wide pooled session, creating it on first use from HTTP_POOL_MAXSIZE,
+    HTTP_MAX_RETRIES and HTTP_CONNECT_TIMEOUT. Idempotent requests are retried with exponential
+    backoff on connection errors and 502/503/504 (honouring Retry-After); POSTs are never retried.
+    Pass retry=False for requests whose body is a stream that cannot be resent; that session
+    shares the same settings but never retries.
+    The session is thread-safe for concurrent requests; do not set per-caller state on it.
+    """
+    with _http_session_lock:
+        session = _http_sessions.get(retry)
+        if session is None:
+            retries = Retry(
+                total=_get_http_setting('HTTP_MAX_RETRIES', HTTP_DEFAULT_MAX_RETRIES),
+                backoff_factor=HTTP_DEFAULT_RETRY_BACKOFF,
+                status_forcelist=HTTP_RETRY_STATUSES,
+                raise_on_status=False
+            ) if retry else 0
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=HTTP_DEFAULT_POOL_CONNECTIONS,
+                pool_maxsize=_get_http_setting('HTTP_POOL_MAXSIZE', HTTP_DEFAULT_POOL_MAXSIZE),
+                max_retries=retries
+            )
+            session = _PooledSession(_get_http_setting('HTTP_CONNECT_TIMEOUT', HTTP_DEFAULT_CONNECT_TIMEOUT, float))
+            # Shared across users and target servers, so never persist response cookies
+            session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _http_sessions[retry] = session
+        return session
+
+def reset_http_session():
+    """Closes the shared sessions so the next get_http_session() call rebuilds them (e.g. after a config change)."""
+    with _http_session_lock:
+        for session in _http_sessions.values():
+            session.close()
+        _http_sessions.clear()
+
+def get_http_client_stats():
+    """Returns per-host request counts, error counts and average/max latency in milliseconds."""
+    with _http_stats_lock:
+        return {host: {
+            'requests': stats['requests'],
+            'errors': stats['errors'],
+            'avg_ms': round(stats['total_seconds'] * 1000 / stats['requests'], 1) if stats['requests'] else 0.0,
+            'max_ms': round(stats['max_seconds'] * 1000, 1)
+        } for host, stats in _http_host_stats.items()}
+
+# --- Proxied FHIR Response Cache ---
+# Opt-in HTTP cache for GETs through the /fhir proxy. Entries are keyed by target URL and the
+# representation/auth request headers, honour upstream Cache-Control/Expires and are revalidated
+# with If-None-Match/If-Modified-Since once stale.
+_proxy_cache = None
+_proxy_cache_lock = threading.Lock()
+
+def _parse_cache_control(value):
+    """Parses a Cache-Control header into {directive: argument or True}."""
+    directives = {}
+    for part in (value or '').split(','):
+        name, _, argument = part.strip().partition('=')
+        if name:
+            directives[name.lower()] = argument.strip().strip('"') if argument else True
+    return directives
+
+def _delta_seconds(value):
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return 0
+
+def proxy_cache_lifetime(response_headers, default_ttl=0):
+    """
+    Returns the number of seconds a proxied response stays fresh, or None if it must not be stored
+    (no-store, private, Vary: *, Set-Cookie or nothing to revalidate with once stale). Uses s-maxage/max-age,
+    then Expires relative to Date, then default_ttl, less the upstream Age.
+    """
+    directives = _parse_cache_control(response_headers.get('Cache-Control'))
+    if 'no-store' in directives or 'private' in directives or response_headers.get('Vary', '').strip() == '*':
+        return None
+    if response_headers.get('Set-Cookie'):
+        return None # A shared cache would replay one client's cookie to every client with the same key
+    if 'no-cache' in directives:
+        lifetime = 0
+    elif 's-maxage' in directives or 'max-age' in directives:
+        lifetime = _delta_seconds(directives.get('s-maxage', directives.get('max-age')))
+    elif response_headers.get('Expires'):
+        try:
+            expires = email.utils.parsedate_to_datetime(response_headers['Expires'])
+            date = email.utils.parsedate_to_datetime(response_headers['Date']) if response_headers.get('Date') else datetime.datetime.now(datetime.timezone.utc)
+            lifetime = max(0, int((expires - date).total_seconds()))
+        except (TypeError, ValueError):
+            lifetime = 0 # An invalid Expires means already expired
+    else:
+        lifetime = default_ttl
+    lifetime = max(0, lifetime - _delta_seconds(response_headers.get('Age')))
+    if lifetime == 0 and not (response_headers.get('ETag') or response_headers.get('Last-Modified')):
+        return None
+    return lifetime
+
+def proxy_cache_key(url, request_headers):
+    """Cache key for a proxied GET: the full target URL plus the headers in PROXY_CACHE_KEY_HEADERS."""
+    parts = [url] + [f"{name}:{request_headers.get(name, '')}" for name in PROXY_CACHE_KEY_HEADERS]
+    return hashlib.sha256('\n'.join(parts).encode('utf-8')).hexdigest()
+
+def build_proxy_cache_entry(url, status, response_headers, headers, body, request_headers, lifetime):
+    """
+    Builds a cache entry for a proxied response. response_headers are the upstream headers,
+    headers the filtered ones to replay to clients; Vary'd request header values are recorded
+    so lookups with different values miss.
+    """
+    vary = [name.strip() for name in response_headers.get('Vary', '').split(',') if name.strip()]
+    now = time.time()
+    return {
+        'url': url,
+        'status': status,
+        'headers': dict(headers),
+        'body': body,
+        'etag': response_headers.get('ETag'),
+        'last_modified': response_headers.get('Last-Modified'),
+        'vary': {name: request_headers.get(name, '') for name in vary},
+        'stored_at': now,
+        'expires_at': now + lifetime
+    }
+
+def _proxy_entry_size(entry):
+    return len(entry['body']) + 1024 # Body plus a rough allowance for headers and metadata
+
+class _ProxyMemoryCache(LRUCache):
+    """LRUCache that hands evicted proxy entries to the owning cache for spilling."""
+    def __init__(self, maxsize, on_evict):
+        super().__init__(maxsize=maxsize, getsizeof=_proxy_entry_size)
+        self.on_evict = on_evict
+
+    def popitem(self):
+        key, entry = super().popitem()
+        self.on_evict(key, entry)
+        return key, entry
+
+class _ProxySpillIndex(LRUCache):
+    """LRU index of spilled entries (key -> (size, url)) that deletes the spill file of evicted keys."""
+    def __init__(self, maxsize, spill_path):
+        super().__init__(maxsize=maxsize, getsizeof=lambda value: value[0])
+        self.spill_path = spill_path
+
+    def popitem(self):
+        key, value = super().popitem()
+        try:
+            os.remove(self.spill_path(key))
+        except OSError:
+            pass
+        return key, value
+
+class ProxyResponseCache:
+    """
+    Byte-bounded LRU of proxied GET responses. With a spill_dir, entries evicted from memory are
+    written to disk (itself bounded by spill_max_bytes) and promoted back on their next lookup.
+    Entries are shared between requests and must not be mutated by callers.
+    """
+
+    def __init__(self, max_bytes=PROXY_CACHE_DEFAULT_MAX_BYTES, max_entry_bytes=PROXY_CACHE_DEFAULT_MAX_ENTRY_BYTES,
+                 spill_dir=None, spill_max_bytes=PROXY_CACHE_DEFAULT_SPILL_MAX_BYTES, default_ttl=0):
+        self.max_entry_bytes = min(max_entry_bytes, max_bytes)
+        self.default_ttl = default_ttl
+        self.spill_dir = spill_dir or None
+        self.stats = {'hits': 0, 'misses': 0, 'revalidated': 0, 'stores': 0, 'evictions': 0, 'spilled': 0, 'invalidated': 0}
+        self._lock = threading.RLock()
+        self._memory = _ProxyMemoryCache(max_bytes, self._spill)
+        self._spilled = None
+        if self.spill_dir and spill_max_bytes > 0:
+            try:
+                os.makedirs(self.spill_dir, exist_ok=True)
+                for name in os.listdir(self.spill_dir):
+                    if name.endswith(PROXY_CACHE_SPILL_SUFFIX):
+                        os.remove(os.path.join(self.spill_dir, name)) # Left over from a previous process
+                self._spilled = _ProxySpillIndex(spill_max_bytes, self._spill_path)
+            except OSError as e:
+                logger.warning(f"Proxy cache spill directory {self.spill_dir} unavailable, keeping entries in memory only: {e}")
+
+    def _spill_path(self, key):
+        return os.path.join(self.spill_dir, key + PROXY_CACHE_SPILL_SUFFIX)
+
+    def _spill(self, key, entry):
+        """Writes an entry evicted from memory to disk as one JSON metadata line followed by the body."""
+        self.stats['evictions'] += 1
+        if self._spilled is None:
+            return
+        metadata = {k: v for k, v in entry.items() if k != 'body'}
+        try:
+            with open(self._spill_path(key), 'wb') as f:
+                f.write(json.dumps(metadata).encode('utf-8') + b'\n')
+                f.write(entry['body'])
+            self._spilled[key] = (_proxy_entry_size(entry), entry['url'])
+            self.stats['spilled'] += 1
+        except (OSError, ValueError) as e:
+            logger.debug(f"Could not spill proxy cache entry for {entry['url']}: {e}")
+
+    def _load_spilled(self, key):
+        path = self._spill_path(key)
+        try:
+            with open(path, 'rb') as f:
+                metadata = json.loads(f.readline())
+                metadata['body'] = f.read()
+            return metadata
+        except (OSError, ValueError) as e:
+            logger.debug(f"Could not read spilled proxy cache entry {path}: {e}")
+            return None
+        finally:
+            self._spilled.pop(key, None)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def lookup(self, key, request_headers):
+        """Returns the stored entry for key if its Vary'd request headers match, else None."""
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is None and self._spilled is not None and key in self._spilled:
+                entry = self._load_spilled(key)
+                if entry is not None:
+                    self._memory[key] = entry
+            if entry is None or any(request_headers.get(name, '') != value for name, value in entry['vary'].items()):
+                self.stats['misses'] += 1
+                return None
+            return entry
+
+    def is_fresh(self, entry):
+        return time.time() < entry['expires_at']
+
+    def lifetime_for(self, status, response_headers):
+        """Freshness lifetime of an upstream response if it may be stored here, else None."""
+        if status not in PROXY_CACHE_STORABLE_STATUSES:
+            return None
+        declared_length = response_headers.get('Content-Length', '')
+        if declared_length.isdigit() and int(declared_length) > self.max_entry_bytes:
+            return None
+        return proxy_cache_lifetime(response_headers, self.default_ttl)
+
+    def store(self, key, entry):
+        """Stores an entry, returning False when its body is over the per-entry limit."""
+        if len(entry['body']) > self.max_entry_bytes:
+            return False
+        with self._lock:
+            self._memory.pop(key, None)
+            if self._spilled is not None and key in self._spilled:
+                self._spilled.pop(key)
+                try:
+                    os.remove(self._spill_path(key))
+                except OSError:
+                    pass
+            self._memory[key] = entry
+            self.stats['stores'] += 1
+        return True
+
+    def refresh(self, key, entry, response_headers):
+        """
+        Records a 304 Not Modified revalidation of entry: returns a copy with updated validators
+        and freshness, stored under key (or dropped when the 304 forbids storing).
+        """
+        merged = dict(entry['headers'])
+        for name in ('Cache-Control', 'Expires', 'ETag', 'Last-Modified'):
+            if name in response_headers:
+                merged[name] = response_headers[name]
+        lifetime = proxy_cache_lifetime(dict(merged, Date=response_headers.get('Date', ''), Age=response_headers.get('Age', '0'), Vary=response_headers.get('Vary', '')), self.default_ttl)
+        refreshed = dict(entry, headers=merged, etag=merged.get('ETag', entry['etag']),
+                         last_modified=merged.get('Last-Modified', entry['last_modified']),
+                         stored_at=time.time(), expires_at=time.time() + (lifetime or 0))
+        with self._lock:
+            self.stats['revalidated'] += 1
+            if lifetime is None:
+                self._memory.pop(key, None)
+            else:
+                self._memory[key] = refreshed
+        return refreshed
+
+    def record_hit(self):
+        with self._lock:
+            self.stats['hits'] += 1
+
+    def invalidate(self, url_prefix=None):
+        """Drops entries whose target URL starts with url_prefix (all entries if None), e.g. after a write."""
+        with self._lock:
+            dropped = 0
+            for key in [k for k, entry in self._memory.items() if url_prefix is None or entry['url'].startswith(url_prefix)]:
+                del self._memory[key]
+                dropped += 1
+            if self._spilled is not None:
+                for key in [k for k, (_, url) in self._spilled.items() if url_prefix is None or url.startswith(url_prefix)]:
+                    del self._spilled[key]
+                    try:
+                        os.remove(self._spill_path(key))
+                    except OSError:
+                        pass
+                    dropped += 1
+            self.stats['invalidated'] += dropped
+        if dropped:
+            logger.debug(f"Invalidated {dropped} proxy cache entries for {url_prefix or 'all targets'}")
+        return dropped
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats, entries=len(self._memory), current_bytes=self._memory.currsize, max_bytes=self._memory.maxsize,
+                        spilled_entries=len(self._spilled) if self._spilled is not None else 0,
+                        spilled_bytes=self._spilled.currsize if self._spilled is not None else 0)
+
+def get_proxy_cache():
+    """
+    Returns the process-wide proxy response cache, or None unless FHIR_PROXY_CACHE_ENABLED is set.
+    The cache is created on first use from the FHIR_PROXY_CACHE_* settings.
+    """
+    global _proxy_cache
+    try:
+        config = current_app.config
+    except RuntimeError:
+        return None
+    if not config.get('FHIR_PROXY_CACHE_ENABLED', False):
+        return None
+    with _proxy_cache_lock:
+        if _proxy_cache is None:
+            _proxy_cache = ProxyResponseCache(
+                max_bytes=_get_http_setting('FHIR_PROXY_CACHE_MAX_BYTES', PROXY_CACHE_DEFAULT_MAX_BYTES),
+                max_entry_bytes=_get_http_setting('FHIR_PROXY_CACHE_MAX_ENTRY_BYTES', PROXY_CACHE_DEFAULT_MAX_ENTRY_BYTES),
+                spill_dir=config.get('FHIR_PROXY_CACHE_DIR', ''),
+                spill_max_bytes=_get_http_setting('FHIR_PROXY_CACHE_DIR_MAX_BYTES', PROXY_CACHE_DEFAULT_SPILL_MAX_BYTES),
+                default_ttl=_get_http_setting('FHIR_PROXY_CACHE_DEFAULT_TTL', 0)
+            )
+            logger.info(f"Initialized proxy response cache with a budget of {_proxy_cache.get_stats()['max_bytes']} bytes")
+        return _proxy_cache
+
+def reset_proxy_cache():
+    """Drops the proxy cache (and its spilled entries) so the next get_proxy_cache() call rebuilds it."""
+    global _proxy_cache
+    with _proxy_cache_lock:
+        if _proxy_cache is not None:
+            _proxy_cache.invalidate()
+            _proxy_cache = None
+
+def build_upstream_headers(headers):
+    """
+    Returns the headers to send to the target FHIR server for a client's request headers: hop-by-hop
+    and proxy control headers (X-Target-FHIR-Server) are dropped and Accept defaults to FHIR formats.
+    Shared by the /fhir proxy and direct upstream clients so both present the same request.
+    """
+    forwarded = {k: v for k, v in headers.items() if k.lower() not in PROXY_EXCLUDED_REQUEST_HEADERS}
+    if not any(k.lower() == 'accept' for k in forwarded):
+        forwarded['Accept'] = FHIR_DEFAULT_ACCEPT
+    return forwarded
+
 # --- MODIFIED FUNCTION with Enhanced Logging ---
-def get_additional_registries():
-    """Fetches the list of additional FHIR IG registries from the master feed."""
+def _conditional_get(url, state, timeout, stream=False):
+    """
+    GETs url, sending If-None-Match/If-Modified-Since from state when it already holds parsed data
+    for the url. Returns None on 304 Not Modified, otherwise the (status-checked) response;
+    with stream=True the caller reads the body incrementally and must close the response.
+    """
+    headers = {}
+    if state and state.get('data') is not None:
+        if state.get('etag'):
+            headers['If-None-Match'] = state['etag']
+        if state.get('last_modified'):
+            headers['If-Modified-Since'] = state['last_modified']
+    response = get_http_session().get(url, timeout=timeout, headers=headers, stream=stream)
+    if response.status_code == 304 and headers:
+        response.close()
+        return None
+    if stream and response.status_code >= 400:
+        response.close()
+    response.raise_for_status()
+    return response
+
+def _store_feed_state(state, response, data):
+    """Records the validators and parsed data of a successful feed response in its feed state entry."""
+    if state is None:
+        return
+    state['etag'] = response.headers.get('ETag')
+    state['last_modified'] = response.headers.get('Last-Modified')
+    state['data'] = data
+    state['changed'] = True
+
+def get_additional_registries(feed_state=None):
+    """
+    Fetches the list of additional FHIR IG registries from the master feed.
+    If feed_state (a dict keyed by URL) is given, the request is conditional and the
+    cached list is reused when the master feed has not changed.
+    """
     logger.debug("Entering get_additional_registries function")
-    feed_registry_url = 'https://raw.githubusercontent.com/FHIR/ig-registry/master/package-feeds.json'
+    feed_registry_url = FEED_REGISTRY_URL
     feeds = [] # Default to empty list
+    state = feed_state.setdefault(feed_registry_url, {}) if feed_state is not None else None
     try:
         logger.info(f"Attempting to fetch feed registry from {feed_registry_url}")
         # Use a reasonable timeout
-        response = requests.get(feed_registry_url, timeout=15)
+        response = _conditional_get(feed_registry_url, state, 15)
+        if response is None:
+            feeds = state['data']
+            state['changed'] = False
+            logger.info(f"Feed registry not modified, reusing {len(feeds)} cached feeds")
+            return feeds
         logger.debug(f"Feed registry request to {feed_registry_url} returned status code: {response.status_code}")
-        # Raise HTTPError for bad responses (4xx or 5xx)
-        response.raise_for_status()
 
         # Log successful fetch
         logger.debug(f"Successfully fetched feed registry. Response text (first 500 chars): {response.text[:500]}...")
@@ -210,6 +774,7 @@ def get_additional_registries():
                      for feed in feeds_raw
                      if isinstance(feed, dict) and 'name' in feed and 'url' in feed]
             logger.info(f"Successfully parsed {len(feeds)} valid feeds from {feed_registry_url}")
+            _store_feed_state(state, response, feeds)
 
         except json.JSONDecodeError as e:
             # Log JSON parsing errors specifically
@@ -237,93 +802,269 @@ def get_additional_registries():
         logger.error(f"Unexpected error fetching feed registry from {feed_registry_url}: {e}", exc_info=True)
         # feeds remains []
 
+    if not feeds and state and state.get('data'):
+        feeds = state['data']
+        state['changed'] = False
+        logger.warning(f"Using {len(feeds)} previously cached feeds after feed registry fetch failure")
     logger.debug(f"Exiting get_additional_registries function, returning {len(feeds)} feeds.")
     return feeds
 # --- END MODIFIED FUNCTION ---
 
-def fetch_packages_from_registries(search_term=''):
+def _parse_feed_packages(feed, response_text, search_term=''):
+    """Parses a registry feed body (package JSON or Atom/RSS) into a list of raw package entries."""
+    feed_packages = []
+    try:
+        data = json.loads(response_text)
+        num_feed_packages = len(data.get('packages', []))
+        logger.info(f"Fetched from feed {feed['name']}: {num_feed_packages} packages (JSON)")
+        for pkg in data.get('packages', []):
+            if not isinstance(pkg, dict):
+                continue
+            pkg_name = pkg.get('name', '')
+            if not pkg_name:
+                continue
+            feed_packages.append(pkg)
+    except json.JSONDecodeError:
+        feed_data = feedparser.parse(response_text)
+        if not feed_data.entries:
+            logger.warning(f"No entries found in feed {feed['name']}")
+            return feed_packages
+        num_rss_packages = len(feed_data.entries)
+        logger.info(f"Fetched from feed {feed['name']}: {num_rss_packages} packages (Atom/RSS)")
+        logger.info(f"Sample feed entries from {feed['name']}: {feed_data.entries[:2]}")
+        for entry in feed_data.entries:
+            try:
+                # Extract package name and version from title (e.g., "hl7.fhir.au.ereq#0.3.0-preview")
+                title = entry.get('title', '')
+                if '#' in title:
+                    pkg_name, version = title.split('#', 1)
+                else:
+                    pkg_name = title
+                    version = entry.get('version', '')
+                if not pkg_name:
+                    pkg_name = entry.get('id', '') or entry.get('summary', '')
+                if not pkg_name:
+                    continue
+
+                package = {
+                    'name': pkg_name,
+                    'version': version,
+                    'author': entry.get('author', ''),
+                    'fhirVersion': entry.get('fhir_version', [''])[0] or '',
+                    'url': entry.get('link', ''),
+                    'canonical': entry.get('canonical', ''),
+                    'dependencies': entry.get('dependencies', []),
+                    'pubDate': entry.get('published', entry.get('pubdate', '')),
+                    'registry': feed['url']
+                }
+                if search_term and package['name'] and search_term.lower() not in package['name'].lower():
+                    continue
+                feed_packages.append(package)
+            except Exception as entry_error:
+                logger.error(f"Error processing entry in feed {feed['name']}: {entry_error}")
+                logger.info(f"Problematic entry: {entry}")
+    return feed_packages
+
+class _ChunkStream:
+    """Minimal read()-able file object over an iterator of byte chunks; counts the bytes consumed."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = b''
+        self.bytes_read = 0
+
+    def _fill(self, size):
+        # Chunks are joined once per call; growing the buffer chunk by chunk would copy it quadratically
+        parts = [self._buffer]
+        buffered = len(self._buffer)
+        while size < 0 or buffered < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self.bytes_read += len(chunk)
+            parts.append(chunk)
+            buffered += len(chunk)
+        if len(parts) > 1:
+            self._buffer = b''.join(parts)
+
+    def peek(self, size=1):
+        self._fill(size)
+        return self._buffer[:size]
+
+    def read(self, size=-1):
+        self._fill(size)
+        if size < 0:
+            data, self._buffer = self._buffer, b''
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+def _feed_entry_fields(element):
+    """Flattens an RSS <item> / Atom <entry> element into a dict keyed like feedparser entries."""
+    fields = {}
+    for child in element:
+        namespace, _, local = child.tag[1:].partition('}') if child.tag.startswith('{') else ('', '', child.tag)
+        key = f"fhir_{local}" if namespace == FHIR_FEED_NAMESPACE else local
+        if local == 'link' and child.get('href'):
+            fields.setdefault('link', child.get('href'))
+        elif local == 'author' and len(child):
+            fields.setdefault('author', (child.findtext('{http://www.w3.org/2005/Atom}name') or child.findtext('name') or '').strip())
+        elif local == 'creator':
+            fields.setdefault('author', (child.text or '').strip())
+        else:
+            fields.setdefault(key, (child.text or '').strip())
+    return fields
+
+def _iter_xml_feed_packages(feed, stream, search_term=''):
+    """Incrementally parses an RSS/Atom registry feed, yielding one raw package entry per item."""
+    parser = ET.XMLPullParser(events=('end',))
+    chunk = stream.read(FEED_STREAM_CHUNK_SIZE)
+    while chunk:
+        parser.feed(chunk)
+        for _, element in parser.read_events():
+            if element.tag.rsplit('}', 1)[-1] not in ('item', 'entry'):
+                continue
+            entry = _feed_entry_fields(element)
+            element.clear() # Parsed entries are not kept in the tree
+            # Extract package name and version from title (e.g., "hl7.fhir.au.ereq#0.3.0-preview")
+            title = entry.get('title', '')
+            if '#' in title:
+                pkg_name, version = title.split('#', 1)
+            else:
+                pkg_name = title
+                version = entry.get('version', '')
+            if not pkg_name:
+                pkg_name = entry.get('guid') or entry.get('id') or entry.get('summary') or entry.get('description') or ''
+            if not pkg_name:
+                continue
+            if search_term and search_term.lower() not in pkg_name.lower():
+                continue
+            yield {
+                'name': pkg_name,
+                'version': version,
+                'author': entry.get('author', ''),
+                'fhirVersion': entry.get('fhir_version', ''),
+                'url': entry.get('link', ''),
+                'canonical': entry.get('fhir_canonical') or entry.get('canonical', ''),
+                'dependencies': [],
+                'pubDate': entry.get('pubDate') or entry.get('published') or entry.get('updated', ''),
+                'registry': feed['url']
+            }
+        chunk = stream.read(FEED_STREAM_CHUNK_SIZE)
+    parser.close()
+
+def iter_feed_packages(feed, response, search_term=''):
+    """
+    Streams raw package entries out of a registry feed response (opened with stream=True)
+    without holding the body in memory: JSON feeds are parsed with ijson when it is installed,
+    RSS/Atom feeds with an incremental XML parser. Returns (entries generator, byte-counting stream).
+    Raises ValueError / ET.ParseError (from the generator) on malformed feeds.
+    """
+    stream = _ChunkStream(response.iter_content(chunk_size=FEED_STREAM_CHUNK_SIZE))
+    head = stream.peek(64).lstrip(b'\xef\xbb\xbf \t\r\n')
+    if not head.startswith((b'{', b'[')):
+        return _iter_xml_feed_packages(feed, stream, search_term), stream
+
+    def iter_ijson_packages():
+        try:
+            yield from ijson.items(stream, 'packages.item', use_float=True)
+        except ijson.JSONError as e:
+            # ijson's errors are not ValueErrors; raise the documented type so callers can fall back
+            raise ValueError(f"Invalid JSON feed: {e}")
+
+    def iter_json():
+        if ijson is not None:
+            packages = iter_ijson_packages()
+        else:
+            packages = json.load(stream).get('packages', []) # Without ijson only the text copy is avoided
+        for pkg in packages:
+            if isinstance(pkg, dict) and pkg.get('name', ''):
+                yield pkg
+    return iter_json(), stream
+
+def _open_json_stream(open_stream):
+    """Opens a binary JSON stream positioned after any UTF-8 byte order mark."""
+    fp = open_stream()
+    if fp.peek(3)[:3] == b'\xef\xbb\xbf':
+        fp.read(3)
+    return fp
+
+def _json_top_level_resource_type(fp):
+    """Reads parser events only until the top-level resourceType (normally the first key) is known."""
+    for prefix, event, value in ijson.parse(fp, use_float=True):
+        if prefix == 'resourceType' and event == 'string':
+            return value
+        if prefix == '' and event in ('start_array', 'end_map'):
+            return None
+    return None
+
+def read_json_bundle(open_stream):
+    """
+    Reads a JSON document for resource extraction. Returns (entries, None) for a Bundle, where
+    entries yields its Bundle.entry items one at a time, or (None, document) for anything else.
+    open_stream() must return a fresh binary file object (a file opened 'rb' or a ZIP member) on
+    each call. With ijson installed a Bundle is parsed incrementally, one pass to find resourceType
+    and one to stream the entries, so peak memory is bounded by the largest entry rather than the
+    Bundle; without it the document is loaded whole. Malformed JSON raises ValueError.
+    """
+    if ijson is None:
+        with _open_json_stream(open_stream) as fp:
+            document = json.load(fp)
+        if isinstance(document, dict) and document.get('resourceType') == 'Bundle':
+            return iter(document.get('entry') or []), None
+        return None, document
+
+    try:
+        with _open_json_stream(open_stream) as fp:
+            resource_type = _json_top_level_resource_type(fp)
+        if resource_type != 'Bundle':
+            with _open_json_stream(open_stream) as fp:
+                return None, json.load(fp)
+    except ijson.JSONError as e:
+        raise ValueError(f"Invalid JSON: {e}")
+
+    def iter_entries():
+        with _open_json_stream(open_stream) as fp:
+            try:
+                yield from ijson.items(fp, 'entry.item', use_float=True)
+            except ijson.JSONError as e:
+                raise ValueError(f"Invalid JSON: {e}")
+    return iter_entries(), None
+
+def fetch_packages_from_registries(search_term='', feed_state=None):
+    """
+    Fetches and aggregates packages from all registry feeds.
+    feed_state (a dict keyed by feed URL, see get_additional_registries) enables conditional
+    requests: feeds answering 304 Not Modified reuse their previously parsed entries, and each
+    entry's 'changed' flag tells the caller which feeds were actually re-downloaded and parsed.
+    """
     logger.debug("Entering fetch_packages_from_registries function with search_term: %s", search_term)
     packages_dict = defaultdict(list)
+    if search_term:
+        feed_state = None # Cached feed data is unfiltered
     
     try:
         logger.debug("Calling get_additional_registries")
-        feed_registries = get_additional_registries()
+        feed_registries = get_additional_registries(feed_state)
         logger.debug("Returned from get_additional_registries with %d registries: %s", len(feed_registries), feed_registries)
         
         if not feed_registries:
             logger.warning("No feed registries available. Cannot fetch packages.")
             return []
         
-        logger.info(f"Processing {len(feed_registries)} feed registries")
-        for feed in feed_registries:
-            try:
-                logger.info(f"Fetching feed: {feed['name']} from {feed['url']}")
-                response = requests.get(feed['url'], timeout=30)
-                response.raise_for_status()
-                
-                # Log the raw response content for debugging
-                response_text = response.text[:500]  # Limit to first 500 chars for logging
-                logger.debug(f"Raw response from {feed['url']}: {response_text}")
-                
-                try:
-                    data = json.loads(response.text)
-                    num_feed_packages = len(data.get('packages', []))
-                    logger.info(f"Fetched from feed {feed['name']}: {num_feed_packages} packages (JSON)")
-                    for pkg in data.get('packages', []):
-                        if not isinstance(pkg, dict):
-                            continue
-                        pkg_name = pkg.get('name', '')
-                        if not pkg_name:
-                            continue
-                        packages_dict[pkg_name].append(pkg)
-                except json.JSONDecodeError:
-                    feed_data = feedparser.parse(response.text)
-                    if not feed_data.entries:
-                        logger.warning(f"No entries found in feed {feed['name']}")
-                        continue
-                    num_rss_packages = len(feed_data.entries)
-                    logger.info(f"Fetched from feed {feed['name']}: {num_rss_packages} packages (Atom/RSS)")
-                    logger.info(f"Sample feed entries from {feed['name']}: {feed_data.entries[:2]}")
-                    for entry in feed_data.entries:
-                        try:
-                            # Extract package name and version from title (e.g., "hl7.fhir.au.ereq#0.3.0-preview")
-                            title = entry.get('title', '')
-                            if '#' in title:
-                                pkg_name, version = title.split('#', 1)
-                            else:
-                                pkg_name = title
-                                version = entry.get('version', '')
-                            if not pkg_name:
-                                pkg_name = entry.get('id', '') or entry.get('summary', '')
-                            if not pkg_name:
-                                continue
-                            
-                            package = {
-                                'name': pkg_name,
-                                'version': version,
-                                'author': entry.get('author', ''),
-                                'fhirVersion': entry.get('fhir_version', [''])[0] or '',
-                                'url': entry.get('link', ''),
-                                'canonical': entry.get('canonical', ''),
-                                'dependencies': entry.get('dependencies', []),
-                                'pubDate': entry.get('published', entry.get('pubdate', '')),
-                                'registry': feed['url']
-                            }
-                            if search_term and package['name'] and search_term.lower() not in package['name'].lower():
-                                continue
-                            packages_dict[pkg_name].append(package)
-                        except Exception as entry_error:
-                            logger.error(f"Error processing entry in feed {feed['name']}: {entry_error}")
-                            logger.info(f"Problematic entry: {entry}")
-            except requests.exceptions.HTTPError as e:
-                if e.response.status_code == 404:
-                    logger.warning(f"Feed endpoint not found for {feed['name']}: {feed['url']} - 404 Not Found")
-                else:
-                    logger.error(f"HTTP error fetching from feed {feed['name']}: {e}")
-            except requests.exceptions.RequestException as e:
-                logger.error(f"Request error fetching from feed {feed['name']}: {e}")
-            except Exception as error:
-                logger.error(f"Unexpected error fetching from feed {feed['name']}: {error}")
+        workers = min(_get_registry_feed_setting('REGISTRY_FEED_MAX_WORKERS', REGISTRY_FEED_DEFAULT_MAX_WORKERS), len(feed_registries))
+        timeout = _get_registry_feed_setting('REGISTRY_FEED_TIMEOUT', REGISTRY_FEED_DEFAULT_TIMEOUT)
+        logger.info(f"Processing {len(feed_registries)} feed registries with {workers} workers")
+        states = [feed_state.setdefault(feed['url'], {}) if feed_state is not None else None for feed in feed_registries]
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='feed') as executor:
+            fetch = functools.partial(_fetch_feed, search_term=search_term, timeout=timeout, streaming=_is_feed_streaming_enabled())
+            fetched = list(executor.map(fetch, feed_registries, states))
+        # Merge in feed order so aggregation does not depend on which feed answered first
+        for feed_packages, _ in fetched:
+            for pkg in feed_packages:
+                packages_dict[pkg.get('name', '')].append(pkg)
+        _log_feed_timing_report([report for _, report in fetched], time.monotonic() - started)
     except Exception as e:
         logger.error(f"Unexpected error in fetch_packages_from_registries: {e}")
     
@@ -363,10 +1104,126 @@ def fetch_packages_from_registries(search_term=''):
     logger.info(f"Total packages fetched: {len(packages)}")
     return packages
 
+def _get_registry_feed_setting(key, default):
+    """Reads a positive integer feed fetching setting from the app config."""
+    try:
+        value = current_app.config.get(key, default)
+    except RuntimeError:
+        value = default
+    try:
+        return max(1, int(value))
+    except (TypeError, ValueError):
+        logger.warning(f"Invalid {key} value {value!r}, using {default}.")
+        return default
+
+def _is_feed_streaming_enabled():
+    """Returns whether registry feeds are parsed incrementally from the response stream."""
+    try:
+        return current_app.config.get('REGISTRY_FEED_STREAMING', True)
+    except RuntimeError:
+        return True
+
+def _reuse_cached_feed(feed, state):
+    """Falls back to a feed's previously parsed entries when refreshing it fails."""
+    if state and state.get('data') is not None:
+        state['changed'] = False
+        logger.warning(f"Using {len(state['data'])} cached packages for feed {feed['name']} after fetch failure")
+        return state['data']
+    return []
+
+def _stream_feed_packages(feed, state, search_term, timeout, report, conditional=True):
+    """
+    Fetches one registry feed with stream=True and parses it as it arrives (see iter_feed_packages).
+    Returns the parsed entries, or None on 304 Not Modified.
+    """
+    response = _conditional_get(feed['url'], state if conditional else None, timeout, stream=True)
+    if response is None:
+        return None
+    with response:
+        report['status'] = response.status_code
+        entries, stream = iter_feed_packages(feed, response, search_term)
+        feed_packages = list(entries)
+        report['bytes'] = stream.bytes_read
+    logger.info(f"Fetched from feed {feed['name']}: {len(feed_packages)} packages (streamed)")
+    _store_feed_state(state, response, feed_packages)
+    return feed_packages
+
+def _download_feed_packages(feed, state, search_term, timeout, report, conditional=True):
+    """
+    Fetches one registry feed in full and parses it with _parse_feed_packages.
+    Returns the parsed entries, or None on 304 Not Modified.
+    """
+    response = _conditional_get(feed['url'], state if conditional else None, timeout)
+    if response is None:
+        return None
+    report['status'] = response.status_code
+    report['bytes'] = len(response.content or b'')
+    # Log the raw response content for debugging
+    response_text = response.text[:500]  # Limit to first 500 chars for logging
+    logger.debug(f"Raw response from {feed['url']}: {response_text}")
+    feed_packages = _parse_feed_packages(feed, response.text, search_term)
+    _store_feed_state(state, response, feed_packages)
+    return feed_packages
+
+def _fetch_feed(feed, state, search_term='', timeout=REGISTRY_FEED_DEFAULT_TIMEOUT, streaming=True):
+    """
+    Fetches and parses one registry feed (conditionally, if state is given).
+    With streaming, the body is parsed incrementally as it arrives; a feed the incremental parser
+    rejects is fetched again and parsed in full, since feedparser tolerates malformed XML.
+    Returns (feed_packages, report) where report holds the feed's status, duration and size.
+    """
+    report = {'name': feed['name'], 'url': feed['url'], 'status': None, 'seconds': 0.0, 'bytes': 0, 'packages': 0}
+    started = time.monotonic()
+    feed_packages = []
+    try:
+        logger.info(f"Fetching feed: {feed['name']} from {feed['url']}")
+        fetch = _stream_feed_packages if streaming else _download_feed_packages
+        try:
+            feed_packages = fetch(feed, state, search_term, timeout, report)
+        except (ValueError, ET.ParseError) as parse_error:
+            if not streaming or isinstance(parse_error, requests.exceptions.RequestException):
+                raise
+            logger.warning(f"Streaming parse of feed {feed['name']} failed ({parse_error}); refetching it for a full parse")
+            feed_packages = _download_feed_packages(feed, state, search_term, timeout, report, conditional=False)
+        if feed_packages is None:
+            feed_packages = state['data']
+            state['changed'] = False
+            report['status'] = 304
+            logger.info(f"Feed {feed['name']} not modified, reusing {len(feed_packages)} cached packages")
+    except requests.exceptions.HTTPError as e:
+        report['status'] = e.response.status_code if e.response is not None else 'error'
+        if e.response is not None and e.response.status_code == 404:
+            logger.warning(f"Feed endpoint not found for {feed['name']}: {feed['url']} - 404 Not Found")
+        else:
+            logger.error(f"HTTP error fetching from feed {feed['name']}: {e}")
+        feed_packages = _reuse_cached_feed(feed, state)
+    except requests.exceptions.Timeout as e:
+        report['status'] = 'timeout'
+        logger.error(f"Timeout fetching from feed {feed['name']} after {timeout}s: {e}")
+        feed_packages = _reuse_cached_feed(feed, state)
+    except requests.exceptions.RequestException as e:
+        report['status'] = 'error'
+        logger.error(f"Request error fetching from feed {feed['name']}: {e}")
+        feed_packages = _reuse_cached_feed(feed, state)
+    except Exception as error:
+        report['status'] = 'error'
+        logger.error(f"Unexpected error fetching from feed {feed['name']}: {error}")
+        feed_packages = _reuse_cached_feed(feed, state)
+    report['seconds'] = time.monotonic() - started
+    report['packages'] = len(feed_packages)
+    return feed_packages, report
+
+def _log_feed_timing_report(reports, total_seconds):
+    """Logs per-feed status, duration and size, slowest first, so slow registries are visible in the refresh log stream."""
+    logger.info(f"Feed timing report ({len(reports)} feeds fetched in {total_seconds:.2f}s):")
+    for report in sorted(reports, key=lambda r: r['seconds'], reverse=True):
+        logger.info(f"  {report['name']}: status={report['status']}, {report['seconds']:.2f}s, "
+                    f"{report['bytes'] / 1024:.1f} KB, {report['packages']} packages ({report['url']})")
+
 def normalize_package_data(raw_packages):
     """
     Normalizes package data, identifying latest absolute and latest official versions.
-    Uses safe_parse_version for robust comparison.
+    Compares memoized version_sort_key tuples, so each distinct version string is parsed once.
     """
     packages_grouped = defaultdict(list)
     skipped_raw_count = 0
@@ -395,8 +1252,8 @@ def normalize_package_data(raw_packages):
         total_entries_considered += len(entries)
         latest_absolute_data = None
         latest_official_data = None
-        latest_absolute_ver_for_comp = safe_parse_version("0.0.0a0")
-        latest_official_ver_for_comp = safe_parse_version("0.0.0a0")
+        latest_absolute_ver_for_comp = version_sort_key("0.0.0a0")
+        latest_official_ver_for_comp = version_sort_key("0.0.0a0")
         all_versions = []
         package_name_display = name_key
 
@@ -446,7 +1303,7 @@ def normalize_package_data(raw_packages):
             processed_entries.append(entry_with_version)
 
             try:
-                current_ver_obj_for_comp = safe_parse_version(version_str)
+                current_ver_obj_for_comp = version_sort_key(version_str)
                 if latest_absolute_data is None or current_ver_obj_for_comp > latest_absolute_ver_for_comp:
                     latest_absolute_ver_for_comp = current_ver_obj_for_comp
                     latest_absolute_data = entry_with_version
@@ -531,10 +1388,49 @@ def normalize_package_data(raw_packages):
     normalized_list.sort(key=lambda x: x.get('name', '').lower())
     return normalized_list
 
+def _cached_package_row(package):
+    """Maps a normalized package dict to CachedPackage column values."""
+    row = {'package_name': package['name'], 'version': package['version']}
+    row.update({column: package.get(column, '' if column == 'registry' else None) for column in CACHED_PACKAGE_COLUMNS})
+    return row
+
+def _bulk_upsert_cached_packages(rows, db, CachedPackage):
+    """
+    Inserts or updates CachedPackage rows in one executemany statement using
+    INSERT ... ON CONFLICT (package_name, version) DO UPDATE. Falls back to the ORM
+    for database backends without ON CONFLICT support. The caller commits.
+    """
+    if not rows:
+        return
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    elif dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        logger.debug(f"No ON CONFLICT support for {dialect}, upserting CachedPackage rows through the ORM.")
+        existing = {(p.package_name, p.version): p for p in CachedPackage.query.all()}
+        for row in rows:
+            package = existing.get((row['package_name'], row['version']))
+            if package is None:
+                db.session.add(CachedPackage(**row))
+            else:
+                for column in CACHED_PACKAGE_COLUMNS:
+                    setattr(package, column, row[column])
+        return
+    stmt = dialect_insert(CachedPackage.__table__)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['package_name', 'version'],
+        set_={column: stmt.excluded[column] for column in CACHED_PACKAGE_COLUMNS}
+    )
+    for start in range(0, len(rows), CACHED_PACKAGE_UPSERT_CHUNK_SIZE):
+        db.session.execute(stmt, rows[start:start + CACHED_PACKAGE_UPSERT_CHUNK_SIZE])
+
 def cache_packages(normalized_packages, db, CachedPackage):
     """
     Cache normalized FHIR Implementation Guide packages in the CachedPackage database.
     Updates existing records or adds new ones to improve performance for other routes.
+    All rows are written with a bulk INSERT ... ON CONFLICT DO UPDATE in a single transaction.
     
     Args:
         normalized_packages (list): List of normalized package dictionaries.
@@ -542,42 +1438,227 @@ def cache_packages(normalized_packages, db, CachedPackage):
         CachedPackage: The CachedPackage model class.
     """
     try:
-        for package in normalized_packages:
-            existing = CachedPackage.query.filter_by(package_name=package['name'], version=package['version']).first()
-            if existing:
-                existing.author = package['author']
-                existing.fhir_version = package['fhir_version']
-                existing.version_count = package['version_count']
-                existing.url = package['url']
-                existing.all_versions = package['all_versions']
-                existing.dependencies = package['dependencies']
-                existing.latest_absolute_version = package['latest_absolute_version']
-                existing.latest_official_version = package['latest_official_version']
-                existing.canonical = package['canonical']
-                existing.registry = package.get('registry', '')
-            else:
-                new_package = CachedPackage(
-                    package_name=package['name'],
-                    version=package['version'],
-                    author=package['author'],
-                    fhir_version=package['fhir_version'],
-                    version_count=package['version_count'],
-                    url=package['url'],
-                    all_versions=package['all_versions'],
-                    dependencies=package['dependencies'],
-                    latest_absolute_version=package['latest_absolute_version'],
-                    latest_official_version=package['latest_official_version'],
-                    canonical=package['canonical'],
-                    registry=package.get('registry', '')
-                )
-                db.session.add(new_package)
+        # Later duplicates of a (name, version) key win, as with the previous per-row updates
+        rows = list({(p['name'], p['version']): _cached_package_row(p) for p in normalized_packages}.values())
+        existing_keys = set(db.session.query(CachedPackage.package_name, CachedPackage.version).all())
+        new_count = sum(1 for row in rows if (row['package_name'], row['version']) not in existing_keys)
+        _bulk_upsert_cached_packages(rows, db, CachedPackage)
         db.session.commit()
-        logger.info(f"Cached {len(normalized_packages)} packages in CachedPackage.")
+        logger.info(f"Cached {len(normalized_packages)} packages in CachedPackage ({new_count} new, {len(rows) - new_count} updated).")
     except Exception as error:
         db.session.rollback()
         logger.error(f"Error caching packages: {error}")
         raise
 
+def sync_cached_packages(normalized_packages, db, CachedPackage):
+    """
+    Brings the CachedPackage table in line with normalized_packages by diffing against the
+    existing rows: new packages are inserted, changed rows updated and packages no longer
+    listed by any feed deleted. Unchanged rows are not touched. The caller commits.
+
+    Returns:
+        dict: Counts of 'added', 'updated', 'removed' and 'unchanged' rows.
+    """
+    counts = {'added': 0, 'updated': 0, 'removed': 0, 'unchanged': 0}
+    existing_rows = {(row.package_name, row.version): row for row in CachedPackage.query.all()}
+    seen = set()
+    upserts = []
+    for package in normalized_packages:
+        key = (package['name'], package['version'])
+        if key in seen:
+            continue
+        seen.add(key)
+        values = _cached_package_row(package)
+        row = existing_rows.get(key)
+        if row is None:
+            upserts.append(values)
+            counts['added'] += 1
+        elif any(getattr(row, column) != values[column] for column in CACHED_PACKAGE_COLUMNS):
+            upserts.append(values)
+            counts['updated'] += 1
+        else:
+            counts['unchanged'] += 1
+    removed_ids = [row.id for key, row in existing_rows.items() if key not in seen]
+    _bulk_upsert_cached_packages(upserts, db, CachedPackage)
+    for start in range(0, len(removed_ids), CACHED_PACKAGE_UPSERT_CHUNK_SIZE):
+        db.session.execute(CachedPackage.__table__.delete().where(CachedPackage.id.in_(removed_ids[start:start + CACHED_PACKAGE_UPSERT_CHUNK_SIZE])))
+    counts['removed'] = len(removed_ids)
+    logger.info(f"Synced CachedPackage table: {counts['added']} added, {counts['updated']} updated, {counts['removed']} removed, {counts['unchanged']} unchanged.")
+    return counts
+
+class PackageDependencyGraph:
+    """
+    Forward and reverse dependency adjacency between packages, keyed by lowercase package name.
+    Edges come from each package's latest dependency list; original name casing is kept for display.
+    """
+
+    def __init__(self, edges=()):
+        self._forward = defaultdict(dict)
+        self._reverse = defaultdict(set)
+        self._names = {}
+        for package_name, dependency_name, dependency_version in edges:
+            self.add_edge(package_name, dependency_name, dependency_version)
+
+    @classmethod
+    def from_packages(cls, packages):
+        """Builds the graph from normalized package dicts."""
+        graph = cls()
+        for package in packages or []:
+            if not isinstance(package, dict) or not package.get('name'):
+                continue
+            graph._names.setdefault(package['name'].lower(), package['name'])
+            for dependency in package.get('dependencies') or []:
+                if isinstance(dependency, dict) and dependency.get('name'):
+                    graph.add_edge(package['name'], dependency['name'], dependency.get('version'))
+        return graph
+
+    def add_edge(self, package_name, dependency_name, dependency_version=None):
+        package_key, dependency_key = package_name.lower(), dependency_name.lower()
+        self._names.setdefault(package_key, package_name)
+        self._names.setdefault(dependency_key, dependency_name)
+        self._forward[package_key].setdefault(dependency_key, dependency_version)
+        self._reverse[dependency_key].add(package_key)
+
+    def edges(self):
+        """Yields (package_name, dependency_name, dependency_version) tuples, e.g. for persistence."""
+        for package_key, dependencies in self._forward.items():
+            for dependency_key, dependency_version in dependencies.items():
+                yield self._names[package_key], self._names[dependency_key], dependency_version
+
+    def __len__(self):
+        return sum(len(dependencies) for dependencies in self._forward.values())
+
+    def _walk(self, adjacency, name, transitive):
+        start = (name or '').lower()
+        if not transitive:
+            return sorted(self._names[key] for key in adjacency.get(start, ()))
+        seen = {start}
+        queue = deque([start])
+        while queue:
+            for key in adjacency.get(queue.popleft(), ()):
+                if key not in seen:
+                    seen.add(key)
+                    queue.append(key)
+        seen.discard(start)
+        return sorted(self._names[key] for key in seen)
+
+    def dependencies(self, name, transitive=False):
+        """Returns the names name depends on, directly or (transitive=True) through any path."""
+        return self._walk(self._forward, name, transitive)
+
+    def dependents(self, name, transitive=False):
+        """Returns the names that depend on name, directly or (transitive=True) through any path."""
+        return self._walk(self._reverse, name, transitive)
+
+class PackageCatalog:
+    """
+    Read-only, indexed view over a normalized package list. Built once per refresh and
+    swapped into app.config as a whole, so readers never see a half-built index.
+
+    Entries are shallow copies of the source dicts carrying a precomputed 'display_version',
+    so request handlers never mutate the shared cache. graph is derived from the packages
+    unless a (persisted) PackageDependencyGraph is supplied.
+    """
+
+    def __init__(self, packages, graph=None):
+        self.source = packages
+        self.packages = []
+        self._by_name = defaultdict(list)
+        self._grams = defaultdict(list)
+        self._search_text = []
+        self._positions = {}
+        started = time.perf_counter()
+        for package in packages or []:
+            if not isinstance(package, dict):
+                continue
+            position = len(self.packages)
+            entry = dict(package)
+            entry['display_version'] = package.get('latest_official_version') or package.get('latest_absolute_version') or 'N/A'
+            self.packages.append(entry)
+            name = (package.get('name') or '').lower()
+            author = (package.get('author') or '').lower()
+            self._by_name[name].append(entry)
+            self._positions.setdefault(name, position)
+            self._search_text.append((name, author))
+            grams = set()
+            for text in (name, author):
+                for size in range(1, PACKAGE_CATALOG_GRAM_SIZE + 1):
+                    grams.update(text[i:i + size] for i in range(len(text) - size + 1))
+            for gram in grams:
+                self._grams[gram].append(position)
+        self.graph = graph if graph is not None else PackageDependencyGraph.from_packages(self.packages)
+        logger.debug(f"Built package catalog: {len(self.packages)} packages, {len(self._grams)} index keys, {len(self.graph)} dependency edges in {time.perf_counter() - started:.3f}s")
+
+    def __len__(self):
+        return len(self.packages)
+
+    def get(self, name):
+        """Returns the catalog entries whose name matches name (case-insensitive)."""
+        return self._by_name.get((name or '').lower(), [])
+
+    def search(self, term):
+        """
+        Returns entries whose name or author contains term (case-insensitive), in catalog order.
+        Terms up to PACKAGE_CATALOG_GRAM_SIZE characters are answered straight from the index;
+        longer terms scan the rarest of their grams and confirm each candidate.
+        """
+        term = (term or '').lower()
+        if not term:
+            return list(self.packages)
+        if len(term) <= PACKAGE_CATALOG_GRAM_SIZE:
+            return [self.packages[position] for position in self._grams.get(term, ())]
+        size = PACKAGE_CATALOG_GRAM_SIZE
+        candidates = min((self._grams.get(term[i:i + size], ()) for i in range(len(term) - size + 1)), key=len)
+        return [self.packages[position] for position in candidates
+                if term in self._search_text[position][0] or term in self._search_text[position][1]]
+
+    def dependents(self, name, transitive=False):
+        """
+        Returns summaries of cached packages listing name as a dependency, in catalog order.
+        With transitive=True, packages depending on it through any chain are included.
+        """
+        positions = sorted(self._positions[key] for key in map(str.lower, self.graph.dependents(name, transitive)) if key in self._positions)
+        entries = [self.packages[position] for position in positions]
+        return [{
+            "name": entry.get('name', 'Unknown'),
+            "version": entry.get('latest_absolute_version', 'N/A'),
+            "author": entry.get('author', 'N/A'),
+            "fhir_version": entry.get('fhir_version', 'N/A'),
+            "version_count": entry.get('version_count', 0),
+            "canonical": entry.get('canonical', 'N/A')
+        } for entry in entries]
+
+_package_catalog_lock = threading.Lock()
+
+def publish_package_catalog(packages, graph=None):
+    """Builds a catalog for packages and installs it together with MANUAL_PACKAGE_CACHE."""
+    catalog = PackageCatalog(packages, graph)
+    with _package_catalog_lock:
+        current_app.config['MANUAL_PACKAGE_CACHE'] = packages
+        current_app.config['PACKAGE_CATALOG'] = catalog
+    return catalog
+
+def get_package_catalog():
+    """
+    Returns the catalog for the current MANUAL_PACKAGE_CACHE, or None if nothing is cached.
+    The catalog is rebuilt on demand when the cache list was replaced without publishing one.
+    """
+    packages = current_app.config.get('MANUAL_PACKAGE_CACHE')
+    if packages is None:
+        return None
+    catalog = current_app.config.get('PACKAGE_CATALOG')
+    if catalog is not None and catalog.source is packages:
+        return catalog
+    with _package_catalog_lock:
+        packages = current_app.config.get('MANUAL_PACKAGE_CACHE')
+        catalog = current_app.config.get('PACKAGE_CATALOG')
+        if packages is None:
+            return None
+        if catalog is None or catalog.source is not packages:
+            catalog = PackageCatalog(packages)
+            current_app.config['PACKAGE_CATALOG'] = catalog
+    return catalog
+
 #-----------------------------------------------------------------------
 
 # --- Helper Functions ---
@@ -623,14 +1704,11 @@ def get_package_description(package_name, package_version, packages_dir):
         return f"Error: Package file not found ({tgz_filename})."
 
     try:
-        with tarfile.open(tgz_path, "r:gz") as tar:
-            pkg_json_member = next((m for m in tar if m.name == 'package/package.json'), None)
-            if pkg_json_member:
-                with tar.extractfile(pkg_json_member) as f:
-                    pkg_data = json.load(f)
-                    return pkg_data.get('description', 'No description found in package.json.')
-            else:
-                return "Error: package.json not found in archive."
+        try:
+            pkg_data = json.loads(read_package_file(tgz_path, 'package/package.json').decode('utf-8-sig'))
+        except KeyError:
+            return "Error: package.json not found in archive."
+        return pkg_data.get('description', 'No description found in package.json.')
     except (tarfile.TarError, json.JSONDecodeError, KeyError, IOError, Exception) as e:
         logger.error(f"Error reading description from {tgz_filename}: {e}")
         return f"Error reading package details: {e}"
@@ -868,90 +1946,437 @@ def cache_structure(package_name, package_version, resource_type, view, structur
     except Exception as e:
         logger.error(f"Error caching structure: {e}", exc_info=True)
 
+# --- Package Member Index ---
+# In-process copy of the on-disk member indexes, keyed by tgz path
+_member_index_cache = {}
+_member_index_lock = threading.Lock()
+
+def construct_member_index_path(tgz_path):
+    """Constructs the path of the member index file stored alongside a package .tgz."""
+    base_path = tgz_path[:-4] if tgz_path.endswith('.tgz') else tgz_path
+    return f"{base_path}.members.json"
+
+def _compute_file_sha256(file_path):
+    """Computes the sha256 hex digest of a file, reading it in chunks."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _get_tgz_signature(tgz_path):
+    """Returns (size, mtime) of a package file, used to detect stale member indexes."""
+    stat_result = os.stat(tgz_path)
+    return stat_result.st_size, stat_result.st_mtime_ns
+
+def build_package_member_index(tgz_path):
+    """
+    Scans a package .tgz once and records every JSON member under package/.
+    Each entry holds resourceType, id, name, url, type, baseDefinition (and base for
+    SearchParameters) plus the member's data offset and size in the uncompressed tar stream,
+    so later lookups can read a single member without parsing the rest of the archive.
+    The archive's sha256 is recorded as the key of its extracted package store directory.
+    The index is written next to the .tgz and returned.
+    """
+    tgz_size, tgz_mtime = _get_tgz_signature(tgz_path)
+    member_index = {
+        'format_version': MEMBER_INDEX_FORMAT_VERSION,
+        'tgz_size': tgz_size,
+        'tgz_mtime': tgz_mtime,
+        'sha256': _compute_file_sha256(tgz_path),
+        'package_name': None,
+        'package_version': None,
+        'dependencies': {},
+        'members': []
+    }
+    logger.debug(f"Building member index for {os.path.basename(tgz_path)}")
+    with tarfile.open(tgz_path, "r:gz") as tar:
+        for member in tar:
+            if not (member.isfile() and member.name.startswith('package/') and member.name.lower().endswith('.json')):
+                continue
+            entry = {
+                'path': member.name,
+                'offset': member.offset_data,
+                'size': member.size,
+                'resourceType': None,
+                'id': None,
+                'name': None,
+                'url': None,
+                'type': None,
+                'baseDefinition': None
+            }
+            data = None
+            fileobj = None
+            try:
+                fileobj = tar.extractfile(member)
+                if fileobj:
+                    data = json.loads(fileobj.read().decode('utf-8-sig'))
+            except (json.JSONDecodeError, UnicodeDecodeError) as e:
+                logger.debug(f"Could not parse JSON in {member.name} while indexing, recording path only: {e}")
+            finally:
+                if fileobj:
+                    fileobj.close()
+            if isinstance(data, dict):
+                if member.name == 'package/package.json':
+                    member_index['package_name'] = data.get('name')
+                    member_index['package_version'] = data.get('version')
+                    member_index['dependencies'] = data.get('dependencies', {}) or {}
+                for key in ('resourceType', 'id', 'name', 'url', 'type', 'baseDefinition'):
+                    value = data.get(key)
+                    entry[key] = value if isinstance(value, str) else None
+                if entry['resourceType'] == 'SearchParameter':
+                    entry['base'] = [b for b in data.get('base', []) if isinstance(b, str)]
+            member_index['members'].append(entry)
+
+    index_path = construct_member_index_path(tgz_path)
+    temp_path = f"{index_path}.tmp"
+    try:
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(member_index, f)
+        os.replace(temp_path, index_path)
+        logger.info(f"Built member index for {os.path.basename(tgz_path)} with {len(member_index['members'])} entries")
+    except OSError as e:
+        logger.warning(f"Could not write member index {index_path}, keeping it in memory only: {e}")
+    with _member_index_lock:
+        _member_index_cache[tgz_path] = member_index
+    return member_index
+
+def get_package_member_index(tgz_path):
+    """
+    Returns the member index for a package .tgz, loading it from disk or building it if
+    missing or stale (size/mtime of the .tgz changed). Returns None if the package is unreadable.
+    """
+    try:
+        signature = _get_tgz_signature(tgz_path)
+    except OSError as e:
+        logger.debug(f"Cannot stat package file {tgz_path} for member index: {e}")
+        return None
+    with _member_index_lock:
+        cached = _member_index_cache.get(tgz_path)
+    if cached and (cached['tgz_size'], cached['tgz_mtime']) == signature:
+        return cached
+    index_path = construct_member_index_path(tgz_path)
+    try:
+        with open(index_path, 'r', encoding='utf-8') as f:
+            member_index = json.load(f)
+        if (member_index.get('format_version') == MEMBER_INDEX_FORMAT_VERSION and
+                (member_index.get('tgz_size'), member_index.get('tgz_mtime')) == signature):
+            with _member_index_lock:
+                _member_index_cache[tgz_path] = member_index
+            return member_index
+        logger.info(f"Member index {index_path} is stale, rebuilding.")
+        stale_sha256 = member_index.get('sha256')
+    except (OSError, ValueError):
+        logger.debug(f"No usable member index at {index_path}, building one.")
+        stale_sha256 = cached.get('sha256') if cached else None
+    member_index = build_package_member_index(tgz_path)
+    if stale_sha256 and stale_sha256 != member_index.get('sha256'):
+        _remove_extracted_package(os.path.dirname(tgz_path), stale_sha256)
+    return member_index
+
+def invalidate_package_member_index(tgz_path):
+    """Drops the cached and on-disk member index and the extracted store copy for a package .tgz."""
+    with _member_index_lock:
+        cached = _member_index_cache.pop(tgz_path, None)
+    index_path = construct_member_index_path(tgz_path)
+    sha256 = cached.get('sha256') if cached else None
+    if not sha256:
+        try:
+            with open(index_path, 'r', encoding='utf-8') as f:
+                sha256 = json.load(f).get('sha256')
+        except (OSError, ValueError):
+            sha256 = None
+    if sha256:
+        _remove_extracted_package(os.path.dirname(tgz_path), sha256)
+    if os.path.exists(index_path):
+        try:
+            os.remove(index_path)
+            logger.info(f"Deleted member index: {index_path}")
+        except OSError as e:
+            logger.error(f"Error deleting member index {index_path}: {e}")
+
+# --- Extracted Package Store ---
+# Each archive is unpacked once into FHIR_PACKAGES_DIR/.extracted/<sha256>/, keyed by the
+# checksum recorded in its member index; the .tgz remains the source of truth.
+_package_store_lock = threading.Lock()
+
+def _is_package_store_enabled():
+    """Returns whether readers should use the extracted package store."""
+    try:
+        return current_app.config.get('PACKAGE_STORE_ENABLED', True)
+    except RuntimeError:
+        return True
+
+def _remove_extracted_package(packages_dir, sha256):
+    """Removes a package's directory from the extracted package store."""
+    store_dir = os.path.join(packages_dir, PACKAGE_STORE_DIR_NAME, sha256)
+    if os.path.isdir(store_dir):
+        shutil.rmtree(store_dir, ignore_errors=True)
+        logger.info(f"Removed extracted package store directory: {store_dir}")
+
+def _extract_tgz_files(tgz_path, dest_dir):
+    """Extracts the regular files of a .tgz into dest_dir, skipping absolute or parent-relative member paths."""
+    with tarfile.open(tgz_path, "r:gz") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            parts = member.name.replace('\\', '/').split('/')
+            if member.name.startswith('/') or '..' in parts:
+                logger.warning(f"Skipping unsafe member path {member.name} in {os.path.basename(tgz_path)}")
+                continue
+            dest_path = os.path.join(dest_dir, *parts)
+            os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+            with tar.extractfile(member) as src, open(dest_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+
+def _extract_package_to_store(tgz_path, sha256):
+    """Unpacks a package .tgz into its content-addressed store directory and returns it."""
+    store_root = os.path.join(os.path.dirname(tgz_path), PACKAGE_STORE_DIR_NAME)
+    target_dir = os.path.join(store_root, sha256)
+    os.makedirs(store_root, exist_ok=True)
+    temp_dir = tempfile.mkdtemp(prefix=f".{sha256[:12]}-", dir=store_root)
+    try:
+        _extract_tgz_files(tgz_path, temp_dir)
+        with open(os.path.join(temp_dir, '.complete'), 'w', encoding='utf-8') as f:
+            f.write(sha256)
+        if os.path.isdir(target_dir):
+            # Left behind by an interrupted extraction (no valid .complete marker)
+            shutil.rmtree(target_dir, ignore_errors=True)
+        try:
+            os.rename(temp_dir, target_dir)
+        except OSError:
+            if not _is_extraction_complete(target_dir, sha256):
+                raise
+            logger.debug(f"Another worker extracted {os.path.basename(tgz_path)} first, using its copy.")
+        logger.info(f"Extracted {os.path.basename(tgz_path)} to package store {target_dir}")
+        return target_dir
+    finally:
+        if os.path.isdir(temp_dir):
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+def _is_extraction_complete(store_dir, sha256):
+    """
+    Checks the .complete marker of a store directory against the expected checksum, and that its
+    package/ directory is still there (it may link to a shared cache entry that was since removed).
+    """
+    try:
+        with open(os.path.join(store_dir, '.complete'), 'r', encoding='utf-8') as f:
+            return f.read().strip() == sha256 and os.path.isdir(os.path.join(store_dir, 'package'))
+    except OSError:
+        return False
+
+def _link_package_store_to_dir(tgz_path, package_dir):
+    """
+    Makes the package store entry of tgz_path a link to an already unpacked package/ directory
+    (a shared cache entry), so readers use those files in place instead of a second extraction.
+    Returns the store directory, or None if the store is disabled or links are not supported.
+    """
+    if not _is_package_store_enabled():
+        return None
+    member_index = get_package_member_index(tgz_path)
+    if not member_index or not member_index.get('sha256'):
+        return None
+    sha256 = member_index['sha256']
+    store_root = os.path.join(os.path.dirname(tgz_path), PACKAGE_STORE_DIR_NAME)
+    target_dir = os.path.join(store_root, sha256)
+    with _package_store_lock:
+        if _is_extraction_complete(target_dir, sha256):
+            return target_dir
+        try:
+            os.makedirs(store_root, exist_ok=True)
+            temp_dir = tempfile.mkdtemp(prefix=f".{sha256[:12]}-", dir=store_root)
+        except OSError as e:
+            logger.warning(f"Could not link package store entry for {os.path.basename(tgz_path)}: {e}")
+            return None
+        try:
+            os.symlink(package_dir, os.path.join(temp_dir, 'package'), target_is_directory=True)
+            with open(os.path.join(temp_dir, '.complete'), 'w', encoding='utf-8') as f:
+                f.write(sha256)
+            if os.path.isdir(target_dir):
+                shutil.rmtree(target_dir, ignore_errors=True)
+            os.rename(temp_dir, target_dir)
+            logger.info(f"Package store entry for {os.path.basename(tgz_path)} links to {package_dir}")
+            return target_dir
+        except OSError as e:
+            logger.warning(f"Could not link package store entry for {os.path.basename(tgz_path)}, it will be extracted instead: {e}")
+            return None
+        finally:
+            if os.path.isdir(temp_dir):
+                shutil.rmtree(temp_dir, ignore_errors=True)
+
+def get_extracted_package_dir(tgz_path, extract=True):
+    """
+    Returns the extracted package store directory for a .tgz, unpacking it on first use.
+    Returns None if the store is disabled or the package cannot be indexed/extracted,
+    in which case callers read the .tgz directly.
+    """
+    if not _is_package_store_enabled():
+        return None
+    member_index = get_package_member_index(tgz_path)
+    if not member_index or not member_index.get('sha256'):
+        return None
+    sha256 = member_index['sha256']
+    store_dir = os.path.join(os.path.dirname(tgz_path), PACKAGE_STORE_DIR_NAME, sha256)
+    if _is_extraction_complete(store_dir, sha256):
+        return store_dir
+    if not extract:
+        return None
+    with _package_store_lock:
+        if _is_extraction_complete(store_dir, sha256):
+            return store_dir
+        try:
+            return _extract_package_to_store(tgz_path, sha256)
+        except (tarfile.TarError, OSError, EOFError) as e:
+            logger.error(f"Could not extract {tgz_path} into package store, falling back to archive reads: {e}")
+            return None
+
+def read_extracted_file(file_path):
+    """Reads a file from the package store. Callers keep the bytes, so a plain read is the cheapest copy."""
+    with open(file_path, 'rb') as f:
+        return f.read()
+
+def read_package_file(tgz_path, member_name):
+    """
+    Returns the raw bytes of a member (e.g. 'package/package.json') of a package,
+    from the extracted store when available, otherwise from the .tgz.
+    Raises KeyError if the member does not exist.
+    """
+    extracted_dir = get_extracted_package_dir(tgz_path)
+    if extracted_dir:
+        parts = member_name.split('/')
+        if '..' in parts:
+            raise KeyError(member_name)
+        file_path = os.path.join(extracted_dir, *parts)
+        if not os.path.isfile(file_path):
+            raise KeyError(member_name)
+        return read_extracted_file(file_path)
+    with tarfile.open(tgz_path, "r:gz") as tar:
+        with tar.extractfile(tar.getmember(member_name)) as f:
+            return f.read()
+
+def iter_package_json_files(tgz_path):
+    """
+    Yields (member_name, read_bytes) for every JSON file under package/, in archive order.
+    read_bytes() returns the member's content from the extracted store or the open .tgz.
+    """
+    extracted_dir = get_extracted_package_dir(tgz_path)
+    if extracted_dir:
+        member_index = get_package_member_index(tgz_path)
+        for entry in member_index['members']:
+            file_path = os.path.join(extracted_dir, *entry['path'].split('/'))
+            yield entry['path'], (lambda p=file_path: read_extracted_file(p))
+        return
+    with tarfile.open(tgz_path, "r:gz") as tar:
+        for member in tar.getmembers():
+            if not (member.isfile() and member.name.startswith("package/") and member.name.lower().endswith(".json")):
+                continue
+            def read_member(m=member):
+                with tar.extractfile(m) as f:
+                    return f.read()
+            yield member.name, read_member
+
+def read_package_member(tgz_path, entry):
+    """Reads and parses a single indexed JSON member from a package."""
+    extracted_dir = get_extracted_package_dir(tgz_path)
+    if extracted_dir:
+        content_bytes = read_extracted_file(os.path.join(extracted_dir, *entry['path'].split('/')))
+    else:
+        with gzip.open(tgz_path, 'rb') as gz:
+            gz.seek(entry['offset'])
+            content_bytes = gz.read(entry['size'])
+    return json.loads(content_bytes.decode('utf-8-sig'))
+
+def iter_package_members(tgz_path, entries):
+    """
+    Yields (entry, data) for the given index entries. Members are read from the extracted
+    store when available, otherwise in archive order through a single gzip stream so that
+    each seek only moves forward. Unreadable members are skipped.
+    """
+    extracted_dir = get_extracted_package_dir(tgz_path)
+    if extracted_dir:
+        for entry in entries:
+            try:
+                content_bytes = read_extracted_file(os.path.join(extracted_dir, *entry['path'].split('/')))
+                data = json.loads(content_bytes.decode('utf-8-sig'))
+            except (OSError, json.JSONDecodeError, UnicodeDecodeError) as e:
+                logger.warning(f"Could not read/parse extracted member {entry['path']}, skipping: {e}")
+                continue
+            yield entry, data
+        return
+    with gzip.open(tgz_path, 'rb') as gz:
+        for entry in sorted(entries, key=lambda e: e['offset']):
+            try:
+                gz.seek(entry['offset'])
+                data = json.loads(gz.read(entry['size']).decode('utf-8-sig'))
+            except (json.JSONDecodeError, UnicodeDecodeError) as e:
+                logger.warning(f"Could not read/parse indexed member {entry['path']}, skipping: {e}")
+                continue
+            yield entry, data
+
+def _score_sd_candidate(entry, resource_identifier, profile_url):
+    """Scores how well an indexed StructureDefinition matches the requested identifier/profile."""
+    if profile_url and entry.get('url') == profile_url:
+        return 5
+    if not resource_identifier:
+        return 0
+    resource_identifier_lower = resource_identifier.lower()
+    sd_id = entry.get('id')
+    sd_name = entry.get('name')
+    sd_type = entry.get('type')
+    sd_url = entry.get('url')
+    sd_filename_lower = os.path.splitext(os.path.basename(entry['path']))[0].lower()
+    if sd_id and resource_identifier_lower == sd_id.lower():
+        return 4
+    if sd_name and resource_identifier_lower == sd_name.lower():
+        return 4
+    if sd_filename_lower == f"structuredefinition-{resource_identifier_lower}":
+        return 3
+    if sd_type and resource_identifier_lower == sd_type.lower() and not re.search(r'[-.]', resource_identifier):
+        return 2
+    if resource_identifier_lower in sd_filename_lower:
+        return 1
+    if sd_url and resource_identifier_lower in sd_url.lower():
+        return 1
+    return 0
+
 def find_and_extract_sd(tgz_path, resource_identifier, profile_url=None, include_narrative=False, raw=False):
-    """Helper to find and extract StructureDefinition json from a tgz path, prioritizing profile match."""
+    """
+    Helper to find and extract StructureDefinition json from a tgz path, prioritizing profile match.
+    Candidates are scored from the package member index, so only the selected member is read.
+    """
     sd_data = None
     found_path = None
     if not tgz_path or not os.path.exists(tgz_path):
         logger.error(f"File not found in find_and_extract_sd: {tgz_path}")
         return None, None
     try:
-        with tarfile.open(tgz_path, "r:gz") as tar:
-            logger.debug(f"Searching for SD matching '{resource_identifier}' with profile '{profile_url}' in {os.path.basename(tgz_path)}")
-            potential_matches = []
-            for member in tar:
-                if not (member.isfile() and member.name.startswith('package/') and member.name.lower().endswith('.json')):
-                    continue
-                if os.path.basename(member.name).lower() in ['package.json', '.index.json', 'validation-summary.json', 'validation-oo.json']:
-                    continue
-                fileobj = None
-                try:
-                    fileobj = tar.extractfile(member)
-                    if fileobj:
-                        content_bytes = fileobj.read()
-                        content_string = content_bytes.decode('utf-8-sig')
-                        data = json.loads(content_string)
-                        if isinstance(data, dict) and data.get('resourceType') == 'StructureDefinition':
-                            sd_id = data.get('id')
-                            sd_name = data.get('name')
-                            sd_type = data.get('type')
-                            sd_url = data.get('url')
-                            sd_filename_base = os.path.splitext(os.path.basename(member.name))[0]
-                            sd_filename_lower = sd_filename_base.lower()
-                            resource_identifier_lower = resource_identifier.lower() if resource_identifier else None
-                            match_score = 0
-                            if profile_url and sd_url == profile_url:
-                                match_score = 5
-                                sd_data = remove_narrative(data, include_narrative)
-                                found_path = member.name
-                                logger.info(f"Found definitive SD matching profile '{profile_url}' at path: {found_path}")
-                                break
-                            elif resource_identifier_lower:
-                                if sd_id and resource_identifier_lower == sd_id.lower():
-                                    match_score = 4
-                                elif sd_name and resource_identifier_lower == sd_name.lower():
-                                    match_score = 4
-                                elif sd_filename_lower == f"structuredefinition-{resource_identifier_lower}":
-                                    match_score = 3
-                                elif sd_type and resource_identifier_lower == sd_type.lower() and not re.search(r'[-.]', resource_identifier):
-                                    match_score = 2
-                                elif resource_identifier_lower in sd_filename_lower:
-                                    match_score = 1
-                                elif sd_url and resource_identifier_lower in sd_url.lower():
-                                    match_score = 1
-                            if match_score > 0:
-                                potential_matches.append((match_score, remove_narrative(data, include_narrative), member.name))
-                                if match_score >= 3:
-                                    sd_data = remove_narrative(data, include_narrative)
-                                    found_path = member.name
-                                    break
-                except json.JSONDecodeError as e:
-                    logger.debug(f"Could not parse JSON in {member.name}, skipping: {e}")
-                except UnicodeDecodeError as e:
-                    logger.warning(f"Could not decode UTF-8 in {member.name}, skipping: {e}")
-                except tarfile.TarError as e:
-                    logger.warning(f"Tar error reading member {member.name}, skipping: {e}")
-                except Exception as e:
-                    logger.warning(f"Could not read/parse potential SD {member.name}, skipping: {e}")
-                finally:
-                    if fileobj:
-                        fileobj.close()
-            if not sd_data and potential_matches:
-                potential_matches.sort(key=lambda x: x[0], reverse=True)
-                best_match = potential_matches[0]
-                sd_data = best_match[1]
-                found_path = best_match[2]
-                logger.info(f"Selected best match for '{resource_identifier}' from potential matches (Score: {best_match[0]}): {found_path}")
-            if sd_data is None:
-                logger.info(f"SD matching identifier '{resource_identifier}' or profile '{profile_url}' not found within archive {os.path.basename(tgz_path)}")
-            elif raw:
-                # Return the full, unprocessed StructureDefinition JSON
-                with tarfile.open(tgz_path, "r:gz") as tar:
-                    fileobj = tar.extractfile(found_path)
-                    content_bytes = fileobj.read()
-                    content_string = content_bytes.decode('utf-8-sig')
-                    raw_data = json.loads(content_string)
-                    return remove_narrative(raw_data, include_narrative), found_path
+        member_index = get_package_member_index(tgz_path)
+        if member_index is None:
+            return None, None
+        logger.debug(f"Searching for SD matching '{resource_identifier}' with profile '{profile_url}' in {os.path.basename(tgz_path)}")
+        best_entry = None
+        best_score = 0
+        for entry in member_index['members']:
+            if entry.get('resourceType') != 'StructureDefinition':
+                continue
+            if os.path.basename(entry['path']).lower() in PACKAGE_METADATA_FILES:
+                continue
+            match_score = _score_sd_candidate(entry, resource_identifier, profile_url)
+            if match_score >= 3:
+                best_entry, best_score = entry, match_score
+                break
+            if match_score > best_score:
+                best_entry, best_score = entry, match_score
+        if best_entry is None:
+            logger.info(f"SD matching identifier '{resource_identifier}' or profile '{profile_url}' not found within archive {os.path.basename(tgz_path)}")
+            return None, None
+        found_path = best_entry['path']
+        if best_score == 5:
+            logger.info(f"Found definitive SD matching profile '{profile_url}' at path: {found_path}")
+        else:
+            logger.info(f"Selected best match for '{resource_identifier}' (Score: {best_score}): {found_path}")
+        # raw callers get the same full StructureDefinition; narrative handling applies to both
+        sd_data = remove_narrative(read_package_member(tgz_path, best_entry), include_narrative)
     except tarfile.ReadError as e:
         logger.error(f"Tar ReadError reading {tgz_path}: {e}")
         return None, None
@@ -961,11 +2386,99 @@ def find_and_extract_sd(tgz_path, resource_identifier, profile_url=None, include
     except FileNotFoundError:
         logger.error(f"FileNotFoundError reading {tgz_path} in find_and_extract_sd.")
         raise
+    except (json.JSONDecodeError, UnicodeDecodeError, EOFError, gzip.BadGzipFile) as e:
+        logger.error(f"Could not read indexed SD {found_path} from {tgz_path}: {e}")
+        return None, None
     except Exception as e:
         logger.error(f"Unexpected error in find_and_extract_sd for {tgz_path}: {e}", exc_info=True)
         raise
     return sd_data, found_path
 
+# --- Parsed StructureDefinition Cache ---
+SD_CACHE_DEFAULT_MAX_BYTES = 128 * 1024 * 1024
+_sd_cache = None
+_sd_cache_lock = threading.Lock()
+_sd_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+_SD_NOT_FOUND = (None, None)
+_compiled_validators = LRUCache(maxsize=COMPILED_VALIDATOR_CACHE_SIZE)
+_compiled_validator_lock = threading.Lock()
+
+class _SizedLRUCache(LRUCache):
+    """LRUCache that counts evictions for the SD cache statistics."""
+    def popitem(self):
+        item = super().popitem()
+        _sd_cache_stats['evictions'] += 1
+        return item
+
+def _estimate_sd_size(value):
+    """Approximates the memory held by a cached (sd_data, path) value by its serialized size."""
+    sd_data, _ = value
+    if sd_data is None:
+        return 1
+    return len(json.dumps(sd_data, separators=(',', ':')))
+
+def _get_sd_cache():
+    """Returns the process-wide SD cache, creating it with the configured byte budget on first use."""
+    global _sd_cache
+    if _sd_cache is None:
+        try:
+            max_bytes = current_app.config.get('SD_CACHE_MAX_BYTES', SD_CACHE_DEFAULT_MAX_BYTES)
+        except RuntimeError:
+            max_bytes = SD_CACHE_DEFAULT_MAX_BYTES
+        _sd_cache = _SizedLRUCache(maxsize=max_bytes, getsizeof=_estimate_sd_size)
+        logger.info(f"Initialized StructureDefinition cache with a budget of {max_bytes} bytes")
+    return _sd_cache
+
+def get_cached_sd(tgz_path, resource_identifier, profile_url=None, include_narrative=False):
+    """
+    Cached front end to find_and_extract_sd for read-only callers such as validation.
+    Entries are keyed by package file (including its size/mtime), profile URL and identifier,
+    and are shared between callers: the returned StructureDefinition must not be mutated.
+    """
+    try:
+        signature = _get_tgz_signature(tgz_path)
+    except (OSError, TypeError):
+        return find_and_extract_sd(tgz_path, resource_identifier, profile_url, include_narrative)
+    key = (tgz_path, signature, profile_url, resource_identifier, include_narrative)
+    with _sd_cache_lock:
+        cache = _get_sd_cache()
+        cached = cache.get(key)
+        if cached is not None:
+            _sd_cache_stats['hits'] += 1
+            return cached
+        _sd_cache_stats['misses'] += 1
+    result = find_and_extract_sd(tgz_path, resource_identifier, profile_url, include_narrative)
+    value = result if result[0] is not None else _SD_NOT_FOUND
+    with _sd_cache_lock:
+        try:
+            cache[key] = value
+        except ValueError:
+            logger.debug(f"SD {result[1]} exceeds the SD cache budget, not caching it.")
+    return result
+
+def invalidate_sd_cache(tgz_path=None):
+    """Drops cached StructureDefinitions and compiled validators for one package file, or all of them if no path is given."""
+    with _sd_cache_lock:
+        cache = _get_sd_cache()
+        if tgz_path is None:
+            cache.clear()
+        else:
+            for key in [k for k in cache.keys() if k[0] == tgz_path]:
+                del cache[key]
+    with _compiled_validator_lock:
+        if tgz_path is None:
+            _compiled_validators.clear()
+        else:
+            for key in [k for k in _compiled_validators.keys() if k[0] == tgz_path]:
+                del _compiled_validators[key]
+    logger.debug(f"Invalidated SD cache for {tgz_path or 'all packages'}")
+
+def get_sd_cache_stats():
+    """Returns hit/miss/eviction counters and current usage of the SD cache."""
+    with _sd_cache_lock:
+        cache = _get_sd_cache()
+        return dict(_sd_cache_stats, entries=len(cache), current_bytes=cache.currsize, max_bytes=cache.maxsize)
+
 # --- Metadata Saving/Loading ---
 def save_package_metadata(name, version, dependency_mode, dependencies, complies_with_profiles=None, imposed_profiles=None):
     """Saves dependency mode, imported dependencies, and profile relationships as metadata."""
@@ -1455,16 +2968,21 @@ def _legacy_navigate_fhir_path(resource, path, extension_url=None):
     logger.debug(f"Path {path} resolved to: {result}")
     return result
 
-def navigate_fhir_path(resource, path, extension_url=None):
-    """Navigates a FHIR resource using FHIRPath expressions."""
-    logger.debug(f"Navigating FHIR path: {path}, extension_url={extension_url}")
-    if not resource or not path:
+@functools.lru_cache(maxsize=FHIRPATH_COMPILE_CACHE_SIZE)
+def _compile_fhir_path(path):
+    """Parses a FHIRPath expression once; returns None if it cannot be parsed."""
+    try:
+        return compile_fhirpath(path)
+    except Exception as e:
+        logger.debug(f"FHIRPath expression {path} could not be compiled: {e}")
         return None
+
+def _evaluate_compiled_path(resource, path, compiled, extension_url=None):
+    """Evaluates a pre-compiled FHIRPath expression, falling back to legacy navigation on failure."""
     try:
-        # Adjust path for extension filtering
-        if extension_url and 'extension' in path:
-            path = f"{path}[url='{extension_url}']"
-        result = evaluate(resource, path)
+        if compiled is None:
+            raise ValueError("expression could not be parsed")
+        result = compiled(resource)
         # Return first result if list, None if empty
         return result[0] if result else None
     except Exception as e:
@@ -1472,6 +2990,122 @@ def navigate_fhir_path(resource, path, extension_url=None):
         # Fallback to legacy navigation for compatibility
         return _legacy_navigate_fhir_path(resource, path, extension_url)
 
+def navigate_fhir_path(resource, path, extension_url=None):
+    """Navigates a FHIR resource using FHIRPath expressions."""
+    logger.debug(f"Navigating FHIR path: {path}, extension_url={extension_url}")
+    if not resource or not path:
+        return None
+    # Adjust path for extension filtering
+    if extension_url and 'extension' in path:
+        path = f"{path}[url='{extension_url}']"
+    return _evaluate_compiled_path(resource, path, _compile_fhir_path(path), extension_url)
+
+class CompiledProfileValidator:
+    """
+    Local validation checks for one StructureDefinition, prepared once and applied to many resources.
+    Element paths and discriminator paths are compiled up front; elements without min>0,
+    mustSupport or slicing are dropped so validate() only walks elements that can report issues.
+    """
+    def __init__(self, sd_data):
+        self.url = sd_data.get('url')
+        self.checks = []
+        for element in sd_data.get('snapshot', {}).get('element', []):
+            path = element.get('path')
+            if not path:
+                continue
+            min_val = element.get('min', 0)
+            must_support = element.get('mustSupport', False)
+            slicing = element.get('slicing')
+            slice_name = element.get('sliceName')
+            required = (path, _compile_fhir_path(path), min_val) if min_val > 0 else None
+            must_support_check = None
+            if must_support:
+                ms_path = slice_name if slice_name else path
+                must_support_check = (ms_path, _compile_fhir_path(ms_path))
+            discriminators = []
+            if slicing and not slice_name:  # Parent slicing element
+                for d in slicing.get('discriminator', []):
+                    d_type = d.get('type')
+                    d_path = d.get('path')
+                    if d_type in ('value', 'type'):
+                        discriminators.append((d_type, d_path, _compile_fhir_path(d_path) if d_path else None))
+            if required or must_support_check or discriminators:
+                self.checks.append((path, _compile_fhir_path(path), required, must_support_check, discriminators))
+        self.required_count = sum(1 for check in self.checks if check[2])
+        self.must_support_count = sum(1 for check in self.checks if check[3])
+        self.slicing_count = sum(1 for check in self.checks if check[4])
+        logger.debug(f"Compiled validator for {self.url}: {self.required_count} required, {self.must_support_count} must-support, {self.slicing_count} sliced elements")
+
+    @staticmethod
+    def _navigate(resource, path, compiled):
+        if not resource or not path:
+            return None
+        return _evaluate_compiled_path(resource, path, compiled)
+
+    def validate(self, resource, result):
+        """Applies the compiled checks to a resource, appending issues to the given result dict."""
+        profile = result['profile'] or 'unknown'
+        for path, path_expr, required, must_support_check, discriminators in self.checks:
+            # Check required elements
+            if required:
+                _, required_expr, min_val = required
+                value = self._navigate(resource, path, required_expr)
+                if value is None or (isinstance(value, list) and not any(value)):
+                    result['valid'] = False
+                    result['errors'].append(f"Required element {path} missing")
+                    result['details'].append({
+                        'issue': f"Required element {path} missing",
+                        'severity': 'error',
+                        'description': f"Element {path} has min={min_val} in profile {profile}"
+                    })
+
+            # Check must-support elements
+            if must_support_check:
+                ms_path, ms_expr = must_support_check
+                value = self._navigate(resource, ms_path, ms_expr)
+                if value is None or (isinstance(value, list) and not any(value)):
+                    result['warnings'].append(f"Must Support element {path} missing or empty")
+                    result['details'].append({
+                        'issue': f"Must Support element {path} missing or empty",
+                        'severity': 'warning',
+                        'description': f"Element {path} is marked as Must Support in profile {profile}"
+                    })
+
+            # Validate slicing
+            for d_type, d_path, d_expr in discriminators:
+                sliced_elements = self._navigate(resource, path, path_expr)
+                if not isinstance(sliced_elements, list):
+                    continue
+                if d_type == 'value':
+                    seen_values = set()
+                    for elem in sliced_elements:
+                        d_value = self._navigate(elem, d_path, d_expr)
+                        if d_value in seen_values:
+                            result['valid'] = False
+                            result['errors'].append(f"Duplicate discriminator value {d_value} for {path}.{d_path}")
+                        seen_values.add(d_value)
+                elif d_type == 'type':
+                    for elem in sliced_elements:
+                        if not self._navigate(elem, d_path, d_expr):
+                            result['valid'] = False
+                            result['errors'].append(f"Missing discriminator type {d_path} for {path}")
+        return result
+
+def get_compiled_validator(tgz_path, sd_data, sd_path):
+    """Returns the cached CompiledProfileValidator for an SD, compiling it on first use."""
+    try:
+        signature = _get_tgz_signature(tgz_path)
+    except (OSError, TypeError):
+        return CompiledProfileValidator(sd_data)
+    key = (tgz_path, signature, sd_path)
+    with _compiled_validator_lock:
+        validator = _compiled_validators.get(key)
+    if validator is None:
+        validator = CompiledProfileValidator(sd_data)
+        with _compiled_validator_lock:
+            _compiled_validators[key] = validator
+    return validator
+
 def _legacy_validate_resource_against_profile(package_name, version, resource, include_dependencies=True):
     """Validates a FHIR resource against a StructureDefinition in the specified package."""
     logger.debug(f"Validating resource {resource.get('resourceType')} against {package_name}#{version}, include_dependencies={include_dependencies}")
@@ -1518,7 +3152,7 @@ def _legacy_validate_resource_against_profile(package_name, version, resource, i
         logger.debug(f"Using profile from meta.profile: {profile_url}")
 
     # Find StructureDefinition
-    sd_data, sd_path = find_and_extract_sd(tgz_path, resource.get('resourceType'), profile_url)
+    sd_data, sd_path = get_cached_sd(tgz_path, resource.get('resourceType'), profile_url)
     if not sd_data and include_dependencies:
         logger.debug(f"SD not found in {package_name}#{version}. Checking dependencies.")
         try:
@@ -1538,7 +3172,7 @@ def _legacy_validate_resource_against_profile(package_name, version, resource, i
                         dep_tgz = os.path.join(download_dir, construct_tgz_filename(dep_name, dep_version))
                         if os.path.exists(dep_tgz):
                             logger.debug(f"Searching SD in dependency {dep_name}#{dep_version}")
-                            sd_data, sd_path = find_and_extract_sd(dep_tgz, resource.get('resourceType'), profile_url)
+                            sd_data, sd_path = get_cached_sd(dep_tgz, resource.get('resourceType'), profile_url)
                             if sd_data:
                                 logger.info(f"Found SD in dependency {dep_name}#{dep_version} at {sd_path}")
                                 break
@@ -1653,7 +3287,99 @@ def _legacy_validate_resource_against_profile(package_name, version, resource, i
     logger.debug(f"Validation result: valid={result['valid']}, errors={len(result['errors'])}, warnings={len(result['warnings'])}")
     return result
 
-def validate_resource_against_profile(package_name, version, resource, include_dependencies=True):
+def _get_hapi_validate_batch_size(batch_size=None):
+    """Resolves the $validate batch size from the argument or HAPI_VALIDATE_BATCH_SIZE."""
+    if batch_size is None:
+        try:
+            batch_size = current_app.config.get('HAPI_VALIDATE_BATCH_SIZE', HAPI_VALIDATE_DEFAULT_BATCH_SIZE)
+        except RuntimeError:
+            batch_size = HAPI_VALIDATE_DEFAULT_BATCH_SIZE
+    try:
+        return max(1, int(batch_size))
+    except (TypeError, ValueError):
+        logger.warning(f"Invalid HAPI validate batch size {batch_size!r}, validating one resource per request.")
+        return 1
+
+def _declared_profile(resource):
+    """Returns the first meta.profile of resource, or None when it declares none (or meta is malformed)."""
+    meta = resource.get('meta') if isinstance(resource, dict) else None
+    profiles = (meta.get('profile') if isinstance(meta, dict) else None) or [None]
+    return profiles[0] if isinstance(profiles, list) else None
+
+def _batch_validate_or_fallback(resources, batch_size=None):
+    """batch_validate_with_hapi, degrading to per-resource $validate calls (all None) if batching itself fails."""
+    try:
+        return batch_validate_with_hapi(resources, batch_size)
+    except Exception as e:
+        logger.error(f"HAPI batch validation of {len(resources)} resources failed, validating individually: {e}", exc_info=True)
+        return [None] * len(resources)
+
+def batch_validate_with_hapi(resources, batch_size=None):
+    """
+    Runs $validate for every resource that declares a meta.profile, packing up to batch_size
+    calls into one FHIR batch Bundle per request over the shared pooled session.
+    Returns a list aligned with resources holding, per resource, the response resource
+    (normally an OperationOutcome), the requests.RequestException that prevented validation,
+    or None if the resource has no profile or batching is disabled (batch size 1).
+    """
+    outcomes = [None] * len(resources)
+    batch_size = _get_hapi_validate_batch_size(batch_size)
+    if batch_size <= 1:
+        return outcomes
+    profiled = [i for i, resource in enumerate(resources) if _declared_profile(resource)]
+    if not profiled:
+        return outcomes
+    hapi_base = current_app.config['HAPI_FHIR_URL'].rstrip('/')
+    session = get_http_session()
+    for start in range(0, len(profiled), batch_size):
+        chunk = profiled[start:start + batch_size]
+        batch_bundle = {
+            'resourceType': 'Bundle',
+            'type': 'batch',
+            'entry': [{
+                'resource': {
+                    'resourceType': 'Parameters',
+                    'parameter': [
+                        {'name': 'resource', 'resource': resources[i]},
+                        {'name': 'profile', 'valueUri': _declared_profile(resources[i])}
+                    ]
+                },
+                'request': {'method': 'POST', 'url': f"{resources[i]['resourceType']}/$validate"}
+            } for i in chunk]
+        }
+        try:
+            response = session.post(
+                hapi_base,
+                json=batch_bundle,
+                headers={'Content-Type': 'application/fhir+json', 'Accept': 'application/fhir+json'},
+                timeout=HAPI_VALIDATE_BATCH_TIMEOUT
+            )
+            response.raise_for_status()
+            response_entries = response.json().get('entry', [])
+            if len(response_entries) != len(chunk):
+                raise requests.RequestException(f"Batch response has {len(response_entries)} entries for {len(chunk)} requests")
+        except (requests.RequestException, ValueError) as e:
+            logger.error(f"HAPI batch validation of {len(chunk)} resources failed: {e}")
+            error = e if isinstance(e, requests.RequestException) else requests.RequestException(f"Invalid batch response: {e}")
+            for i in chunk:
+                outcomes[i] = error
+            continue
+        for i, response_entry in zip(chunk, response_entries):
+            entry_response = response_entry.get('response', {})
+            status = str(entry_response.get('status', ''))
+            if status and not status.startswith('2'):
+                outcomes[i] = requests.HTTPError(f"{status} for {resources[i]['resourceType']}/$validate in batch")
+            else:
+                outcomes[i] = response_entry.get('resource') or entry_response.get('outcome') or {}
+        logger.debug(f"HAPI batch validation returned {len(chunk)} results")
+    return outcomes
+
+def validate_resource_against_profile(package_name, version, resource, include_dependencies=True, hapi_outcome=None):
+    """
+    Validates a resource against its meta.profile via HAPI $validate, falling back to local validation.
+    hapi_outcome may carry a result already obtained from batch_validate_with_hapi, in which case
+    no request is sent for this resource.
+    """
     result = {
         'valid': True,
         'errors': [],
@@ -1661,21 +3387,26 @@ def validate_resource_against_profile(package_name, version, resource, include_d
         'details': [],
         'resource_type': resource.get('resourceType'),
         'resource_id': resource.get('id', 'unknown'),
-        'profile': resource.get('meta', {}).get('profile', [None])[0]
+        'profile': _declared_profile(resource)
     }
 
     # Attempt HAPI validation if a profile is specified
     if result['profile']:
         try:
-            hapi_url = f"{current_app.config['HAPI_FHIR_URL'].rstrip('/')}/{resource['resourceType']}/$validate?profile={result['profile']}"
-            response = requests.post(
-                hapi_url,
-                json=resource,
-                headers={'Content-Type': 'application/fhir+json', 'Accept': 'application/fhir+json'},
-                timeout=10
-            )
-            response.raise_for_status()
-            outcome = response.json()
+            if isinstance(hapi_outcome, requests.RequestException):
+                raise hapi_outcome
+            if hapi_outcome is not None:
+                outcome = hapi_outcome
+            else:
+                hapi_url = f"{current_app.config['HAPI_FHIR_URL'].rstrip('/')}/{resource['resourceType']}/$validate?profile={result['profile']}"
+                response = get_http_session().post(
+                    hapi_url,
+                    json=resource,
+                    headers={'Content-Type': 'application/fhir+json', 'Accept': 'application/fhir+json'},
+                    timeout=10
+                )
+                response.raise_for_status()
+                outcome = response.json()
             if outcome.get('resourceType') == 'OperationOutcome':
                 for issue in outcome.get('issue', []):
                     severity = issue.get('severity')
@@ -1720,7 +3451,7 @@ def validate_resource_against_profile(package_name, version, resource, include_d
         return result
 
     tgz_path = os.path.join(download_dir, construct_tgz_filename(package_name, version))
-    sd_data, sd_path = find_and_extract_sd(tgz_path, resource.get('resourceType'), result['profile'])
+    sd_data, sd_path = get_cached_sd(tgz_path, resource.get('resourceType'), result['profile'])
     if not sd_data:
         result['valid'] = False
         result['errors'].append(f"No StructureDefinition found for {resource.get('resourceType')}")
@@ -1731,60 +3462,7 @@ def validate_resource_against_profile(package_name, version, resource, include_d
         })
         return result
 
-    elements = sd_data.get('snapshot', {}).get('element', [])
-    for element in elements:
-        path = element.get('path')
-        min_val = element.get('min', 0)
-        must_support = element.get('mustSupport', False)
-        slicing = element.get('slicing')
-        slice_name = element.get('sliceName')
-
-        # Check required elements
-        if min_val > 0:
-            value = navigate_fhir_path(resource, path)
-            if value is None or (isinstance(value, list) and not any(value)):
-                result['valid'] = False
-                result['errors'].append(f"Required element {path} missing")
-                result['details'].append({
-                    'issue': f"Required element {path} missing",
-                    'severity': 'error',
-                    'description': f"Element {path} has min={min_val} in profile {result['profile'] or 'unknown'}"
-                })
-
-        # Check must-support elements
-        if must_support:
-            value = navigate_fhir_path(resource, slice_name if slice_name else path)
-            if value is None or (isinstance(value, list) and not any(value)):
-                result['warnings'].append(f"Must Support element {path} missing or empty")
-                result['details'].append({
-                    'issue': f"Must Support element {path} missing or empty",
-                    'severity': 'warning',
-                    'description': f"Element {path} is marked as Must Support in profile {result['profile'] or 'unknown'}"
-                })
-
-        # Validate slicing
-        if slicing and not slice_name:  # Parent slicing element
-            discriminator = slicing.get('discriminator', [])
-            for d in discriminator:
-                d_type = d.get('type')
-                d_path = d.get('path')
-                if d_type == 'value':
-                    sliced_elements = navigate_fhir_path(resource, path)
-                    if isinstance(sliced_elements, list):
-                        seen_values = set()
-                        for elem in sliced_elements:
-                            d_value = navigate_fhir_path(elem, d_path)
-                            if d_value in seen_values:
-                                result['valid'] = False
-                                result['errors'].append(f"Duplicate discriminator value {d_value} for {path}.{d_path}")
-                            seen_values.add(d_value)
-                elif d_type == 'type':
-                    sliced_elements = navigate_fhir_path(resource, path)
-                    if isinstance(sliced_elements, list):
-                        for elem in sliced_elements:
-                            if not navigate_fhir_path(elem, d_path):
-                                result['valid'] = False
-                                result['errors'].append(f"Missing discriminator type {d_path} for {path}")
+    get_compiled_validator(tgz_path, sd_data, sd_path).validate(resource, result)
 
     result['summary'] = {
         'error_count': len(result['errors']),
@@ -1792,8 +3470,46 @@ def validate_resource_against_profile(package_name, version, resource, include_d
     }
     return result
 
-def validate_bundle_against_profile(package_name, version, bundle, include_dependencies=True):
-    """Validates a FHIR Bundle against profiles in the specified package."""
+def _get_validation_max_workers(max_workers=None):
+    """Resolves the per-request validation concurrency cap from the argument or VALIDATION_MAX_WORKERS."""
+    if max_workers is None:
+        try:
+            max_workers = current_app.config.get('VALIDATION_MAX_WORKERS', VALIDATION_DEFAULT_MAX_WORKERS)
+        except RuntimeError:
+            max_workers = VALIDATION_DEFAULT_MAX_WORKERS
+    try:
+        return max(1, int(max_workers))
+    except (TypeError, ValueError):
+        logger.warning(f"Invalid validation worker count {max_workers!r}, validating serially.")
+        return 1
+
+def _validate_resources_concurrently(package_name, version, resources, include_dependencies=True, max_workers=None):
+    """
+    Validates resources with a bounded thread pool and returns the results in input order.
+    HAPI $validate calls are batched up front; each worker then runs inside the caller's app
+    context. With one worker (or one resource) the resources are validated on the calling thread.
+    """
+    hapi_outcomes = _batch_validate_or_fallback(resources)
+    workers = min(_get_validation_max_workers(max_workers), len(resources))
+    if workers <= 1:
+        return [validate_resource_against_profile(package_name, version, resource, include_dependencies, hapi_outcome)
+                for resource, hapi_outcome in zip(resources, hapi_outcomes)]
+    app = current_app._get_current_object()
+
+    def validate_one(resource, hapi_outcome):
+        with app.app_context():
+            return validate_resource_against_profile(package_name, version, resource, include_dependencies, hapi_outcome)
+
+    logger.debug(f"Validating {len(resources)} resources against {package_name}#{version} with {workers} workers")
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='validate') as executor:
+        return list(executor.map(validate_one, resources, hapi_outcomes))
+
+def validate_bundle_against_profile(package_name, version, bundle, include_dependencies=True, max_workers=None):
+    """
+    Validates a FHIR Bundle against profiles in the specified package.
+    Entries are validated concurrently by up to max_workers threads (VALIDATION_MAX_WORKERS by default)
+    and merged in entry order, so the result matches a serial run.
+    """
     logger.debug(f"Validating bundle against {package_name}#{version}, include_dependencies={include_dependencies}")
     result = {
         'valid': True,
@@ -1822,10 +3538,10 @@ def validate_bundle_against_profile(package_name, version, bundle, include_depen
     references = set()
     resolved_references = set()
 
-    for entry in bundle.get('entry', []):
-        resource = entry.get('resource')
-        if not resource:
-            continue
+    resources = [entry.get('resource') for entry in bundle.get('entry', []) if entry.get('resource')]
+    validation_results = _validate_resources_concurrently(package_name, version, resources, include_dependencies, max_workers)
+
+    for resource, validation_result in zip(resources, validation_results):
         resource_type = resource.get('resourceType')
         resource_id = resource.get('id', 'unknown')
         result['summary']['resource_count'] += 1
@@ -1839,8 +3555,6 @@ def validate_bundle_against_profile(package_name, version, bundle, include_depen
                     if isinstance(item, dict) and 'reference' in item:
                         references.add(item['reference'])
 
-        # Validate resource
-        validation_result = validate_resource_against_profile(package_name, version, resource, include_dependencies)
         result['results'][f"{resource_type}/{resource_id}"] = validation_result
         result['summary']['profiles_validated'].add(validation_result['profile'] or 'unknown')
 
@@ -1945,7 +3659,7 @@ def get_structure_definition(package_name, version, resource_type):
 
 # --- Other Service Functions ---
 def _build_package_index(download_dir):
-    """Builds an index of canonical URLs to package details from .index.json files."""
+    """Builds an index of canonical URLs to package details from the package member indexes."""
     index = {}
     try:
         for tgz_file in os.listdir(download_dir):
@@ -1953,24 +3667,21 @@ def _build_package_index(download_dir):
                 continue
             tgz_path = os.path.join(download_dir, tgz_file)
             try:
-                with tarfile.open(tgz_path, "r:gz") as tar:
-                    index_file = next((m for m in tar.getmembers() if m.name == 'package/.index.json'), None)
-                    if index_file:
-                        fileobj = tar.extractfile(index_file)
-                        if fileobj:
-                            content = json.loads(fileobj.read().decode('utf-8-sig'))
-                            package_name = content.get('package-id', '')
-                            package_version = content.get('version', '')
-                            for file_entry in content.get('files', []):
-                                canonical = file_entry.get('canonical')
-                                filename = file_entry.get('filename')
-                                if canonical and filename:
-                                    index[canonical] = {
-                                        'package_name': package_name,
-                                        'package_version': package_version,
-                                        'filename': filename
-                                    }
-                            fileobj.close()
+                member_index = get_package_member_index(tgz_path)
+                if not member_index:
+                    continue
+                package_name = member_index.get('package_name') or ''
+                package_version = member_index.get('package_version') or ''
+                for entry in member_index['members']:
+                    canonical = entry.get('url')
+                    filename = entry['path'][len('package/'):]
+                    # Mirror .index.json, which only lists resources in the package root
+                    if canonical and '/' not in filename and filename.lower() not in PACKAGE_METADATA_FILES:
+                        index[canonical] = {
+                            'package_name': package_name,
+                            'package_version': package_version,
+                            'filename': filename
+                        }
             except Exception as e:
                 logger.warning(f"Failed to index {tgz_file}: {e}")
     except Exception as e:
@@ -1991,15 +3702,12 @@ def _load_definition(details, download_dir):
         return None
     tgz_path = os.path.join(download_dir, construct_tgz_filename(details['package_name'], details['package_version']))
     try:
-        with tarfile.open(tgz_path, "r:gz") as tar:
+        member_index = get_package_member_index(tgz_path)
+        if member_index:
             member_path = f"package/{details['filename']}"
-            member = next((m for m in tar.getmembers() if m.name == member_path), None)
-            if member:
-                fileobj = tar.extractfile(member)
-                if fileobj:
-                    data = json.loads(fileobj.read().decode('utf-8-sig'))
-                    fileobj.close()
-                    return data
+            entry = next((e for e in member_index['members'] if e['path'] == member_path), None)
+            if entry:
+                return read_package_member(tgz_path, entry)
     except Exception as e:
         logger.error(f"Failed to load definition {details['filename']} from {tgz_path}: {e}")
     return None
@@ -2029,6 +3737,140 @@ def _load_definition(details, download_dir):
 #         logger.error(f"File write error for {save_path}: {e}")
 #         return None, f"File write error: {e}"
 
+def _index_downloaded_package(tgz_path):
+    """
+    Indexes a freshly downloaded package and unpacks it into the package store.
+    An index that is already current (e.g. built while linking a shared cache entry) is reused.
+    Failures only defer this work to the first lookup.
+    """
+    invalidate_sd_cache(tgz_path)
+    try:
+        get_package_member_index(tgz_path)
+        get_extracted_package_dir(tgz_path)
+    except Exception as e:
+        logger.warning(f"Could not index/extract {tgz_path}, it will be prepared on first lookup: {e}")
+
+# --- Shared Package Cache (~/.fhir/packages layout) ---
+def _get_shared_package_cache_dir():
+    """
+    Returns the shared package cache directory (FHIR_SHARED_PACKAGE_CACHE), or None if it is not configured.
+    The cache uses the <name>#<version>/package layout of the HL7 validator, SUSHI and GoFSH.
+    """
+    try:
+        cache_dir = current_app.config.get('FHIR_SHARED_PACKAGE_CACHE')
+    except RuntimeError:
+        return None
+    if not cache_dir:
+        return None
+    cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+    except OSError as e:
+        logger.warning(f"Shared package cache {cache_dir} is not usable: {e}")
+        return None
+    return cache_dir
+
+def _shared_cache_work_dir(cache_dir):
+    """
+    Returns the directory holding this app's lock files and temporary entries inside the shared cache,
+    keeping them out of the cache root that other tools scan for <name>#<version> entries.
+    """
+    work_dir = os.path.join(cache_dir, SHARED_CACHE_WORK_DIR_NAME)
+    os.makedirs(work_dir, exist_ok=True)
+    return work_dir
+
+@contextmanager
+def _shared_cache_entry_lock(cache_dir, name, version):
+    """Holds an exclusive file lock on one shared cache entry so concurrent instances do not race on it."""
+    lock_path = os.path.join(_shared_cache_work_dir(cache_dir), f"{name}#{version}.lock")
+    with open(lock_path, 'a') as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+def _shared_cache_package_json(cache_dir, name, version):
+    return os.path.join(cache_dir, f"{name}#{version}", 'package', 'package.json')
+
+def restore_package_from_shared_cache(name, version, download_path):
+    """
+    Rebuilds download_path from the shared cache entry for name#version, if one exists.
+    The .tgz is only written (with fast compression) because the package list and indexes are
+    built from archives; the package store links to the shared entry, so its files are read in
+    place rather than extracted again. Returns True if the package was restored without contacting a registry.
+    """
+    cache_dir = _get_shared_package_cache_dir()
+    if not cache_dir or not os.path.isfile(_shared_cache_package_json(cache_dir, name, version)):
+        return False
+    package_dir = os.path.join(cache_dir, f"{name}#{version}", 'package')
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(download_path), prefix=f".{os.path.basename(download_path)}.", suffix='.part')
+    try:
+        with _shared_cache_entry_lock(cache_dir, name, version):
+            with os.fdopen(fd, 'wb') as f, tarfile.open(fileobj=f, mode='w:gz', compresslevel=1) as tar:
+                tar.add(package_dir, arcname='package')
+        os.replace(temp_path, download_path)
+        _link_package_store_to_dir(download_path, package_dir)
+        logger.info(f"Restored {name}#{version} from shared package cache {cache_dir}")
+        return True
+    except (OSError, tarfile.TarError) as e:
+        logger.warning(f"Could not restore {name}#{version} from shared package cache: {e}")
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        return False
+
+def publish_package_to_shared_cache(name, version, tgz_path):
+    """Unpacks a downloaded .tgz into the shared cache as <name>#<version>/package, unless it is already there."""
+    cache_dir = _get_shared_package_cache_dir()
+    if not cache_dir or os.path.isfile(_shared_cache_package_json(cache_dir, name, version)):
+        return
+    target_dir = os.path.join(cache_dir, f"{name}#{version}")
+    try:
+        with _shared_cache_entry_lock(cache_dir, name, version):
+            if os.path.isfile(_shared_cache_package_json(cache_dir, name, version)):
+                return
+            temp_dir = tempfile.mkdtemp(prefix=f"{name}#{version}-", dir=_shared_cache_work_dir(cache_dir))
+            try:
+                _extract_tgz_files(tgz_path, temp_dir)
+                if not os.path.isfile(os.path.join(temp_dir, 'package', 'package.json')):
+                    logger.warning(f"{os.path.basename(tgz_path)} has no package/package.json, not adding it to the shared cache.")
+                    return
+                if os.path.isdir(target_dir):
+                    # Incomplete entry without package.json
+                    shutil.rmtree(target_dir, ignore_errors=True)
+                os.rename(temp_dir, target_dir)
+            finally:
+                if os.path.isdir(temp_dir):
+                    shutil.rmtree(temp_dir, ignore_errors=True)
+        logger.info(f"Added {name}#{version} to shared package cache {cache_dir}")
+    except (OSError, tarfile.TarError, EOFError) as e:
+        logger.warning(f"Could not add {name}#{version} to shared package cache: {e}")
+
+def _stream_download_to_file(url, download_path):
+    """
+    Streams url into download_path in chunks. The body is written to a temporary file in the same
+    directory and renamed into place only once complete, so an interrupted download never leaves a
+    partial .tgz that later looks already downloaded. HTTP errors propagate to the caller.
+    """
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(download_path), prefix=f".{os.path.basename(download_path)}.", suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            with get_http_session().get(url, timeout=30, stream=True) as response:
+                response.raise_for_status()
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+        os.replace(temp_path, download_path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
 def download_package(name, version, dependency_mode='none'):
     """Downloads a FHIR package by name and version to the configured directory."""
     download_dir = _get_download_dir()
@@ -2045,17 +3887,22 @@ def download_package(name, version, dependency_mode='none'):
         logger.info(f"Package {name}#{version} already downloaded at {download_path}")
         return download_path, []
 
+    # Check the shared package cache before going to a registry
+    if restore_package_from_shared_cache(name, version, download_path):
+        save_package_metadata(name, version, dependency_mode, [])
+        _index_downloaded_package(download_path)
+        return download_path, []
+
     # Primary download URL
     primary_url = f"{FHIR_REGISTRY_BASE_URL}/{name}/{version}"
     logger.info(f"Attempting download of {name}#{version} from {primary_url}")
 
     try:
-        response = requests.get(primary_url, timeout=30)
-        response.raise_for_status()
-        with open(download_path, 'wb') as f:
-            f.write(response.content)
+        _stream_download_to_file(primary_url, download_path)
         logger.info(f"Successfully downloaded {name}#{version} to {download_path}")
         save_package_metadata(name, version, dependency_mode, [])
+        _index_downloaded_package(download_path)
+        publish_package_to_shared_cache(name, version, download_path)
         return download_path, []
     except requests.exceptions.HTTPError as e:
         if e.response.status_code == 404:
@@ -2103,12 +3950,11 @@ def download_package(name, version, dependency_mode='none'):
             fallback_url = f"{package_url.rstrip('/')}/{version}.tgz"
             logger.info(f"Attempting fallback download of {name}#{version} from {fallback_url}")
 
-            response = requests.get(fallback_url, timeout=30)
-            response.raise_for_status()
-            with open(download_path, 'wb') as f:
-                f.write(response.content)
+            _stream_download_to_file(fallback_url, download_path)
             logger.info(f"Successfully downloaded {name}#{version} using fallback URL to {download_path}")
             save_package_metadata(name, version, dependency_mode, [])
+            _index_downloaded_package(download_path)
+            publish_package_to_shared_cache(name, version, download_path)
             return download_path, []
         except requests.exceptions.HTTPError as e:
             error_msg = f"Fallback download error for {name}#{version} at {fallback_url}: {str(e)}"
@@ -2135,14 +3981,11 @@ def extract_dependencies(tgz_path):
     error_message = None
     if not tgz_path or not os.path.exists(tgz_path): return None, "File not found"
     try:
-        with tarfile.open(tgz_path, "r:gz") as tar:
-            try:
-                pkg_member = tar.getmember(package_json_path)
-                with tar.extractfile(pkg_member) as f:
-                    pkg_data = json.load(f)
-                    dependencies = pkg_data.get('dependencies', {})
-            except KeyError: error_message = "package.json not found"
-            except (json.JSONDecodeError, tarfile.TarError) as e: error_message = f"Error reading package.json: {e}"
+        try:
+            pkg_data = json.loads(read_package_file(tgz_path, package_json_path).decode('utf-8-sig'))
+            dependencies = pkg_data.get('dependencies', {})
+        except KeyError: error_message = "package.json not found"
+        except (json.JSONDecodeError, UnicodeDecodeError) as e: error_message = f"Error reading package.json: {e}"
     except tarfile.TarError as e: error_message = f"Error opening tarfile: {e}"
     except Exception as e: error_message = f"Unexpected error: {e}"
     return dependencies, error_message
@@ -2278,6 +4121,33 @@ def map_types_to_packages(used_types, all_dependencies, download_dir):
     logger.debug(f"Final type-to-package mapping: {type_to_package}")
     return type_to_package
 
+def _get_download_max_workers():
+    """Returns the number of packages downloaded concurrently per dependency level (PACKAGE_DOWNLOAD_MAX_WORKERS)."""
+    try:
+        max_workers = current_app.config.get('PACKAGE_DOWNLOAD_MAX_WORKERS', PACKAGE_DOWNLOAD_DEFAULT_MAX_WORKERS)
+    except RuntimeError:
+        max_workers = PACKAGE_DOWNLOAD_DEFAULT_MAX_WORKERS
+    try:
+        return max(1, int(max_workers))
+    except (TypeError, ValueError):
+        logger.warning(f"Invalid package download worker count {max_workers!r}, downloading serially.")
+        return 1
+
+def _download_packages_concurrently(packages):
+    """Downloads (name, version) pairs with a bounded thread pool, returning download_package results in input order."""
+    workers = min(_get_download_max_workers(), len(packages))
+    if workers <= 1:
+        return [download_package(name, version) for name, version in packages]
+    app = current_app._get_current_object()
+
+    def download_one(package):
+        with app.app_context():
+            return download_package(*package)
+
+    logger.info(f"Downloading {len(packages)} packages with {workers} workers")
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='download') as executor:
+        return list(executor.map(download_one, packages))
+
 def import_package_and_dependencies(initial_name, initial_version, dependency_mode='recursive'):
     """Orchestrates recursive download and dependency extraction."""
     logger.info(f"Starting import of {initial_name}#{initial_version} with mode {dependency_mode}")
@@ -2306,70 +4176,75 @@ def import_package_and_dependencies(initial_name, initial_version, dependency_mo
     all_found_dependencies = set()
 
     while pending_queue:
-        name, version = pending_queue.pop(0)
-        package_id_tuple = (name, version)
-        if package_id_tuple in results['processed']:
-            logger.debug(f"Skipping already processed package: {name}#{version}")
-            continue
-        logger.info(f"Processing package {name}#{version}")
-        save_path, dl_error = download_package(name, version)
-        if dl_error:
-            logger.error(f"Download failed for {name}#{version}: {dl_error}")
-            results['errors'].append(f"Download failed for {name}#{version}: {dl_error}")
-            continue
-        tgz_filename = os.path.basename(save_path)
-        logger.info(f"Downloaded {tgz_filename}")
-        results['downloaded'][package_id_tuple] = save_path
-        logger.info(f"Extracting dependencies from {tgz_filename}")
-        dependencies, dep_error = extract_dependencies(save_path)
-        if dep_error:
-            logger.error(f"Dependency extraction failed for {name}#{version}: {dep_error}")
-            results['errors'].append(f"Dependency extraction failed for {name}#{version}: {dep_error}")
-            results['processed'].add(package_id_tuple)
-            continue
-        elif dependencies is None:
-            logger.error(f"Critical error in dependency extraction for {name}#{version}")
-            results['errors'].append(f"Dependency extraction returned critical error for {name}#{version}.")
+        # Download one breadth-first level concurrently, then process it in queue order
+        level = []
+        for package_id_tuple in pending_queue:
+            if package_id_tuple in results['processed']:
+                logger.debug(f"Skipping already processed package: {package_id_tuple[0]}#{package_id_tuple[1]}")
+            else:
+                level.append(package_id_tuple)
+        pending_queue = []
+        downloads = _download_packages_concurrently(level)
+        for (name, version), (save_path, dl_error) in zip(level, downloads):
+            package_id_tuple = (name, version)
+            logger.info(f"Processing package {name}#{version}")
+            if dl_error:
+                logger.error(f"Download failed for {name}#{version}: {dl_error}")
+                results['errors'].append(f"Download failed for {name}#{version}: {dl_error}")
+                continue
+            tgz_filename = os.path.basename(save_path)
+            logger.info(f"Downloaded {tgz_filename}")
+            results['downloaded'][package_id_tuple] = save_path
+            logger.info(f"Extracting dependencies from {tgz_filename}")
+            dependencies, dep_error = extract_dependencies(save_path)
+            if dep_error:
+                logger.error(f"Dependency extraction failed for {name}#{version}: {dep_error}")
+                results['errors'].append(f"Dependency extraction failed for {name}#{version}: {dep_error}")
+                results['processed'].add(package_id_tuple)
+                continue
+            elif dependencies is None:
+                logger.error(f"Critical error in dependency extraction for {name}#{version}")
+                results['errors'].append(f"Dependency extraction returned critical error for {name}#{version}.")
+                results['processed'].add(package_id_tuple)
+                continue
+            results['all_dependencies'][package_id_tuple] = dependencies
             results['processed'].add(package_id_tuple)
-            continue
-        results['all_dependencies'][package_id_tuple] = dependencies
-        results['processed'].add(package_id_tuple)
-        current_package_deps = []
-        for dep_name, dep_version in dependencies.items():
-            if isinstance(dep_name, str) and isinstance(dep_version, str) and dep_name and dep_version:
-                dep_tuple = (dep_name, dep_version)
-                current_package_deps.append({"name": dep_name, "version": dep_version})
-                if dep_tuple not in all_found_dependencies:
-                    all_found_dependencies.add(dep_tuple)
-                    results['dependencies'].append({"name": dep_name, "version": dep_version})
-                if dep_tuple not in queued_or_processed_lookup:
-                    should_queue = False
-                    if dependency_mode == 'recursive':
-                        should_queue = True
-                        logger.info(f"Queueing dependency {dep_name}#{dep_version} (recursive mode)")
-                    elif dependency_mode == 'patch-canonical' and dep_tuple == CANONICAL_PACKAGE:
-                        should_queue = True
-                        logger.info(f"Queueing canonical dependency {dep_name}#{dep_version} (patch-canonical mode)")
-                    if should_queue:
-                        logger.debug(f"Adding dependency to queue ({dependency_mode}): {dep_name}#{dep_version}")
-                        pending_queue.append(dep_tuple)
-                        queued_or_processed_lookup.add(dep_tuple)
-        logger.info(f"Saving metadata for {name}#{version}")
-        save_package_metadata(name, version, dependency_mode, current_package_deps)
-        if dependency_mode == 'tree-shaking' and package_id_tuple == (initial_name, initial_version):
-            logger.info(f"Performing tree-shaking for {initial_name}#{initial_version}")
-            used_types = extract_used_types(save_path)
-            if used_types:
-                type_to_package = map_types_to_packages(used_types, results['all_dependencies'], download_dir)
-                tree_shaken_deps = set(type_to_package.values()) - {package_id_tuple}
-                if CANONICAL_PACKAGE not in tree_shaken_deps:
-                    tree_shaken_deps.add(CANONICAL_PACKAGE)
-                    logger.info(f"Ensuring canonical package {CANONICAL_PACKAGE[0]}#{CANONICAL_PACKAGE[1]} for tree-shaking")
-                for dep_tuple in tree_shaken_deps:
+            current_package_deps = []
+            for dep_name, dep_version in dependencies.items():
+                if isinstance(dep_name, str) and isinstance(dep_version, str) and dep_name and dep_version:
+                    dep_tuple = (dep_name, dep_version)
+                    current_package_deps.append({"name": dep_name, "version": dep_version})
+                    if dep_tuple not in all_found_dependencies:
+                        all_found_dependencies.add(dep_tuple)
+                        results['dependencies'].append({"name": dep_name, "version": dep_version})
                     if dep_tuple not in queued_or_processed_lookup:
-                        logger.info(f"Queueing tree-shaken dependency {dep_tuple[0]}#{dep_tuple[1]}")
-                        pending_queue.append(dep_tuple)
-                        queued_or_processed_lookup.add(dep_tuple)
+                        should_queue = False
+                        if dependency_mode == 'recursive':
+                            should_queue = True
+                            logger.info(f"Queueing dependency {dep_name}#{dep_version} (recursive mode)")
+                        elif dependency_mode == 'patch-canonical' and dep_tuple == CANONICAL_PACKAGE:
+                            should_queue = True
+                            logger.info(f"Queueing canonical dependency {dep_name}#{dep_version} (patch-canonical mode)")
+                        if should_queue:
+                            logger.debug(f"Adding dependency to queue ({dependency_mode}): {dep_name}#{dep_version}")
+                            pending_queue.append(dep_tuple)
+                            queued_or_processed_lookup.add(dep_tuple)
+            logger.info(f"Saving metadata for {name}#{version}")
+            save_package_metadata(name, version, dependency_mode, current_package_deps)
+            if dependency_mode == 'tree-shaking' and package_id_tuple == (initial_name, initial_version):
+                logger.info(f"Performing tree-shaking for {initial_name}#{initial_version}")
+                used_types = extract_used_types(save_path)
+                if used_types:
+                    type_to_package = map_types_to_packages(used_types, results['all_dependencies'], download_dir)
+                    tree_shaken_deps = set(type_to_package.values()) - {package_id_tuple}
+                    if CANONICAL_PACKAGE not in tree_shaken_deps:
+                        tree_shaken_deps.add(CANONICAL_PACKAGE)
+                        logger.info(f"Ensuring canonical package {CANONICAL_PACKAGE[0]}#{CANONICAL_PACKAGE[1]} for tree-shaking")
+                    for dep_tuple in tree_shaken_deps:
+                        if dep_tuple not in queued_or_processed_lookup:
+                            logger.info(f"Queueing tree-shaken dependency {dep_tuple[0]}#{dep_tuple[1]}")
+                            pending_queue.append(dep_tuple)
+                            queued_or_processed_lookup.add(dep_tuple)
     results['dependencies'] = [{"name": d[0], "version": d[1]} for d in all_found_dependencies]
     logger.info(f"Completed import of {initial_name}#{initial_version}. Processed {len(results['processed'])} packages, downloaded {len(results['downloaded'])}, with {len(results['errors'])} errors")
     return results
@@ -2763,47 +4638,33 @@ def find_and_extract_search_params(tgz_path, base_resource_type):
         return search_params
     logger.debug(f"Searching for SearchParameters based on '{base_resource_type}' in {os.path.basename(tgz_path)}")
     try:
-        with tarfile.open(tgz_path, "r:gz") as tar:
-            for member in tar:
-                if not (member.isfile() and member.name.startswith('package/') and member.name.lower().endswith('.json')):
-                    continue
-                if os.path.basename(member.name).lower() in ['package.json', '.index.json', 'validation-summary.json', 'validation-oo.json']:
-                    continue
-                fileobj = None
-                try:
-                    fileobj = tar.extractfile(member)
-                    if fileobj:
-                        content_bytes = fileobj.read()
-                        content_string = content_bytes.decode('utf-8-sig')
-                        data = json.loads(content_string)
-                        if isinstance(data, dict) and data.get('resourceType') == 'SearchParameter':
-                            sp_bases = data.get('base', [])
-                            if base_resource_type in sp_bases:
-                                param_info = {
-                                    'id': data.get('id'),
-                                    'url': data.get('url'),
-                                    'name': data.get('name'),
-                                    'description': data.get('description'),
-                                    'code': data.get('code'),
-                                    'type': data.get('type'),
-                                    'expression': data.get('expression'),
-                                    'base': sp_bases,
-                                    'conformance': 'N/A',
-                                    'is_mandatory': False
-                                }
-                                search_params.append(param_info)
-                                logger.debug(f"Found relevant SearchParameter: {param_info.get('name')} (ID: {param_info.get('id')}) for base {base_resource_type}")
-                except json.JSONDecodeError as e:
-                    logger.debug(f"Could not parse JSON for SearchParameter in {member.name}, skipping: {e}")
-                except UnicodeDecodeError as e:
-                    logger.warning(f"Could not decode UTF-8 for SearchParameter in {member.name}, skipping: {e}")
-                except tarfile.TarError as e:
-                    logger.warning(f"Tar error reading member {member.name} for SearchParameter, skipping: {e}")
-                except Exception as e:
-                    logger.warning(f"Could not read/parse potential SearchParameter {member.name}, skipping: {e}", exc_info=False)
-                finally:
-                    if fileobj:
-                        fileobj.close()
+        member_index = get_package_member_index(tgz_path)
+        if not member_index:
+            return search_params
+        candidates = [
+            e for e in member_index['members']
+            if e.get('resourceType') == 'SearchParameter'
+            and base_resource_type in e.get('base', [])
+            and os.path.basename(e['path']).lower() not in PACKAGE_METADATA_FILES
+        ]
+        for entry, data in iter_package_members(tgz_path, candidates):
+            if not isinstance(data, dict):
+                continue
+            sp_bases = data.get('base', [])
+            param_info = {
+                'id': data.get('id'),
+                'url': data.get('url'),
+                'name': data.get('name'),
+                'description': data.get('description'),
+                'code': data.get('code'),
+                'type': data.get('type'),
+                'expression': data.get('expression'),
+                'base': sp_bases,
+                'conformance': 'N/A',
+                'is_mandatory': False
+            }
+            search_params.append(param_info)
+            logger.debug(f"Found relevant SearchParameter: {param_info.get('name')} (ID: {param_info.get('id')}) for base {base_resource_type}")
     except tarfile.ReadError as e:
         logger.error(f"Tar ReadError extracting SearchParameters from {tgz_path}: {e}")
     except tarfile.TarError as e:
@@ -2818,13 +4679,266 @@ def find_and_extract_search_params(tgz_path, base_resource_type):
 
 # --- Full Replacement Function (Corrected Prefix Definitions & Unabbreviated) ---
 
+def _get_push_max_workers():
+    """Returns the number of resources uploaded concurrently within a push wave (PUSH_MAX_WORKERS)."""
+    try:
+        max_workers = current_app.config.get('PUSH_MAX_WORKERS', PUSH_DEFAULT_MAX_WORKERS)
+    except RuntimeError:
+        max_workers = PUSH_DEFAULT_MAX_WORKERS
+    try:
+        return max(1, int(max_workers))
+    except (TypeError, ValueError):
+        logger.warning(f"Invalid push worker count {max_workers!r}, uploading serially.")
+        return 1
+
+def plan_push_waves(resources):
+    """
+    Groups generate_push_stream resource_info dicts into upload waves following PUSH_WAVE_ORDER, keeping
+    package order within a wave. A canonical url|version already in a wave is moved to a follow-up wave,
+    so two uploads never race through the same search-then-POST.
+    """
+    by_wave = defaultdict(list)
+    for resource_info in resources:
+        resource_type = resource_info["data"].get("resourceType")
+        by_wave[_PUSH_WAVE_INDEX.get(resource_type, len(PUSH_WAVE_ORDER))].append(resource_info)
+    waves = []
+    for wave_index in sorted(by_wave):
+        remaining = by_wave[wave_index]
+        while remaining:
+            wave, deferred, canonicals = [], [], set()
+            for resource_info in remaining:
+                data = resource_info["data"]
+                canonical = None
+                if data.get("resourceType") in CANONICAL_RESOURCE_TYPES and data.get("url"):
+                    canonical = (data.get("resourceType"), data.get("url"), data.get("version"))
+                if canonical in canonicals:
+                    deferred.append(resource_info)
+                    continue
+                if canonical:
+                    canonicals.add(canonical)
+                wave.append(resource_info)
+            waves.append(wave)
+            remaining = deferred
+    return waves
+
+def _tally_pushed_package(pushed_packages_info, source_pkg, increment):
+    """Adds increment to the resource_count of source_pkg in the push summary, creating its entry if needed."""
+    for p in pushed_packages_info:
+        if p["id"] == source_pkg:
+            p["resource_count"] += increment
+            return
+    pushed_packages_info.append({"id": source_pkg, "resource_count": increment})
+
+def _push_resource(session, base_url, headers, resource_info, position, total, verbose, force_upload):
+    """
+    Uploads one resource for generate_push_stream: canonical resources are searched by url|version,
+    content identical to the server's copy is skipped (unless force_upload), then it is PUT or POSTed.
+    Runs on push worker threads, so progress lines are collected rather than yielded. Returns a dict of
+    "messages" (NDJSON lines), "method" (the POST/PUT sent, if any), "status" ("success", "failure" or
+    "skipped") and "detail" (the failed/skipped summary entry).
+    """
+    local_resource = resource_info["data"]
+    resource_type = local_resource.get("resourceType")
+    resource_id = local_resource.get("id")
+    resource_log_id = f"{resource_type}/{resource_id}"
+    canonical_url = local_resource.get("url")
+    canonical_version = local_resource.get("version")
+    is_canonical_type = resource_type in CANONICAL_RESOURCE_TYPES
+    messages = []
+    result = {"messages": messages, "method": None, "status": None, "detail": None}
+
+    existing_resource_id = None
+    existing_resource_data = None
+    action = "PUT"
+    target_url = f"{base_url}/{resource_type}/{resource_id}"
+    skip_resource = False
+
+    if is_canonical_type and canonical_url:
+        action = "SEARCH_POST_PUT"
+        search_params = {"url": canonical_url}
+        if canonical_version:
+            search_params["version"] = canonical_version
+        search_url = f"{base_url}/{resource_type}"
+        if verbose:
+            messages.append(json.dumps({"type": "info", "message": f"Canonical Type: Searching {search_url} with params {search_params}"}) + "\n")
+
+        try:
+            search_response = session.get(search_url, params=search_params, headers=headers, timeout=20)
+            search_response.raise_for_status()
+            search_bundle = search_response.json()
+
+            if search_bundle.get("resourceType") == "Bundle" and "entry" in search_bundle:
+                entries = search_bundle.get("entry", [])
+                if len(entries) == 1:
+                    existing_resource_data = entries[0].get("resource")
+                    if existing_resource_data:
+                        existing_resource_id = existing_resource_data.get("id")
+                        if existing_resource_id:
+                            action = "PUT"
+                            target_url = f"{base_url}/{resource_type}/{existing_resource_id}"
+                            if verbose:
+                                messages.append(json.dumps({"type": "info", "message": f"Found existing canonical resource ID: {existing_resource_id}"}) + "\n")
+                        else:
+                            messages.append(json.dumps({"type": "warning", "message": f"Found canonical {canonical_url}|{canonical_version} but lacks ID. Skipping update."}) + "\n")
+                            action = "SKIP"
+                            skip_resource = True
+                            result["status"], result["detail"] = "skipped", {"resource": resource_log_id, "reason": "Found canonical match without ID"}
+                    else:
+                        messages.append(json.dumps({"type": "warning", "message": f"Search for {canonical_url}|{canonical_version} entry lacks resource data. Assuming not found."}) + "\n")
+                        action = "POST"
+                        target_url = f"{base_url}/{resource_type}"
+                elif len(entries) == 0:
+                    action = "POST"
+                    target_url = f"{base_url}/{resource_type}"
+                    if verbose:
+                        messages.append(json.dumps({"type": "info", "message": f"Canonical not found by URL/Version. Planning POST."}) + "\n")
+                else:
+                    ids_found = [e.get("resource", {}).get("id", "unknown") for e in entries]
+                    messages.append(json.dumps({"type": "error", "message": f"Conflict: Found {len(entries)} matches for {canonical_url}|{canonical_version} (IDs: {', '.join(ids_found)}). Skipping."}) + "\n")
+                    action = "SKIP"
+                    skip_resource = True
+                    result["status"], result["detail"] = "failure", {"resource": resource_log_id, "error": f"Conflict: Multiple matches ({len(entries)}) for canonical URL/Version"}
+            else:
+                messages.append(json.dumps({"type": "warning", "message": f"Search for {canonical_url}|{canonical_version} returned non-Bundle/empty. Assuming not found."}) + "\n")
+                action = "POST"
+                target_url = f"{base_url}/{resource_type}"
+
+        except requests.exceptions.RequestException as search_err:
+            messages.append(json.dumps({"type": "warning", "message": f"Search failed for {resource_log_id}: {search_err}. Defaulting to PUT by ID."}) + "\n")
+            action = "PUT"
+            target_url = f"{base_url}/{resource_type}/{resource_id}"
+        except json.JSONDecodeError as json_err:
+            messages.append(json.dumps({"type": "warning", "message": f"Failed parse search result for {resource_log_id}: {json_err}. Defaulting PUT by ID."}) + "\n")
+            action = "PUT"
+            target_url = f"{base_url}/{resource_type}/{resource_id}"
+        except Exception as e:
+            messages.append(json.dumps({"type": "warning", "message": f"Unexpected canonical search error for {resource_log_id}: {e}. Defaulting PUT by ID."}) + "\n")
+            action = "PUT"
+            target_url = f"{base_url}/{resource_type}/{resource_id}"
+
+    if action == "PUT" and not force_upload and not skip_resource:
+        resource_to_compare = existing_resource_data
+        if not resource_to_compare:
+            try:
+                if verbose:
+                    messages.append(json.dumps({"type": "info", "message": f"Checking existing (PUT target): {target_url}"}) + "\n")
+                get_response = session.get(target_url, headers=headers, timeout=15)
+                if get_response.status_code == 200:
+                    resource_to_compare = get_response.json()
+                    if verbose:
+                        messages.append(json.dumps({"type": "info", "message": f"Found resource by ID for comparison."}) + "\n")
+                elif get_response.status_code == 404:
+                    if verbose:
+                        messages.append(json.dumps({"type": "info", "message": f"Resource {resource_log_id} not found by ID ({target_url}). Proceeding with PUT create."}) + "\n")
+                else:
+                    messages.append(json.dumps({"type": "warning", "message": f"Comparison check failed (GET {get_response.status_code}). Attempting PUT."}) + "\n")
+            except Exception as get_err:
+                messages.append(json.dumps({"type": "warning", "message": f"Comparison check failed (Error during GET by ID: {get_err}). Attempting PUT."}) + "\n")
+
+        if resource_to_compare:
+            try:
+                if are_resources_semantically_equal(local_resource, resource_to_compare):
+                    messages.append(json.dumps({"type": "info", "message": f"Skipping {resource_log_id} (Identical content)"}) + "\n")
+                    skip_resource = True
+                    result["status"], result["detail"] = "skipped", {"resource": resource_log_id, "reason": "Identical content"}
+                elif verbose:
+                    messages.append(json.dumps({"type": "info", "message": f"{resource_log_id} exists but differs. Updating."}) + "\n")
+            except Exception as comp_err:
+                messages.append(json.dumps({"type": "warning", "message": f"Comparison failed for {resource_log_id}: {comp_err}. Proceeding with PUT."}) + "\n")
+
+    elif action == "PUT" and force_upload:
+        if verbose:
+            messages.append(json.dumps({"type": "info", "message": f"Force Upload enabled, skipping comparison for {resource_log_id}."}) + "\n")
+
+    if not skip_resource:
+        http_method = action if action in ["POST", "PUT"] else "PUT"
+        log_action = f"{http_method}ing"
+        messages.append(json.dumps({"type": "progress", "message": f"{log_action} {resource_log_id} ({position}/{total}) to {target_url}..."}) + "\n")
+
+        try:
+            if http_method == "POST":
+                response = session.post(target_url, json=local_resource, headers=headers, timeout=30)
+                result["method"] = "POST"
+            else:
+                response = session.put(target_url, json=local_resource, headers=headers, timeout=30)
+                result["method"] = "PUT"
+
+            response.raise_for_status()
+
+            success_msg = f"{http_method} successful for {resource_log_id} (Status: {response.status_code})"
+            if http_method == "POST" and response.status_code == 201:
+                location = response.headers.get("Location")
+                if location:
+                    match = re.search(f"{resource_type}/([^/]+)/_history", location)
+                    new_id = match.group(1) if match else "unknown"
+                    success_msg += f" -> New ID: {new_id}"
+                else:
+                    success_msg += " (No Location header)"
+            messages.append(json.dumps({"type": "success", "message": success_msg}) + "\n")
+            result["status"] = "success"
+
+        except requests.exceptions.HTTPError as http_err:
+            outcome_text = ""
+            status_code = http_err.response.status_code if http_err.response is not None else "N/A"
+            try:
+                outcome = http_err.response.json()
+                if outcome and outcome.get("resourceType") == "OperationOutcome":
+                    issues = outcome.get("issue", [])
+                    outcome_text = "; ".join([f"{i.get('severity', 'info')}: {i.get('diagnostics', i.get('details', {}).get('text', 'No details'))}" for i in issues]) if issues else "OperationOutcome with no issues."
+                else:
+                    outcome_text = http_err.response.text[:200] if http_err.response is not None else "No response body"
+            except ValueError:
+                outcome_text = http_err.response.text[:200] if http_err.response is not None else "No response body (or not JSON)"
+            error_msg = f"Failed {http_method} {resource_log_id} (Status: {status_code}): {outcome_text or str(http_err)}"
+            messages.append(json.dumps({"type": "error", "message": error_msg}) + "\n")
+            result["status"], result["detail"] = "failure", {"resource": resource_log_id, "error": error_msg}
+        except requests.exceptions.Timeout:
+            error_msg = f"Timeout during {http_method} {resource_log_id}"
+            messages.append(json.dumps({"type": "error", "message": error_msg}) + "\n")
+            result["status"], result["detail"] = "failure", {"resource": resource_log_id, "error": "Timeout"}
+        except requests.exceptions.ConnectionError as conn_err:
+            error_msg = f"Connection error during {http_method} {resource_log_id}: {conn_err}"
+            messages.append(json.dumps({"type": "error", "message": error_msg}) + "\n")
+            result["status"], result["detail"] = "failure", {"resource": resource_log_id, "error": f"Connection Error: {conn_err}"}
+        except requests.exceptions.RequestException as req_err:
+            error_msg = f"Request error during {http_method} {resource_log_id}: {str(req_err)}"
+            messages.append(json.dumps({"type": "error", "message": error_msg}) + "\n")
+            result["status"], result["detail"] = "failure", {"resource": resource_log_id, "error": f"Request Error: {req_err}"}
+        except Exception as e:
+            error_msg = f"Unexpected error during {http_method} {resource_log_id}: {str(e)}"
+            messages.append(json.dumps({"type": "error", "message": error_msg}) + "\n")
+            result["status"], result["detail"] = "failure", {"resource": resource_log_id, "error": f"Unexpected: {e}"}
+            logger.error(f"[API Push Stream] Upload error for {resource_log_id}: {e}", exc_info=True)
+    return result
+
+def _iter_push_results(jobs, max_workers):
+    """Runs _push_resource(*job) for each job on up to max_workers threads, yielding results in job order."""
+    workers = max(1, min(max_workers, len(jobs)))
+    if workers <= 1:
+        for job in jobs:
+            yield _push_resource(*job)
+        return
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='push') as executor:
+        # Keep a bounded window of uploads in flight and consume them in submission order
+        pending = deque()
+        remaining = iter(jobs)
+        for job in itertools.islice(remaining, workers * 2):
+            pending.append(executor.submit(_push_resource, *job))
+        while pending:
+            future = pending.popleft()
+            for job in itertools.islice(remaining, 1):
+                pending.append(executor.submit(_push_resource, *job))
+            yield future.result()
+
 def generate_push_stream(package_name, version, fhir_server_url, include_dependencies,
                          auth_type, auth_token, resource_types_filter, skip_files,
-                         dry_run, verbose, force_upload, packages_dir):
+                         dry_run, verbose, force_upload, packages_dir, max_workers=None):
     """
     Generates NDJSON stream for the push IG operation.
     Handles canonical resources (search by URL, POST/PUT),
     skips identical resources (unless force_upload is true), and specified files.
+    Resources are uploaded in dependency waves (see plan_push_waves), up to max_workers at a time
+    (default PUSH_MAX_WORKERS); progress is still streamed in upload order.
     """
     # --- Variable Initializations ---
     pushed_packages_info = []
@@ -2893,52 +5007,48 @@ def generate_push_stream(package_name, version, fhir_server_url, include_depende
         for pkg_name, pkg_version, pkg_path in packages_to_push:
             yield json.dumps({"type": "progress", "message": f"Extracting resources from: {pkg_name}#{pkg_version}..."}) + "\n"
             try:
-                with tarfile.open(pkg_path, "r:gz") as tar:
-                    for member in tar.getmembers():
-                        if not (member.isfile() and member.name.startswith("package/") and member.name.lower().endswith(".json")):
-                            continue
-                        basename_lower = os.path.basename(member.name).lower()
-                        if basename_lower in ["package.json", ".index.json", "validation-summary.json", "validation-oo.json"]:
-                            continue
+                for member_name, read_member in iter_package_json_files(pkg_path):
+                    basename_lower = os.path.basename(member_name).lower()
+                    if basename_lower in ["package.json", ".index.json", "validation-summary.json", "validation-oo.json"]:
+                        continue
 
-                        normalized_member_name = member.name.replace("\\", "/")
-                        if normalized_member_name in skip_files_set or member.name in skip_files_set:
-                            if verbose:
-                                yield json.dumps({"type": "info", "message": f"Skipping file due to filter: {member.name}"}) + "\n"
-                            continue
+                    normalized_member_name = member_name.replace("\\", "/")
+                    if normalized_member_name in skip_files_set or member_name in skip_files_set:
+                        if verbose:
+                            yield json.dumps({"type": "info", "message": f"Skipping file due to filter: {member_name}"}) + "\n"
+                        continue
 
-                        if member.name in seen_resource_files:
-                            if verbose:
-                                yield json.dumps({"type": "info", "message": f"Skipping already seen file: {member.name}"}) + "\n"
-                            continue
-                        seen_resource_files.add(member.name)
+                    if member_name in seen_resource_files:
+                        if verbose:
+                            yield json.dumps({"type": "info", "message": f"Skipping already seen file: {member_name}"}) + "\n"
+                        continue
+                    seen_resource_files.add(member_name)
 
-                        try:
-                            with tar.extractfile(member) as f:
-                                resource_content = f.read().decode("utf-8-sig")
-                                resource_data = json.loads(resource_content)
-
-                                if isinstance(resource_data, dict) and "resourceType" in resource_data and "id" in resource_data:
-                                    resource_type_val = resource_data.get("resourceType")
-                                    if filter_set and resource_type_val not in filter_set:
-                                        if verbose:
-                                            yield json.dumps({"type": "info", "message": f"Skipping resource type {resource_type_val} due to filter: {member.name}"}) + "\n"
-                                        continue
-                                    resources_to_upload.append({
-                                        "data": resource_data,
-                                        "source_package": f"{pkg_name}#{pkg_version}",
-                                        "source_filename": member.name
-                                    })
-                                else:
-                                    yield json.dumps({"type": "warning", "message": f"Skipping invalid/incomplete resource structure in file: {member.name}"}) + "\n"
-                        except json.JSONDecodeError as json_e:
-                            yield json.dumps({"type": "warning", "message": f"JSON parse error in file {member.name}: {json_e}"}) + "\n"
-                        except UnicodeDecodeError as uni_e:
-                            yield json.dumps({"type": "warning", "message": f"Encoding error in file {member.name}: {uni_e}"}) + "\n"
-                        except KeyError:
-                            yield json.dumps({"type": "warning", "message": f"File not found within archive: {member.name}"}) + "\n"
-                        except Exception as extract_e:
-                            yield json.dumps({"type": "warning", "message": f"Error processing file {member.name}: {extract_e}"}) + "\n"
+                    try:
+                        resource_content = read_member().decode("utf-8-sig")
+                        resource_data = json.loads(resource_content)
+
+                        if isinstance(resource_data, dict) and "resourceType" in resource_data and "id" in resource_data:
+                            resource_type_val = resource_data.get("resourceType")
+                            if filter_set and resource_type_val not in filter_set:
+                                if verbose:
+                                    yield json.dumps({"type": "info", "message": f"Skipping resource type {resource_type_val} due to filter: {member_name}"}) + "\n"
+                                continue
+                            resources_to_upload.append({
+                                "data": resource_data,
+                                "source_package": f"{pkg_name}#{pkg_version}",
+                                "source_filename": member_name
+                            })
+                        else:
+                            yield json.dumps({"type": "warning", "message": f"Skipping invalid/incomplete resource structure in file: {member_name}"}) + "\n"
+                    except json.JSONDecodeError as json_e:
+                        yield json.dumps({"type": "warning", "message": f"JSON parse error in file {member_name}: {json_e}"}) + "\n"
+                    except UnicodeDecodeError as uni_e:
+                        yield json.dumps({"type": "warning", "message": f"Encoding error in file {member_name}: {uni_e}"}) + "\n"
+                    except KeyError:
+                        yield json.dumps({"type": "warning", "message": f"File not found within archive: {member_name}"}) + "\n"
+                    except Exception as extract_e:
+                        yield json.dumps({"type": "warning", "message": f"Error processing file {member_name}: {extract_e}"}) + "\n"
             except tarfile.ReadError as tar_read_e:
                 error_msg = f"Tar ReadError reading package {pkg_name}#{pkg_version}: {tar_read_e}. Skipping package."
                 yield json.dumps({"type": "error", "message": error_msg}) + "\n"
@@ -2966,7 +5076,7 @@ def generate_push_stream(package_name, version, fhir_server_url, include_depende
             yield json.dumps({"type": "warning", "message": "No resources found to upload after filtering."}) + "\n"
         else:
             # --- Resource Upload Loop Setup ---
-            session = requests.Session()
+            session = get_http_session()
             base_url = fhir_server_url.rstrip("/")
             headers = {"Content-Type": "application/fhir+json", "Accept": "application/fhir+json"}
             # MODIFIED: Enhanced authentication handling
@@ -2989,225 +5099,58 @@ def generate_push_stream(package_name, version, fhir_server_url, include_depende
             else:
                 yield json.dumps({"type": "info", "message": "Using no authentication."}) + "\n"
 
-            # --- Main Upload Loop ---
-            for i, resource_info in enumerate(resources_to_upload, 1):
-                local_resource = resource_info["data"]
-                source_pkg = resource_info["source_package"]
-                resource_type = local_resource.get("resourceType")
-                resource_id = local_resource.get("id")
-                resource_log_id = f"{resource_type}/{resource_id}"
-                canonical_url = local_resource.get("url")
-                canonical_version = local_resource.get("version")
-                is_canonical_type = resource_type in CANONICAL_RESOURCE_TYPES
-
+            # --- Upload Waves ---
+            # Duplicate IDs are dropped up front so concurrent uploads never target the same resource
+            unique_resources = []
+            for resource_info in resources_to_upload:
+                resource_log_id = f"{resource_info['data'].get('resourceType')}/{resource_info['data'].get('id')}"
                 if resource_log_id in processed_resources:
                     if verbose:
                         yield json.dumps({"type": "info", "message": f"Skipping duplicate ID in processing list: {resource_log_id}"}) + "\n"
                     continue
                 processed_resources.add(resource_log_id)
-
-                if dry_run:
-                    dry_run_action = "check/PUT"
-                    if is_canonical_type and canonical_url:
-                        dry_run_action = "search/POST/PUT"
-                    yield json.dumps({"type": "progress", "message": f"[DRY RUN] Would {dry_run_action} {resource_log_id} ({i}/{total_resources_attempted}) from {source_pkg}"}) + "\n"
-                    success_count += 1
-                    pkg_found = False
-                    for p in pushed_packages_info:
-                        if p["id"] == source_pkg:
-                            p["resource_count"] += 1
-                            pkg_found = True
-                            break
-                    if not pkg_found:
-                        pushed_packages_info.append({"id": source_pkg, "resource_count": 1})
-                    continue
-
-                existing_resource_id = None
-                existing_resource_data = None
-                action = "PUT"
-                target_url = f"{base_url}/{resource_type}/{resource_id}"
-                skip_resource = False
-
-                if is_canonical_type and canonical_url:
-                    action = "SEARCH_POST_PUT"
-                    search_params = {"url": canonical_url}
-                    if canonical_version:
-                        search_params["version"] = canonical_version
-                    search_url = f"{base_url}/{resource_type}"
-                    if verbose:
-                        yield json.dumps({"type": "info", "message": f"Canonical Type: Searching {search_url} with params {search_params}"}) + "\n"
-
-                    try:
-                        search_response = session.get(search_url, params=search_params, headers=headers, timeout=20)
-                        search_response.raise_for_status()
-                        search_bundle = search_response.json()
-
-                        if search_bundle.get("resourceType") == "Bundle" and "entry" in search_bundle:
-                            entries = search_bundle.get("entry", [])
-                            if len(entries) == 1:
-                                existing_resource_data = entries[0].get("resource")
-                                if existing_resource_data:
-                                    existing_resource_id = existing_resource_data.get("id")
-                                    if existing_resource_id:
-                                        action = "PUT"
-                                        target_url = f"{base_url}/{resource_type}/{existing_resource_id}"
-                                        if verbose:
-                                            yield json.dumps({"type": "info", "message": f"Found existing canonical resource ID: {existing_resource_id}"}) + "\n"
-                                    else:
-                                        yield json.dumps({"type": "warning", "message": f"Found canonical {canonical_url}|{canonical_version} but lacks ID. Skipping update."}) + "\n"
-                                        action = "SKIP"
-                                        skip_resource = True
-                                        skipped_count += 1
-                                        skipped_resources_details.append({"resource": resource_log_id, "reason": "Found canonical match without ID"})
-                                else:
-                                    yield json.dumps({"type": "warning", "message": f"Search for {canonical_url}|{canonical_version} entry lacks resource data. Assuming not found."}) + "\n"
-                                    action = "POST"
-                                    target_url = f"{base_url}/{resource_type}"
-                            elif len(entries) == 0:
-                                action = "POST"
-                                target_url = f"{base_url}/{resource_type}"
-                                if verbose:
-                                    yield json.dumps({"type": "info", "message": f"Canonical not found by URL/Version. Planning POST."}) + "\n"
-                            else:
-                                ids_found = [e.get("resource", {}).get("id", "unknown") for e in entries]
-                                yield json.dumps({"type": "error", "message": f"Conflict: Found {len(entries)} matches for {canonical_url}|{canonical_version} (IDs: {', '.join(ids_found)}). Skipping."}) + "\n"
-                                action = "SKIP"
-                                skip_resource = True
-                                failure_count += 1
-                                failed_uploads_details.append({"resource": resource_log_id, "error": f"Conflict: Multiple matches ({len(entries)}) for canonical URL/Version"})
-                        else:
-                            yield json.dumps({"type": "warning", "message": f"Search for {canonical_url}|{canonical_version} returned non-Bundle/empty. Assuming not found."}) + "\n"
-                            action = "POST"
-                            target_url = f"{base_url}/{resource_type}"
-
-                    except requests.exceptions.RequestException as search_err:
-                        yield json.dumps({"type": "warning", "message": f"Search failed for {resource_log_id}: {search_err}. Defaulting to PUT by ID."}) + "\n"
-                        action = "PUT"
-                        target_url = f"{base_url}/{resource_type}/{resource_id}"
-                    except json.JSONDecodeError as json_err:
-                        yield json.dumps({"type": "warning", "message": f"Failed parse search result for {resource_log_id}: {json_err}. Defaulting PUT by ID."}) + "\n"
-                        action = "PUT"
-                        target_url = f"{base_url}/{resource_type}/{resource_id}"
-                    except Exception as e:
-                        yield json.dumps({"type": "warning", "message": f"Unexpected canonical search error for {resource_log_id}: {e}. Defaulting PUT by ID."}) + "\n"
-                        action = "PUT"
-                        target_url = f"{base_url}/{resource_type}/{resource_id}"
-
-                if action == "PUT" and not force_upload and not skip_resource:
-                    resource_to_compare = existing_resource_data
-                    if not resource_to_compare:
-                        try:
-                            if verbose:
-                                yield json.dumps({"type": "info", "message": f"Checking existing (PUT target): {target_url}"}) + "\n"
-                            get_response = session.get(target_url, headers=headers, timeout=15)
-                            if get_response.status_code == 200:
-                                resource_to_compare = get_response.json()
-                                if verbose:
-                                    yield json.dumps({"type": "info", "message": f"Found resource by ID for comparison."}) + "\n"
-                            elif get_response.status_code == 404:
-                                if verbose:
-                                    yield json.dumps({"type": "info", "message": f"Resource {resource_log_id} not found by ID ({target_url}). Proceeding with PUT create."}) + "\n"
-                            else:
-                                yield json.dumps({"type": "warning", "message": f"Comparison check failed (GET {get_response.status_code}). Attempting PUT."}) + "\n"
-                        except Exception as get_err:
-                            yield json.dumps({"type": "warning", "message": f"Comparison check failed (Error during GET by ID: {get_err}). Attempting PUT."}) + "\n"
-
-                    if resource_to_compare:
-                        try:
-                            if are_resources_semantically_equal(local_resource, resource_to_compare):
-                                yield json.dumps({"type": "info", "message": f"Skipping {resource_log_id} (Identical content)"}) + "\n"
-                                skip_resource = True
-                                skipped_count += 1
-                                skipped_resources_details.append({"resource": resource_log_id, "reason": "Identical content"})
-                            elif verbose:
-                                yield json.dumps({"type": "info", "message": f"{resource_log_id} exists but differs. Updating."}) + "\n"
-                        except Exception as comp_err:
-                            yield json.dumps({"type": "warning", "message": f"Comparison failed for {resource_log_id}: {comp_err}. Proceeding with PUT."}) + "\n"
-
-                elif action == "PUT" and force_upload:
-                    if verbose:
-                        yield json.dumps({"type": "info", "message": f"Force Upload enabled, skipping comparison for {resource_log_id}."}) + "\n"
-
-                if not skip_resource:
-                    http_method = action if action in ["POST", "PUT"] else "PUT"
-                    log_action = f"{http_method}ing"
-                    yield json.dumps({"type": "progress", "message": f"{log_action} {resource_log_id} ({i}/{total_resources_attempted}) to {target_url}..."}) + "\n"
-
-                    try:
-                        if http_method == "POST":
-                            response = session.post(target_url, json=local_resource, headers=headers, timeout=30)
-                            post_count += 1
-                        else:
-                            response = session.put(target_url, json=local_resource, headers=headers, timeout=30)
-                            put_count += 1
-
-                        response.raise_for_status()
-
-                        success_msg = f"{http_method} successful for {resource_log_id} (Status: {response.status_code})"
-                        if http_method == "POST" and response.status_code == 201:
-                            location = response.headers.get("Location")
-                            if location:
-                                match = re.search(f"{resource_type}/([^/]+)/_history", location)
-                                new_id = match.group(1) if match else "unknown"
-                                success_msg += f" -> New ID: {new_id}"
-                            else:
-                                success_msg += " (No Location header)"
-                        yield json.dumps({"type": "success", "message": success_msg}) + "\n"
+                unique_resources.append(resource_info)
+            waves = plan_push_waves(unique_resources)
+            if max_workers is None:
+                max_workers = _get_push_max_workers()
+            yield json.dumps({"type": "info", "message": f"Uploading in {len(waves)} dependency waves with up to {max_workers} concurrent requests."}) + "\n"
+
+            position = 0
+            for wave_number, wave in enumerate(waves, 1):
+                wave_types = sorted({resource_info["data"].get("resourceType") for resource_info in wave})
+                yield json.dumps({"type": "progress", "message": f"Wave {wave_number}/{len(waves)}: {len(wave)} resources ({', '.join(wave_types)})"}) + "\n"
+                jobs = []
+                for resource_info in wave:
+                    position += 1
+                    if dry_run:
+                        local_resource = resource_info["data"]
+                        dry_run_action = "check/PUT"
+                        if local_resource.get("resourceType") in CANONICAL_RESOURCE_TYPES and local_resource.get("url"):
+                            dry_run_action = "search/POST/PUT"
+                        yield json.dumps({"type": "progress", "message": f"[DRY RUN] Would {dry_run_action} {local_resource.get('resourceType')}/{local_resource.get('id')} ({position}/{total_resources_attempted}) from {resource_info['source_package']}"}) + "\n"
                         success_count += 1
-                        pkg_found_success = False
-                        for p in pushed_packages_info:
-                            if p["id"] == source_pkg:
-                                p["resource_count"] += 1
-                                pkg_found_success = True
-                                break
-                        if not pkg_found_success:
-                            pushed_packages_info.append({"id": source_pkg, "resource_count": 1})
-
-                    except requests.exceptions.HTTPError as http_err:
-                        outcome_text = ""
-                        status_code = http_err.response.status_code if http_err.response is not None else "N/A"
-                        try:
-                            outcome = http_err.response.json()
-                            if outcome and outcome.get("resourceType") == "OperationOutcome":
-                                issues = outcome.get("issue", [])
-                                outcome_text = "; ".join([f"{i.get('severity', 'info')}: {i.get('diagnostics', i.get('details', {}).get('text', 'No details'))}" for i in issues]) if issues else "OperationOutcome with no issues."
-                            else:
-                                outcome_text = http_err.response.text[:200] if http_err.response is not None else "No response body"
-                        except ValueError:
-                            outcome_text = http_err.response.text[:200] if http_err.response is not None else "No response body (or not JSON)"
-                        error_msg = f"Failed {http_method} {resource_log_id} (Status: {status_code}): {outcome_text or str(http_err)}"
-                        yield json.dumps({"type": "error", "message": error_msg}) + "\n"
-                        failure_count += 1
-                        failed_uploads_details.append({"resource": resource_log_id, "error": error_msg})
-                    except requests.exceptions.Timeout:
-                        error_msg = f"Timeout during {http_method} {resource_log_id}"
-                        yield json.dumps({"type": "error", "message": error_msg}) + "\n"
-                        failure_count += 1
-                        failed_uploads_details.append({"resource": resource_log_id, "error": "Timeout"})
-                    except requests.exceptions.ConnectionError as conn_err:
-                        error_msg = f"Connection error during {http_method} {resource_log_id}: {conn_err}"
-                        yield json.dumps({"type": "error", "message": error_msg}) + "\n"
-                        failure_count += 1
-                        failed_uploads_details.append({"resource": resource_log_id, "error": f"Connection Error: {conn_err}"})
-                    except requests.exceptions.RequestException as req_err:
-                        error_msg = f"Request error during {http_method} {resource_log_id}: {str(req_err)}"
-                        yield json.dumps({"type": "error", "message": error_msg}) + "\n"
-                        failure_count += 1
-                        failed_uploads_details.append({"resource": resource_log_id, "error": f"Request Error: {req_err}"})
-                    except Exception as e:
-                        error_msg = f"Unexpected error during {http_method} {resource_log_id}: {str(e)}"
-                        yield json.dumps({"type": "error", "message": error_msg}) + "\n"
+                        _tally_pushed_package(pushed_packages_info, resource_info["source_package"], 1)
+                    else:
+                        jobs.append((session, base_url, headers, resource_info, position, total_resources_attempted, verbose, force_upload))
+
+                # Results arrive in wave order whatever order the uploads finish in
+                for resource_info, result in zip([job[3] for job in jobs], _iter_push_results(jobs, max_workers)):
+                    yield from result["messages"]
+                    if result["method"] == "POST":
+                        post_count += 1
+                    elif result["method"] == "PUT":
+                        put_count += 1
+                    if result["status"] == "success":
+                        success_count += 1
+                        _tally_pushed_package(pushed_packages_info, resource_info["source_package"], 1)
+                    elif result["status"] == "failure":
                         failure_count += 1
-                        failed_uploads_details.append({"resource": resource_log_id, "error": f"Unexpected: {e}"})
-                        logger.error(f"[API Push Stream] Upload error for {resource_log_id}: {e}", exc_info=True)
-                else:
-                    pkg_found_skipped = False
-                    for p in pushed_packages_info:
-                        if p["id"] == source_pkg:
-                            pkg_found_skipped = True
-                            break
-                    if not pkg_found_skipped:
-                        pushed_packages_info.append({"id": source_pkg, "resource_count": 0})
+                        failed_uploads_details.append(result["detail"])
+                    else:
+                        skipped_count += 1
+                        skipped_resources_details.append(result["detail"])
+                    if result["method"] is None:
+                        _tally_pushed_package(pushed_packages_info, resource_info["source_package"], 0)
 
         # --- Final Summary ---
         final_status = "success" if failure_count == 0 else "partial" if success_count > 0 else "failure"
@@ -3423,7 +5366,7 @@ def process_and_upload_test_data(server_info, options, temp_file_dir):
                             if member.endswith('/') or member.startswith('__MACOSX') or member.startswith('.'): continue
                             member_filename = os.path.basename(member)
                             if not member_filename: continue
-                            if member_filename.lower().endswith(('.json', '.xml')):
+                            if member_filename.lower().endswith(('.json', '.xml') + NDJSON_SUFFIXES):
                                 target_path = os.path.join(temp_file_dir, member_filename)
                                 if not os.path.exists(target_path):
                                     with zip_ref.open(member) as source, open(target_path, "wb") as target:
@@ -3432,7 +5375,7 @@ def process_and_upload_test_data(server_info, options, temp_file_dir):
                                     extracted_count += 1
                                 else:
                                     yield json.dumps({"type": "warning", "message": f"Skipped extracting '{member_filename}' from ZIP, file exists."}) + "\n"
-                        yield json.dumps({"type": "info", "message": f"Extracted {extracted_count} JSON/XML files from {filename}."}) + "\n"
+                        yield json.dumps({"type": "info", "message": f"Extracted {extracted_count} JSON/NDJSON/XML files from {filename}."}) + "\n"
                         processed_filenames.add(filename)
                 except zipfile.BadZipFile:
                     error_msg = f"Invalid ZIP: {filename}"
@@ -3444,9 +5387,9 @@ def process_and_upload_test_data(server_info, options, temp_file_dir):
                     yield json.dumps({"type": "error", "message": error_msg}) + "\n"
                     errors.append(error_msg)
                     error_count += 1
-            elif filename.lower().endswith(('.json', '.xml')):
+            elif filename.lower().endswith(('.json', '.xml') + NDJSON_SUFFIXES):
                 files_to_parse.append(file_path)
-        yield json.dumps({"type": "info", "message": f"Found {len(files_to_parse)} JSON/XML files to parse."}) + "\n"
+        yield json.dumps({"type": "info", "message": f"Found {len(files_to_parse)} JSON/NDJSON/XML files to parse."}) + "\n"
 
         # --- 2. Parse JSON/XML Files ---
         temp_resources_parsed = []
@@ -3457,15 +5400,22 @@ def process_and_upload_test_data(server_info, options, temp_file_dir):
             processed_filenames.add(filename)
             yield json.dumps({"type": "progress", "message": f"Parsing {filename}..."}) + "\n"
             try:
-                with open(file_path, 'r', encoding='utf-8-sig') as f:
-                    content = f.read()
                 parsed_content_list = []
-                if filename.lower().endswith('.json'):
+                if filename.lower().endswith(NDJSON_SUFFIXES):
+                    # One resource per line, e.g. a Bulk Data export file; no Bundle wrapper to parse
+                    with open(file_path, 'rb') as f:
+                        for line_number, resource in iter_ndjson_resources(f, filename.lower().endswith('.gz')):
+                            if isinstance(resource, dict) and 'resourceType' in resource and 'id' in resource:
+                                parsed_content_list.append(resource)
+                            else:
+                                yield json.dumps({"type": "warning", "message": f"Skipping invalid line #{line_number} in NDJSON {filename}."}) + "\n"
+                elif filename.lower().endswith('.json'):
                     try:
-                        parsed_json = json.loads(content)
-                        if isinstance(parsed_json, dict) and parsed_json.get('resourceType') == 'Bundle':
-                            for entry_idx, entry in enumerate(parsed_json.get('entry', [])):
-                                resource = entry.get('resource')
+                        # Bundles are read entry by entry instead of as one text and one nested dict
+                        bundle_entries, parsed_json = read_json_bundle(functools.partial(open, file_path, 'rb'))
+                        if bundle_entries is not None:
+                            for entry_idx, entry in enumerate(bundle_entries):
+                                resource = entry.get('resource') if isinstance(entry, dict) else None
                                 if isinstance(resource, dict) and 'resourceType' in resource and 'id' in resource:
                                     parsed_content_list.append(resource)
                                 elif resource:
@@ -3484,6 +5434,8 @@ def process_and_upload_test_data(server_info, options, temp_file_dir):
                     except json.JSONDecodeError as e:
                         raise ValueError(f"Invalid JSON: {e}")
                 elif filename.lower().endswith('.xml'):
+                    with open(file_path, 'r', encoding='utf-8-sig') as f:
+                        content = f.read()
                     if FHIR_RESOURCES_AVAILABLE:
                         try:
                             root = ET.fromstring(content)
@@ -3546,35 +5498,39 @@ def process_and_upload_test_data(server_info, options, temp_file_dir):
             val_pkg_name, val_pkg_version = validation_package_id.split('#', 1)
             yield json.dumps({"type": "progress", "message": f"Starting validation against {val_pkg_name}#{val_pkg_version}..."}) + "\n"
             validated_resources_map = {}
-            for resource in resources_parsed_list:
-                full_id = f"{resource.get('resourceType')}/{resource.get('id')}"
-                yield json.dumps({"type": "validation_info", "message": f"Validating {full_id}..."}) + "\n"
-                try:
-                    validation_report = validate_resource_against_profile(val_pkg_name, val_pkg_version, resource, include_dependencies=False)
-                    for warning in validation_report.get('warnings', []):
-                        yield json.dumps({"type": "validation_warning", "message": f"{full_id}: {warning}"}) + "\n"
-                        validation_warnings_count += 1
-                    if not validation_report.get('valid', False):
+            batch_size = _get_hapi_validate_batch_size()
+            for chunk_start in range(0, len(resources_parsed_list), batch_size):
+                chunk = resources_parsed_list[chunk_start:chunk_start + batch_size]
+                hapi_outcomes = _batch_validate_or_fallback(chunk, batch_size)
+                for resource, hapi_outcome in zip(chunk, hapi_outcomes):
+                    full_id = f"{resource.get('resourceType')}/{resource.get('id')}"
+                    yield json.dumps({"type": "validation_info", "message": f"Validating {full_id}..."}) + "\n"
+                    try:
+                        validation_report = validate_resource_against_profile(val_pkg_name, val_pkg_version, resource, include_dependencies=False, hapi_outcome=hapi_outcome)
+                        for warning in validation_report.get('warnings', []):
+                            yield json.dumps({"type": "validation_warning", "message": f"{full_id}: {warning}"}) + "\n"
+                            validation_warnings_count += 1
+                        if not validation_report.get('valid', False):
+                            validation_failed_resources.add(full_id)
+                            validation_errors_count += 1
+                            for error in validation_report.get('errors', []):
+                                error_detail = f"Validation Error ({full_id}): {error}"
+                                yield json.dumps({"type": "validation_error", "message": error_detail}) + "\n"
+                                errors.append(error_detail)
+                            if options.get('error_handling', 'stop') == 'stop':
+                                raise ValueError(f"Validation failed for {full_id} (stop on error).")
+                        else:
+                            validated_resources_map[full_id] = resource
+                    except Exception as val_err:
+                        error_msg = f"Validation error {full_id}: {val_err}"
+                        yield json.dumps({"type": "error", "message": error_msg}) + "\n"
+                        errors.append(error_msg)
+                        error_count += 1
                         validation_failed_resources.add(full_id)
                         validation_errors_count += 1
-                        for error in validation_report.get('errors', []):
-                            error_detail = f"Validation Error ({full_id}): {error}"
-                            yield json.dumps({"type": "validation_error", "message": error_detail}) + "\n"
-                            errors.append(error_detail)
+                        logger.error(f"Validation exception {full_id}", exc_info=True)
                         if options.get('error_handling', 'stop') == 'stop':
-                            raise ValueError(f"Validation failed for {full_id} (stop on error).")
-                    else:
-                        validated_resources_map[full_id] = resource
-                except Exception as val_err:
-                    error_msg = f"Validation error {full_id}: {val_err}"
-                    yield json.dumps({"type": "error", "message": error_msg}) + "\n"
-                    errors.append(error_msg)
-                    error_count += 1
-                    validation_failed_resources.add(full_id)
-                    validation_errors_count += 1
-                    logger.error(f"Validation exception {full_id}", exc_info=True)
-                    if options.get('error_handling', 'stop') == 'stop':
-                        raise ValueError(f"Validation exception for {full_id} (stop on error).")
+                            raise ValueError(f"Validation exception for {full_id} (stop on error).")
             yield json.dumps({"type": "info", "message": f"Validation complete. Errors: {validation_errors_count}, Warnings: {validation_warnings_count}."}) + "\n"
             resource_map = validated_resources_map
             nodes = set(resource_map.keys())
@@ -3654,7 +5610,7 @@ def process_and_upload_test_data(server_info, options, temp_file_dir):
             upload_mode = options.get('upload_mode', 'individual')
             error_handling_mode = options.get('error_handling', 'stop')
             use_conditional = options.get('use_conditional_uploads', False) and upload_mode == 'individual'
-            session = requests.Session()
+            session = get_http_session()
             base_url = server_info['url'].rstrip('/')
             upload_headers = {'Content-Type': 'application/fhir+json', 'Accept': 'application/fhir+json'}
             if server_info['auth_type'] in ['bearerToken', 'basic'] and server_info.get('auth_token'):
@@ -3943,31 +5899,300 @@ def process_and_upload_test_data(server_info, options, temp_file_dir):
 # --- END Service Function ---
 
 # --- CORRECTED retrieve_bundles function with NEW logic ---
-def retrieve_bundles(fhir_server_url, resources, output_zip, validate_references=False, fetch_reference_bundles=False, auth_type='none', auth_token=None):
+def _get_retrieve_setting(key, default):
+    """Reads a positive integer bundle retrieval setting from the app config."""
+    try:
+        value = current_app.config.get(key, default)
+    except RuntimeError:
+        value = default
+    try:
+        return max(1, int(value))
+    except (TypeError, ValueError):
+        logger.warning(f"Invalid {key} value {value!r}, using {default}.")
+        return default
+
+def _bundle_next_url(bundle):
+    """Returns the Bundle.link[relation=next] URL of a search page, or None on the last page."""
+    for link in bundle.get('link') or []:
+        if isinstance(link, dict) and link.get('relation') == 'next' and link.get('url'):
+            return link['url']
+    return None
+
+def _fetch_bundle_page(url, headers, timeout):
+    """GETs one search page and returns its Bundle; raises ValueError for error statuses and non-Bundle bodies."""
+    response = get_http_session().get(url, headers=headers, timeout=timeout)
+    logger.debug(f"Response for page {url}: HTTP {response.status_code}")
+    if response.status_code != 200:
+        error_detail = f"Server returned HTTP {response.status_code}."
+        try: error_detail += f" Body: {response.text[:200]}..."
+        except: pass
+        raise ValueError(error_detail)
+    try:
+        bundle = response.json()
+    except ValueError as e:
+        raise ValueError(f"Invalid JSON response: {e}")
+    if not isinstance(bundle, dict) or bundle.get('resourceType') != 'Bundle':
+        raise ValueError(f"Expected Bundle, got {bundle.get('resourceType', 'unknown') if isinstance(bundle, dict) else type(bundle).__name__}")
+    return bundle
+
+def iter_bundle_pages(url, headers, rebase_url=None, max_pages=RETRIEVE_DEFAULT_MAX_PAGES, timeout=60):
+    """
+    Yields (page_number, bundle) for a search and its Bundle.link[relation=next] continuations, up to
+    max_pages. The next page is requested on a worker thread while the caller handles the current one.
+    rebase_url maps each next link onto the URL to request; when it returns None the page is still
+    yielded and a ValueError is raised afterwards. Fetch errors propagate from the page they occur on.
+    """
+    app = current_app._get_current_object()
+
+    def fetch(page_url):
+        with app.app_context():
+            return _fetch_bundle_page(page_url, headers, timeout)
+
+    requested = {url}
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix='page') as executor:
+        pending = executor.submit(fetch, url)
+        page_number = 0
+        while pending is not None:
+            bundle = pending.result()
+            page_number += 1
+            pending = None
+            stop_reason = None
+            next_url = _bundle_next_url(bundle)
+            if next_url and page_number < max_pages:
+                page_url = rebase_url(next_url) if rebase_url else next_url
+                if page_url is None:
+                    stop_reason = f"Next page link {next_url} does not point at the target server"
+                elif page_url in requested:
+                    logger.warning(f"Next page link {next_url} repeats an earlier page, stopping")
+                else:
+                    requested.add(page_url)
+                    pending = executor.submit(fetch, page_url)
+            yield page_number, bundle
+            if stop_reason:
+                raise ValueError(stop_reason)
+
+def iter_resolved_references(base_url, references, headers, batch_size=RETRIEVE_REFERENCE_DEFAULT_BATCH_SIZE,
+                             max_workers=RETRIEVE_REFERENCE_DEFAULT_MAX_WORKERS, timeout=60, report_pending=False):
+    """
+    Resolves 'Type/id' references with one _id=a,b,c search per batch of up to batch_size ids of a
+    type, keeping up to max_workers searches in flight. Yields (reference, entry, error) in sorted
+    reference order: entry is the matching Bundle entry (None when the server has no such resource)
+    and error the exception that failed the reference's batch, if any (normally a
+    RequestException/ValueError). With report_pending, (reference, REFERENCE_PENDING, None) is also
+    yielded for every reference of a batch before waiting for that batch's result.
+    """
+    ids_by_type = defaultdict(list)
+    for ref in sorted(references):
+        ref_type, ref_id = ref.split('/')
+        ids_by_type[ref_type].append(ref_id)
+    batches = [(ref_type, ids[i:i + batch_size]) for ref_type, ids in sorted(ids_by_type.items()) for i in range(0, len(ids), batch_size)]
+    if not batches:
+        return
+    app = current_app._get_current_object()
+
+    def search(ref_type, ids):
+        with app.app_context():
+            url = f"{base_url}/{quote(ref_type)}?_id={','.join(quote(ref_id) for ref_id in ids)}&_count={len(ids)}"
+            logger.debug(f"Resolving {len(ids)} {ref_type} references via {url}")
+            return _fetch_bundle_page(url, headers, timeout)
+
+    workers = max(1, min(max_workers, len(batches)))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='refs') as executor:
+        # Keep a bounded window of searches in flight and consume them in submission order
+        pending = deque()
+        remaining = iter(batches)
+        for ref_type, ids in itertools.islice(remaining, workers * 2):
+            pending.append((ref_type, ids, executor.submit(search, ref_type, ids)))
+        while pending:
+            ref_type, ids, future = pending.popleft()
+            for next_type, next_ids in itertools.islice(remaining, 1):
+                pending.append((next_type, next_ids, executor.submit(search, next_type, next_ids)))
+            if report_pending:
+                for ref_id in ids:
+                    yield f"{ref_type}/{ref_id}", REFERENCE_PENDING, None
+            error = None
+            found = {}
+            try:
+                bundle = future.result()
+                for entry in bundle.get('entry') or []:
+                    resource = entry.get('resource') if isinstance(entry, dict) else None
+                    if isinstance(resource, dict) and resource.get('resourceType') == ref_type:
+                        found.setdefault(resource.get('id'), entry)
+            except (requests.RequestException, ValueError) as e:
+                error = e
+            except Exception as e:
+                # Reported per reference like any other failure, so one bad batch does not end the reference phase
+                logger.error(f"Unexpected error resolving {len(ids)} {ref_type} references: {e}", exc_info=True)
+                error, found = e, {}
+            for ref_id in ids:
+                yield f"{ref_type}/{ref_id}", found.get(ref_id), error
+
+class NdjsonExportWriter:
+    """
+    Collects resources into one NDJSON file per resource type in the FHIR Bulk Data layout
+    (<ResourceType>.ndjson, or .ndjson.gz with compress) and adds them to an output ZIP.
+    Resources of one type arrive from several searches (_include, reference fetches) while a ZIP is
+    written one member at a time, so each type is spooled to a temporary file until write_to_zip().
+    Resources repeating an already written type/id are skipped; the (type, id) pairs seen are kept
+    for the writer's lifetime, so memory grows with the number of exported resources (about 100
+    bytes each).
+    """
+
+    def __init__(self, compress=False):
+        self.compress = compress
+        self.counts = {}
+        self._files = {}
+        self._seen = set()
+        self._spool_dir = tempfile.mkdtemp(prefix="fhir_ndjson_")
+
+    def member_name(self, resource_type):
+        """Returns the ZIP member name of the file holding resource_type."""
+        return f"{resource_type}.ndjson.gz" if self.compress else f"{resource_type}.ndjson"
+
+    def add(self, resource):
+        """Appends a resource to the file of its type; returns False for duplicates and non-resources."""
+        resource_type = resource.get('resourceType') if isinstance(resource, dict) else None
+        if not resource_type or not re.match(r'^[A-Za-z]+$', resource_type):
+            return False
+        if resource.get('id'):
+            key = (resource_type, resource['id'])
+            if key in self._seen:
+                return False
+            self._seen.add(key)
+        f = self._files.get(resource_type)
+        if f is None:
+            path = os.path.join(self._spool_dir, self.member_name(resource_type))
+            f = gzip.open(path, 'wb') if self.compress else open(path, 'wb')
+            self._files[resource_type] = f
+        f.write((json.dumps(resource, separators=(',', ':')) + '\n').encode('utf-8'))
+        self.counts[resource_type] = self.counts.get(resource_type, 0) + 1
+        return True
+
+    def write_to_zip(self, zipf):
+        """Adds every type file to zipf (gzip files stored as-is) and returns {resource type: count}."""
+        for resource_type in sorted(self._files):
+            self._files[resource_type].close()
+            member_name = self.member_name(resource_type)
+            zipf.write(os.path.join(self._spool_dir, member_name), member_name,
+                       compress_type=zipfile.ZIP_STORED if self.compress else zipfile.ZIP_DEFLATED)
+        return dict(self.counts)
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        shutil.rmtree(self._spool_dir, ignore_errors=True)
+
+def iter_ndjson_resources(fp, compressed=False):
+    """
+    Yields (line_number, resource) for each non-blank line of a binary NDJSON stream, gunzipping
+    it first when compressed. Lines that are not valid JSON yield None as the resource.
+    """
+    if compressed:
+        fp = gzip.GzipFile(fileobj=fp)
+    for line_number, line in enumerate(fp, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield line_number, json.loads(line)
+        except ValueError:
+            yield line_number, None
+
+def _zip_json(zipf, name, data):
+    """Writes data as compact JSON into a new member of an open output ZIP."""
+    zipf.writestr(name, json.dumps(data, separators=(',', ':')))
+
+def _save_bundle_pages(pages, label, file_stem, zipf, max_pages, ndjson_writer=None, references=None, severity='error'):
+    """
+    Saves the pages from iter_bundle_pages as they arrive, yielding NDJSON progress messages: one
+    compact Bundle member per page in the output ZIP ({file_stem}.json, {file_stem}_p2.json, ...),
+    or every entry resource added to ndjson_writer when one is given. Relative reference strings
+    (Type/id) found in the saved resources are added to the references set when one is given, page
+    by page, so it grows with the distinct references rather than with the export. Returns the
+    number of pages saved.
+    """
+    pages_saved = 0
+    resources_saved = 0
+    try:
+        for page_number, bundle in pages:
+            entries = bundle.get('entry') or []
+            if page_number == 1 and not entries:
+                yield json.dumps({"type": "warning", "message": f"No entries found in bundle for {label}"}) + "\n"
+            resources = [entry['resource'] for entry in entries if isinstance(entry, dict) and isinstance(entry.get('resource'), dict)]
+            if ndjson_writer is not None:
+                for resource in resources:
+                    ndjson_writer.add(resource)
+            else:
+                member_name = f"{file_stem}.json" if page_number == 1 else f"{file_stem}_p{page_number}.json"
+                _zip_json(zipf, member_name, bundle)
+                logger.debug(f"Wrote page {page_number} of {label} to ZIP member {member_name}")
+            pages_saved = page_number
+            resources_saved += len(resources)
+            if references is not None:
+                page_references = []
+                for resource in resources:
+                    find_references(resource, page_references)
+                references.update(ref_str for ref_str in page_references if '/' in ref_str and not ref_str.startswith('#'))
+            if page_number == max_pages and _bundle_next_url(bundle):
+                yield json.dumps({"type": "warning", "message": f"Stopped {label} after {max_pages} pages; more results are available on the server."}) + "\n"
+                logger.warning(f"Page limit {max_pages} reached for {label}")
+    except (requests.RequestException, ValueError) as e:
+        message = f"Failed to fetch {label}: {e}" if not pages_saved else f"Failed to fetch page {pages_saved + 1} of {label}, keeping {pages_saved} page(s): {e}"
+        yield json.dumps({"type": severity, "message": message}) + "\n"
+        logger.log(logging.ERROR if severity == 'error' else logging.WARNING, message)
+        return pages_saved
+    except IOError as e:
+        yield json.dumps({"type": severity, "message": f"Failed to save {label}: {e}"}) + "\n"
+        logger.error(f"Failed to write pages of {label} to ZIP: {e}")
+        return pages_saved
+    yield json.dumps({"type": "success", "message": f"Saved {resources_saved} resources for {label} from {pages_saved} page(s)"}) + "\n"
+    return pages_saved
+
+def retrieve_bundles(fhir_server_url, resources, output_zip, validate_references=False, fetch_reference_bundles=False, auth_type='none', auth_token=None,
+                     page_size=None, max_pages=None, page_format=None, direct=None, ndjson_gzip=None):
     """
     Retrieve FHIR bundles and save to a ZIP file.
+    With direct (RETRIEVE_DIRECT_UPSTREAM) requests go straight to HAPI or the custom server using
+    the proxy's header rules; otherwise they loop back through this app's /fhir proxy.
+    Searches follow Bundle.link[relation=next] with _count=page_size (RETRIEVE_PAGE_SIZE) for up to
+    max_pages pages (RETRIEVE_MAX_PAGES), saving each page as it arrives (page_format, RETRIEVE_PAGE_FORMAT):
+    'bundle' writes one compact Bundle file per page straight into output_zip; 'ndjson' writes the
+    FHIR Bulk Data layout, one <ResourceType>.ndjson file per type for all retrieved resources
+    including references, gzip-compressed with ndjson_gzip (RETRIEVE_NDJSON_GZIP).
     Optionally fetches referenced resources, either individually by ID or as full bundles by type.
     Supports authentication for custom FHIR servers.
     Yields NDJSON progress updates.
     """
-    temp_dir = None
+    zipf = None
+    ndjson_writer = None
     try:
         total_initial_bundles = 0
         fetched_individual_references = 0
         fetched_type_bundles = 0
         retrieved_references_or_types = set()
-
-        temp_dir = tempfile.mkdtemp(prefix="fhir_retrieve_")
-        logger.debug(f"Created temporary directory for bundle retrieval: {temp_dir}")
+        page_size = page_size or _get_retrieve_setting('RETRIEVE_PAGE_SIZE', RETRIEVE_DEFAULT_PAGE_SIZE)
+        max_pages = max_pages or _get_retrieve_setting('RETRIEVE_MAX_PAGES', RETRIEVE_DEFAULT_MAX_PAGES)
+        page_format = page_format or current_app.config.get('RETRIEVE_PAGE_FORMAT', 'bundle')
+        if page_format not in RETRIEVE_PAGE_FORMATS:
+            logger.warning(f"Unknown page format {page_format!r}, using 'bundle'.")
+            page_format = 'bundle'
+        if page_format == 'ndjson':
+            if ndjson_gzip is None:
+                ndjson_gzip = current_app.config.get('RETRIEVE_NDJSON_GZIP', False)
+            ndjson_writer = NdjsonExportWriter(compress=ndjson_gzip)
+
+        zipf = zipfile.ZipFile(output_zip, 'w', zipfile.ZIP_DEFLATED)
+        logger.debug(f"Writing retrieved bundles to {output_zip}")
         yield json.dumps({"type": "progress", "message": f"Starting bundle retrieval for {len(resources)} resource types"}) + "\n"
         if validate_references:
             yield json.dumps({"type": "info", "message": f"Reference fetching ON (Mode: {'Full Type Bundles' if fetch_reference_bundles else 'Individual Resources'})"}) + "\n"
         else:
             yield json.dumps({"type": "info", "message": "Reference fetching OFF"}) + "\n"
+        yield json.dumps({"type": "info", "message": f"Paging with _count={page_size}, up to {max_pages} pages per type, saving {('gzipped ' if ndjson_gzip else '') + 'NDJSON files per resource type' if ndjson_writer else 'one Bundle per page'}"}) + "\n"
 
         # Determine Base URL and Headers for Proxy
         base_proxy_url = f"{current_app.config['APP_BASE_URL'].rstrip('/')}/fhir"
-        headers = {'Accept': 'application/fhir+json, application/fhir+xml;q=0.9, */*;q=0.8'}
+        headers = {'Accept': FHIR_DEFAULT_ACCEPT}
         is_custom_url = fhir_server_url != '/fhir' and fhir_server_url is not None and fhir_server_url.startswith('http')
         if is_custom_url:
             headers['X-Target-FHIR-Server'] = fhir_server_url.rstrip('/')
@@ -3977,90 +6202,57 @@ def retrieve_bundles(fhir_server_url, resources, output_zip, validate_references
                 headers['Authorization'] = auth_token
             else:
                 yield json.dumps({"type": "info", "message": "Using no authentication for custom URL"}) + "\n"
-            logger.debug(f"Will use proxy with X-Target-FHIR-Server: {headers['X-Target-FHIR-Server']}")
+            logger.debug(f"Will target custom server {headers['X-Target-FHIR-Server']}")
         else:
             yield json.dumps({"type": "info", "message": "Using no authentication for local HAPI server"}) + "\n"
-            logger.debug("Will use proxy targeting local HAPI server")
+            logger.debug("Will target local HAPI server")
+        target_base_url = fhir_server_url.rstrip('/') if is_custom_url else current_app.config['HAPI_FHIR_URL'].rstrip('/')
+
+        # Direct mode skips the loopback through /fhir: same request, one hop and no second worker thread
+        if direct is None:
+            direct = current_app.config.get('RETRIEVE_DIRECT_UPSTREAM', True)
+        if direct:
+            base_url = target_base_url
+            headers = build_upstream_headers(headers)
+            via = "directly"
+        else:
+            base_url = base_proxy_url
+            via = "via proxy"
+        logger.debug(f"Retrieving from {base_url} ({via})")
+
+        def page_url(next_url):
+            # Next links carry the target server's base; keep requesting them the same way
+            for base in (target_base_url, base_proxy_url):
+                if next_url == base or next_url.startswith(base + '/') or next_url.startswith(base + '?'):
+                    return base_url + next_url[len(base):]
+            return None
 
         # Fetch Initial Bundles
-        initial_bundle_files = []
+        all_references = set()
         for resource_type in resources:
-            url = f"{base_proxy_url}/{quote(resource_type)}"
-            yield json.dumps({"type": "progress", "message": f"Fetching bundle for {resource_type} via proxy..."}) + "\n"
-            logger.debug(f"Sending GET request to proxy {url} with headers: {json.dumps(headers)}")
+            url = f"{base_url}/{quote(resource_type)}?_count={page_size}"
+            yield json.dumps({"type": "progress", "message": f"Fetching bundle for {resource_type} {via}..."}) + "\n"
+            logger.debug(f"Sending GET request {url}")
             try:
-                response = requests.get(url, headers=headers, timeout=60)
-                logger.debug(f"Proxy response for {resource_type}: HTTP {response.status_code}")
-                if response.status_code != 200:
-                    error_detail = f"Proxy returned HTTP {response.status_code}."
-                    try: error_detail += f" Body: {response.text[:200]}..."
-                    except: pass
-                    yield json.dumps({"type": "error", "message": f"Failed to fetch {resource_type}: {error_detail}"}) + "\n"
-                    logger.error(f"Failed to fetch {resource_type} via proxy {url}: {error_detail}")
-                    continue
-                try:
-                    bundle = response.json()
-                except ValueError as e:
-                    yield json.dumps({"type": "error", "message": f"Invalid JSON response for {resource_type}: {str(e)}"}) + "\n"
-                    logger.error(f"Invalid JSON from proxy for {resource_type} at {url}: {e}, Response: {response.text[:500]}")
-                    continue
-                if not isinstance(bundle, dict) or bundle.get('resourceType') != 'Bundle':
-                    yield json.dumps({"type": "error", "message": f"Expected Bundle for {resource_type}, got {bundle.get('resourceType', 'unknown')}"}) + "\n"
-                    logger.error(f"Expected Bundle for {resource_type}, got {bundle.get('resourceType', 'unknown')}")
-                    continue
-                if not bundle.get('entry'):
-                    yield json.dumps({"type": "warning", "message": f"No entries found in bundle for {resource_type}"}) + "\n"
-
-                # Save the bundle
-                output_file = os.path.join(temp_dir, f"{resource_type}_bundle.json")
-                try:
-                    with open(output_file, 'w', encoding='utf-8') as f:
-                        json.dump(bundle, f, indent=2)
-                    logger.debug(f"Wrote bundle to {output_file}")
-                    initial_bundle_files.append(output_file)
+                pages = iter_bundle_pages(url, headers, page_url, max_pages, timeout=60)
+                pages_saved = yield from _save_bundle_pages(pages, resource_type, f"{resource_type}_bundle", zipf, max_pages, ndjson_writer,
+                                                            references=all_references if validate_references else None)
+                if pages_saved:
                     total_initial_bundles += 1
-                    yield json.dumps({"type": "success", "message": f"Saved bundle for {resource_type}"}) + "\n"
-                except IOError as e:
-                    yield json.dumps({"type": "error", "message": f"Failed to save bundle file for {resource_type}: {e}"}) + "\n"
-                    logger.error(f"Failed to write bundle file {output_file}: {e}")
-                    continue
-            except requests.RequestException as e:
-                yield json.dumps({"type": "error", "message": f"Error connecting to proxy for {resource_type}: {str(e)}"}) + "\n"
-                logger.error(f"Error retrieving bundle for {resource_type} via proxy {url}: {e}")
-                continue
             except Exception as e:
                 yield json.dumps({"type": "error", "message": f"Unexpected error fetching {resource_type}: {str(e)}"}) + "\n"
                 logger.error(f"Unexpected error during initial fetch for {resource_type} at {url}: {e}", exc_info=True)
                 continue
 
         # Fetch Referenced Resources (Conditionally)
-        if validate_references and initial_bundle_files:
+        if validate_references and total_initial_bundles:
             yield json.dumps({"type": "progress", "message": "Scanning retrieved bundles for references..."}) + "\n"
-            all_references = set()
             references_by_type = defaultdict(set)
-
-            # Scan for References
-            for bundle_file_path in initial_bundle_files:
-                try:
-                    with open(bundle_file_path, 'r', encoding='utf-8') as f:
-                        bundle = json.load(f)
-                    for entry in bundle.get('entry', []):
-                        resource = entry.get('resource')
-                        if resource:
-                            current_refs = []
-                            find_references(resource, current_refs)
-                            for ref_str in current_refs:
-                                if isinstance(ref_str, str) and '/' in ref_str and not ref_str.startswith('#'):
-                                    all_references.add(ref_str)
-                                    try:
-                                        ref_type = ref_str.split('/')[0]
-                                        if ref_type:
-                                            references_by_type[ref_type].add(ref_str)
-                                    except Exception:
-                                        pass
-                except Exception as e:
-                    yield json.dumps({"type": "warning", "message": f"Could not scan references in {os.path.basename(bundle_file_path)}: {e}"}) + "\n"
-                    logger.warning(f"Error processing references in {bundle_file_path}: {e}")
+            # References were collected from every saved page as it was written
+            for ref_str in all_references:
+                ref_type = ref_str.split('/')[0]
+                if ref_type:
+                    references_by_type[ref_type].add(ref_str)
 
             # Fetch Logic
             if not all_references:
@@ -4076,149 +6268,93 @@ def retrieve_bundles(fhir_server_url, resources, output_zip, validate_references
                         if ref_type in retrieved_references_or_types:
                             continue
 
-                        url = f"{base_proxy_url}/{quote(ref_type)}"
-                        yield json.dumps({"type": "progress", "message": f"Fetching full bundle for type {ref_type} via proxy..."}) + "\n"
-                        logger.debug(f"Sending GET request for full type bundle {ref_type} to proxy {url} with headers: {json.dumps(headers)}")
+                        url = f"{base_url}/{quote(ref_type)}?_count={page_size}"
+                        yield json.dumps({"type": "progress", "message": f"Fetching full bundle for type {ref_type} {via}..."}) + "\n"
+                        logger.debug(f"Sending GET request for full type bundle {ref_type}: {url}")
                         try:
-                            response = requests.get(url, headers=headers, timeout=180)
-                            logger.debug(f"Proxy response for {ref_type} bundle: HTTP {response.status_code}")
-                            if response.status_code != 200:
-                                error_detail = f"Proxy returned HTTP {response.status_code}."
-                                try: error_detail += f" Body: {response.text[:200]}..."
-                                except: pass
-                                yield json.dumps({"type": "warning", "message": f"Failed to fetch full bundle for {ref_type}: {error_detail}"}) + "\n"
-                                logger.warning(f"Failed to fetch full bundle {ref_type} via proxy {url}: {error_detail}")
-                                retrieved_references_or_types.add(ref_type)
-                                continue
-
-                            try:
-                                bundle = response.json()
-                            except ValueError as e:
-                                yield json.dumps({"type": "warning", "message": f"Invalid JSON for full {ref_type} bundle: {str(e)}"}) + "\n"
-                                logger.warning(f"Invalid JSON response from proxy for full {ref_type} bundle at {url}: {e}")
-                                retrieved_references_or_types.add(ref_type)
-                                continue
-
-                            if not isinstance(bundle, dict) or bundle.get('resourceType') != 'Bundle':
-                                yield json.dumps({"type": "warning", "message": f"Expected Bundle for full {ref_type} fetch, got {bundle.get('resourceType', 'unknown')}"}) + "\n"
-                                logger.warning(f"Expected Bundle for full {ref_type} fetch, got {bundle.get('resourceType', 'unknown')}")
-                                retrieved_references_or_types.add(ref_type)
-                                continue
-
-                            # Save the full type bundle
-                            output_file = os.path.join(temp_dir, f"ref_{ref_type}_BUNDLE.json")
-                            try:
-                                with open(output_file, 'w', encoding='utf-8') as f:
-                                    json.dump(bundle, f, indent=2)
-                                logger.debug(f"Wrote full type bundle to {output_file}")
+                            pages = iter_bundle_pages(url, headers, page_url, max_pages, timeout=180)
+                            pages_saved = yield from _save_bundle_pages(pages, f"full bundle for type {ref_type}", f"ref_{ref_type}_BUNDLE", zipf,
+                                                                        max_pages, ndjson_writer, severity='warning')
+                            if pages_saved:
                                 fetched_type_bundles += 1
-                                retrieved_references_or_types.add(ref_type)
-                                yield json.dumps({"type": "success", "message": f"Saved full bundle for type {ref_type}"}) + "\n"
-                            except IOError as e:
-                                yield json.dumps({"type": "warning", "message": f"Failed to save full bundle file for {ref_type}: {e}"}) + "\n"
-                                logger.error(f"Failed to write full bundle file {output_file}: {e}")
-                                retrieved_references_or_types.add(ref_type)
-                        except requests.RequestException as e:
-                            yield json.dumps({"type": "warning", "message": f"Error connecting to proxy for full {ref_type} bundle: {str(e)}"}) + "\n"
-                            logger.warning(f"Error retrieving full {ref_type} bundle via proxy: {e}")
-                            retrieved_references_or_types.add(ref_type)
                         except Exception as e:
                             yield json.dumps({"type": "warning", "message": f"Unexpected error fetching full {ref_type} bundle: {str(e)}"}) + "\n"
                             logger.warning(f"Unexpected error during full {ref_type} bundle fetch: {e}", exc_info=True)
-                            retrieved_references_or_types.add(ref_type)
+                        retrieved_references_or_types.add(ref_type)
                 else:
-                    # Fetch Individual Referenced Resources
+                    # Fetch Individual Referenced Resources, batched by type into concurrent _id searches
                     yield json.dumps({"type": "progress", "message": f"Fetching {len(all_references)} unique referenced resources individually..."}) + "\n"
                     logger.info(f"Fetching {len(all_references)} unique referenced resources by ID.")
-                    for ref in sorted(list(all_references)):
-                        if ref in retrieved_references_or_types:
+                    valid_references = []
+                    for ref in sorted(all_references):
+                        ref_parts = ref.split('/')
+                        if len(ref_parts) != 2 or not ref_parts[0] or not ref_parts[1]:
+                            logger.warning(f"Skipping invalid reference format: {ref}")
+                            continue
+                        if ref not in retrieved_references_or_types:
+                            valid_references.append(ref)
+                    resolved = iter_resolved_references(
+                        base_url, valid_references, headers,
+                        batch_size=_get_retrieve_setting('RETRIEVE_REFERENCE_BATCH_SIZE', RETRIEVE_REFERENCE_DEFAULT_BATCH_SIZE),
+                        max_workers=_get_retrieve_setting('RETRIEVE_REFERENCE_MAX_WORKERS', RETRIEVE_REFERENCE_DEFAULT_MAX_WORKERS),
+                        report_pending=True
+                    )
+                    for ref, entry, error in resolved:
+                        ref_type, ref_id = ref.split('/')
+                        if entry is REFERENCE_PENDING:
+                            yield json.dumps({"type": "progress", "message": f"Fetching referenced {ref_type}/{ref_id} {via}..."}) + "\n"
+                            continue
+                        retrieved_references_or_types.add(ref)
+                        if isinstance(error, requests.RequestException):
+                            yield json.dumps({"type": "warning", "message": f"Network error fetching referenced {ref}: {str(error)}"}) + "\n"
+                            logger.warning(f"Network error retrieving referenced {ref} {via}: {error}")
+                            continue
+                        if error is not None:
+                            yield json.dumps({"type": "warning", "message": f"Failed to fetch referenced {ref}: {error}"}) + "\n"
+                            logger.warning(f"Failed to fetch referenced {ref} {via}: {error}")
+                            continue
+                        if entry is None:
+                            yield json.dumps({"type": "info", "message": f"Referenced resource {ref} not found on server."}) + "\n"
+                            logger.info(f"Referenced resource {ref} not found via _id search")
                             continue
 
+                        # Save a bundle containing the single referenced resource (or add it to its type's NDJSON file)
+                        output_file = f"ref_{ref_type}_{ref_id}.json"
                         try:
-                            ref_parts = ref.split('/')
-                            if len(ref_parts) != 2 or not ref_parts[0] or not ref_parts[1]:
-                                logger.warning(f"Skipping invalid reference format: {ref}")
-                                continue
-                            ref_type, ref_id = ref_parts
-
-                            search_param = quote(f"_id={ref_id}")
-                            url = f"{base_proxy_url}/{quote(ref_type)}?{search_param}"
-                            yield json.dumps({"type": "progress", "message": f"Fetching referenced {ref_type}/{ref_id} via proxy..."}) + "\n"
-                            logger.debug(f"Sending GET request for referenced {ref} to proxy {url} with headers: {json.dumps(headers)}")
-
-                            response = requests.get(url, headers=headers, timeout=60)
-                            logger.debug(f"Proxy response for referenced {ref}: HTTP {response.status_code}")
-
-                            if response.status_code != 200:
-                                error_detail = f"Proxy returned HTTP {response.status_code}."
-                                try: error_detail += f" Body: {response.text[:200]}..."
-                                except: pass
-                                yield json.dumps({"type": "warning", "message": f"Failed to fetch referenced {ref}: {error_detail}"}) + "\n"
-                                logger.warning(f"Failed to fetch referenced {ref} via proxy {url}: {error_detail}")
-                                retrieved_references_or_types.add(ref)
-                                continue
-
-                            try:
-                                bundle = response.json()
-                            except ValueError as e:
-                                yield json.dumps({"type": "warning", "message": f"Invalid JSON for referenced {ref}: {str(e)}"}) + "\n"
-                                logger.warning(f"Invalid JSON from proxy for ref {ref} at {url}: {e}")
-                                retrieved_references_or_types.add(ref)
-                                continue
-
-                            if not isinstance(bundle, dict) or bundle.get('resourceType') != 'Bundle':
-                                yield json.dumps({"type": "warning", "message": f"Expected Bundle for referenced {ref}, got {bundle.get('resourceType', 'unknown')}"}) + "\n"
-                                retrieved_references_or_types.add(ref)
-                                continue
-
-                            if not bundle.get('entry'):
-                                yield json.dumps({"type": "info", "message": f"Referenced resource {ref} not found on server."}) + "\n"
-                                logger.info(f"Referenced resource {ref} not found via search {url}")
-                                retrieved_references_or_types.add(ref)
-                                continue
-
-                            # Save the bundle containing the single referenced resource
-                            output_file = os.path.join(temp_dir, f"ref_{ref_type}_{ref_id}.json")
-                            try:
-                                with open(output_file, 'w', encoding='utf-8') as f:
-                                    json.dump(bundle, f, indent=2)
-                                logger.debug(f"Wrote referenced resource bundle to {output_file}")
-                                fetched_individual_references += 1
-                                retrieved_references_or_types.add(ref)
-                                yield json.dumps({"type": "success", "message": f"Saved referenced resource {ref}"}) + "\n"
-                            except IOError as e:
-                                yield json.dumps({"type": "warning", "message": f"Failed to save file for referenced {ref}: {e}"}) + "\n"
-                                logger.error(f"Failed to write file {output_file}: {e}")
-                                retrieved_references_or_types.add(ref)
-                        except requests.RequestException as e:
-                            yield json.dumps({"type": "warning", "message": f"Network error fetching referenced {ref}: {str(e)}"}) + "\n"
-                            logger.warning(f"Network error retrieving referenced {ref} via proxy: {e}")
-                            retrieved_references_or_types.add(ref)
-                        except Exception as e:
-                            yield json.dumps({"type": "warning", "message": f"Unexpected error fetching referenced {ref}: {str(e)}"}) + "\n"
-                            logger.warning(f"Unexpected error during reference fetch for {ref}: {e}", exc_info=True)
-                            retrieved_references_or_types.add(ref)
-
-        # Create Final ZIP File
+                            if ndjson_writer is not None:
+                                output_file = ndjson_writer.member_name(ref_type)
+                                if not ndjson_writer.add(entry.get('resource')):
+                                    yield json.dumps({"type": "info", "message": f"Referenced resource {ref} already exported, skipping."}) + "\n"
+                                    logger.debug(f"Skipped referenced {ref}, already in {output_file}")
+                                    continue
+                                logger.debug(f"Appended referenced resource to NDJSON member {output_file}")
+                            else:
+                                _zip_json(zipf, output_file, {'resourceType': 'Bundle', 'type': 'searchset', 'total': 1, 'entry': [entry]})
+                                logger.debug(f"Wrote referenced resource bundle to ZIP member {output_file}")
+                            fetched_individual_references += 1
+                            yield json.dumps({"type": "success", "message": f"Saved referenced resource {ref}"}) + "\n"
+                        except IOError as e:
+                            yield json.dumps({"type": "warning", "message": f"Failed to save file for referenced {ref}: {e}"}) + "\n"
+                            logger.error(f"Failed to write file {output_file}: {e}")
+
+        # Finalize the ZIP File
         yield json.dumps({"type": "progress", "message": f"Creating ZIP file {os.path.basename(output_zip)}..."}) + "\n"
-        files_to_zip = [f for f in os.listdir(temp_dir) if f.endswith('.json')]
-        if not files_to_zip:
-            yield json.dumps({"type": "warning", "message": "No bundle files were successfully retrieved to include in ZIP."}) + "\n"
-            logger.warning(f"No JSON files found in {temp_dir} to include in ZIP.")
-        else:
-            logger.debug(f"Found {len(files_to_zip)} JSON files to include in ZIP: {files_to_zip}")
-            try:
-                with zipfile.ZipFile(output_zip, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                    for filename in files_to_zip:
-                        file_path = os.path.join(temp_dir, filename)
-                        if os.path.exists(file_path):
-                            zipf.write(file_path, filename)
-                        else:
-                            logger.error(f"File {file_path} disappeared before adding to ZIP.")
-                yield json.dumps({"type": "success", "message": f"ZIP file created: {os.path.basename(output_zip)} with {len(files_to_zip)} files."}) + "\n"
-            except Exception as e:
-                yield json.dumps({"type": "error", "message": f"Failed to create ZIP file: {e}"}) + "\n"
-                logger.error(f"Error creating ZIP file {output_zip}: {e}", exc_info=True)
+        try:
+            if ndjson_writer is not None:
+                counts = ndjson_writer.write_to_zip(zipf)
+                if counts:
+                    yield json.dumps({"type": "info", "message": f"Wrote NDJSON for {len(counts)} resource types: " + ", ".join(f"{t} ({n})" for t, n in counts.items())}) + "\n"
+            zipped_files = len(zipf.infolist())
+            zipf.close()
+            if not zipped_files:
+                os.remove(output_zip)
+                yield json.dumps({"type": "warning", "message": "No bundle files were successfully retrieved to include in ZIP."}) + "\n"
+                logger.warning(f"No bundle files retrieved, removed empty {output_zip}.")
+            else:
+                yield json.dumps({"type": "success", "message": f"ZIP file created: {os.path.basename(output_zip)} with {zipped_files} files."}) + "\n"
+        except Exception as e:
+            yield json.dumps({"type": "error", "message": f"Failed to create ZIP file: {e}"}) + "\n"
+            logger.error(f"Error creating ZIP file {output_zip}: {e}", exc_info=True)
 
         # Final Completion Message
         completion_message = (
@@ -4242,60 +6378,66 @@ def retrieve_bundles(fhir_server_url, resources, output_zip, validate_references
         logger.error(f"Unexpected error in retrieve_bundles setup: {e}", exc_info=True)
         yield json.dumps({"type": "complete", "message": f"Retrieval failed: {str(e)}", "data": {"total_initial_bundles": 0, "fetched_individual_references": 0, "fetched_type_bundles": 0}}) + "\n"
     finally:
-        if temp_dir and os.path.exists(temp_dir):
+        if ndjson_writer is not None:
+            ndjson_writer.close()
+        if zipf is not None and zipf.fp is not None:
             try:
-                shutil.rmtree(temp_dir)
-                logger.debug(f"Successfully removed temporary directory: {temp_dir}")
+                zipf.close()
             except Exception as cleanup_e:
-                logger.error(f"Error removing temporary directory {temp_dir}: {cleanup_e}", exc_info=True)
+                logger.error(f"Error closing ZIP file {output_zip}: {cleanup_e}", exc_info=True)
 # --- End corrected retrieve_bundles function ---
 
 def split_bundles(input_zip_path, output_zip):
-    """Split FHIR bundles from a ZIP file into individual resource JSON files and save to a ZIP."""
+    """
+    Split FHIR bundles from a ZIP file into individual resource JSON files and save to a ZIP.
+    NDJSON members (.ndjson, .ndjson.gz, e.g. a Bulk Data export) are split line by line.
+    Input members are read one at a time and each resource is written as compact JSON straight
+    into the output ZIP, without extracting to or staging in a temporary directory. Bundles are
+    parsed incrementally when ijson is installed (see read_json_bundle).
+    """
     try:
         total_resources = 0
-        temp_dir = tempfile.mkdtemp()
         yield json.dumps({"type": "progress", "message": f"Starting bundle splitting from ZIP"}) + "\n"
 
-        # Extract input ZIP
-        with zipfile.ZipFile(input_zip_path, 'r') as zip_ref:
-            zip_ref.extractall(temp_dir)
-        yield json.dumps({"type": "progress", "message": f"Extracted input ZIP to temporary directory"}) + "\n"
-
-        # Process JSON files
-        for filename in os.listdir(temp_dir):
-            if not filename.endswith('.json'):
-                continue
-            input_file = os.path.join(temp_dir, filename)
-            try:
-                with open(input_file, 'r', encoding='utf-8') as f:
-                    bundle = json.load(f)
-                if bundle.get('resourceType') != 'Bundle':
-                    yield json.dumps({"type": "error", "message": f"Skipping {filename}: Not a Bundle"}) + "\n"
+        def write_resources(filename, numbered_resources, position):
+            # Each resource is written as soon as it is parsed and not kept afterwards
+            nonlocal total_resources
+            for index, resource in numbered_resources:
+                if not isinstance(resource, dict) or not resource.get('resourceType'):
+                    yield json.dumps({"type": "error", "message": f"Invalid resource in {filename} at {position} {index}"}) + "\n"
                     continue
-                yield json.dumps({"type": "progress", "message": f"Processing bundle {filename}"}) + "\n"
-                index = 1
-                for entry in bundle.get('entry', []):
-                    resource = entry.get('resource')
-                    if not resource or not resource.get('resourceType'):
-                        yield json.dumps({"type": "error", "message": f"Invalid resource in {filename} at entry {index}"}) + "\n"
+                resource_type = resource['resourceType']
+                # Numbered across all inputs so resources from different bundles never share a name
+                total_resources += 1
+                output_name = f"{resource_type}-{total_resources}.json"
+                _zip_json(zipf, output_name, resource)
+                yield json.dumps({"type": "success", "message": f"Saved {output_name}"}) + "\n"
+
+        with zipfile.ZipFile(input_zip_path, 'r') as zip_ref, zipfile.ZipFile(output_zip, 'w', zipfile.ZIP_DEFLATED) as zipf:
+            members = [member for member in zip_ref.infolist()
+                       if not member.is_dir() and member.filename.lower().endswith(('.json',) + NDJSON_SUFFIXES)]
+            yield json.dumps({"type": "progress", "message": f"Opened input ZIP with {len(members)} JSON/NDJSON files"}) + "\n"
+
+            # Process JSON and NDJSON members
+            for member in members:
+                filename = member.filename
+                try:
+                    if filename.lower().endswith(NDJSON_SUFFIXES):
+                        yield json.dumps({"type": "progress", "message": f"Processing NDJSON {filename}"}) + "\n"
+                        with zip_ref.open(member) as fp:
+                            yield from write_resources(filename, iter_ndjson_resources(fp, filename.lower().endswith('.gz')), 'line')
                         continue
-                    resource_type = resource['resourceType']
-                    output_file = os.path.join(temp_dir, f"{resource_type}-{index}.json")
-                    with open(output_file, 'w', encoding='utf-8') as f:
-                        json.dump(resource, f, indent=2)
-                    total_resources += 1
-                    yield json.dumps({"type": "success", "message": f"Saved {resource_type}-{index}.json"}) + "\n"
-                    index += 1
-            except Exception as e:
-                yield json.dumps({"type": "error", "message": f"Error processing {filename}: {str(e)}"}) + "\n"
-                logger.error(f"Error splitting bundle {filename}: {e}", exc_info=True)
-
-        # Create output ZIP
-        with zipfile.ZipFile(output_zip, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for filename in os.listdir(temp_dir):
-                if filename.endswith('.json') and '-' in filename:
-                    zipf.write(os.path.join(temp_dir, filename), filename)
+                    entries, _ = read_json_bundle(functools.partial(zip_ref.open, member))
+                    if entries is None:
+                        yield json.dumps({"type": "error", "message": f"Skipping {filename}: Not a Bundle"}) + "\n"
+                        continue
+                    yield json.dumps({"type": "progress", "message": f"Processing bundle {filename}"}) + "\n"
+                    numbered_resources = ((index, entry.get('resource') if isinstance(entry, dict) else None) for index, entry in enumerate(entries, start=1))
+                    yield from write_resources(filename, numbered_resources, 'entry')
+                except Exception as e:
+                    yield json.dumps({"type": "error", "message": f"Error processing {filename}: {str(e)}"}) + "\n"
+                    logger.error(f"Error splitting bundle {filename}: {e}", exc_info=True)
+
         yield json.dumps({
             "type": "complete",
             "message": f"Bundle splitting completed. Extracted {total_resources} resources.",
@@ -4304,11 +6446,6 @@ def split_bundles(input_zip_path, output_zip):
     except Exception as e:
         yield json.dumps({"type": "error", "message": f"Unexpected error during splitting: {str(e)}"}) + "\n"
         logger.error(f"Unexpected error in split_bundles: {e}", exc_info=True)
-    finally:
-        if os.path.exists(temp_dir):
-            for filename in os.listdir(temp_dir):
-                os.remove(os.path.join(temp_dir, filename))
-            os.rmdir(temp_dir)
 
 
 # --- Standalone Test ---
@@ -0,0 +1,110 @@
+"""
+Benchmark for services.cache_packages: per-row ORM upserts vs. the bulk INSERT ... ON CONFLICT path.
+
+Run from the repository root:
+    python tests/benchmark_cache_packages.py [package counts...]
+
+Each count is measured twice against a temporary SQLite file: a cold refresh (empty table, all
+inserts) and a warm refresh (every row already present, all updates).
+"""
+import os
+import sys
+import tempfile
+import time
+import logging
+
+from flask import Flask
+from flask_sqlalchemy import SQLAlchemy
+
+APP_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if APP_DIR not in sys.path:
+    sys.path.insert(0, APP_DIR)
+
+import services
+
+logging.getLogger('services').setLevel(logging.WARNING)
+
+DEFAULT_COUNTS = [500, 2000, 10000]
+
+
+def make_packages(count, author='Benchmark'):
+    return [{
+        'name': f'bench.pkg{i}',
+        'version': '1.0.0',
+        'latest_absolute_version': '1.0.0',
+        'latest_official_version': '1.0.0',
+        'author': author,
+        'fhir_version': '4.0.1',
+        'url': f'https://example.org/bench.pkg{i}',
+        'canonical': f'https://example.org/bench.pkg{i}',
+        'dependencies': [{'name': 'hl7.fhir.r4.core', 'version': '4.0.1'}],
+        'version_count': 3,
+        'all_versions': [{'version': f'1.0.{v}', 'pubDate': '2024-01-01'} for v in range(3)],
+        'registry': 'https://example.org/feed'
+    } for i in range(count)]
+
+
+def legacy_cache_packages(normalized_packages, db, CachedPackage):
+    """The previous implementation: one SELECT plus an ORM add/update per package."""
+    for package in normalized_packages:
+        existing = CachedPackage.query.filter_by(package_name=package['name'], version=package['version']).first()
+        if existing:
+            for column in services.CACHED_PACKAGE_COLUMNS:
+                setattr(existing, column, package.get(column, ''))
+        else:
+            db.session.add(CachedPackage(package_name=package['name'], version=package['version'],
+                                         **{column: package.get(column, '') for column in services.CACHED_PACKAGE_COLUMNS}))
+    db.session.commit()
+
+
+def build_app(db_path):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_path}'
+    db = SQLAlchemy(app)
+
+    class CachedPackage(db.Model):
+        id = db.Column(db.Integer, primary_key=True)
+        package_name = db.Column(db.String(128), nullable=False)
+        version = db.Column(db.String(64), nullable=False)
+        author = db.Column(db.String(128))
+        fhir_version = db.Column(db.String(64))
+        version_count = db.Column(db.Integer)
+        url = db.Column(db.String(256))
+        all_versions = db.Column(db.JSON, nullable=True)
+        dependencies = db.Column(db.JSON, nullable=True)
+        latest_absolute_version = db.Column(db.String(64))
+        latest_official_version = db.Column(db.String(64))
+        canonical = db.Column(db.String(256))
+        registry = db.Column(db.String(256))
+        __table_args__ = (db.UniqueConstraint('package_name', 'version', name='uq_cached_package_version'),)
+
+    return app, db, CachedPackage
+
+
+def time_refresh(cache_fn, count):
+    results = {}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        app, db, CachedPackage = build_app(os.path.join(temp_dir, 'bench.db'))
+        with app.app_context():
+            db.create_all()
+            for phase, author in (('cold', 'Benchmark'), ('warm', 'Benchmark 2')):
+                packages = make_packages(count, author)
+                started = time.perf_counter()
+                cache_fn(packages, db, CachedPackage)
+                results[phase] = time.perf_counter() - started
+            assert CachedPackage.query.count() == count
+            db.session.remove()
+            db.engine.dispose()
+    return results
+
+
+def main(counts):
+    print(f"{'packages':>9} | {'row-by-row cold':>15} | {'bulk cold':>9} | {'row-by-row warm':>15} | {'bulk warm':>9} | {'speedup (warm)':>14}")
+    for count in counts:
+        legacy = time_refresh(legacy_cache_packages, count)
+        bulk = time_refresh(services.cache_packages, count)
+        print(f"{count:>9} | {legacy['cold']:>14.3f}s | {bulk['cold']:>8.3f}s | {legacy['warm']:>14.3f}s | {bulk['warm']:>8.3f}s | {legacy['warm'] / bulk['warm']:>13.1f}x")
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or DEFAULT_COUNTS)
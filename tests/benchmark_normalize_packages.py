@@ -0,0 +1,71 @@
+"""
+Benchmark for services.normalize_package_data: uncached Version parsing vs. memoized version_sort_key tuples.
+
+Run from the repository root:
+    python tests/benchmark_normalize_packages.py [feed entry counts...]
+
+Each feed has ten versions per package with a mix of release, -ballot, -snapshot, -cibuild and -rc
+versions. The memoized path is measured cold (empty key cache) and warm (a repeat refresh of the same feed).
+"""
+import os
+import sys
+import time
+import logging
+
+APP_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if APP_DIR not in sys.path:
+    sys.path.insert(0, APP_DIR)
+
+import services
+
+logging.getLogger('services').setLevel(logging.ERROR)
+
+DEFAULT_COUNTS = [50000]
+VERSIONS_PER_PACKAGE = 10
+SUFFIXES = ['', '-ballot', '-snapshot1', '-cibuild', '-rc2', '-ballot2', '-preview', '-draft', '', '']
+
+
+def make_feed(count):
+    entries = []
+    for i in range(count):
+        package_index, version_index = divmod(i, VERSIONS_PER_PACKAGE)
+        version = f"{version_index // 3}.{version_index % 3}.{package_index % 7}{SUFFIXES[version_index]}"
+        entries.append({
+            'name': f'bench.pkg{package_index}',
+            'version': version,
+            'author': 'Benchmark',
+            'fhirVersion': '4.0.1',
+            'url': f'https://example.org/bench.pkg{package_index}/{version}',
+            'dependencies': {'hl7.fhir.r4.core': '4.0.1'},
+            'versions': [{'version': version, 'pubDate': f'2024-01-{version_index + 1:02d}'}],
+        })
+    return entries
+
+
+def time_normalize(entries):
+    started = time.perf_counter()
+    normalized = services.normalize_package_data(entries)
+    return time.perf_counter() - started, normalized
+
+
+def main(counts):
+    print(f"{'entries':>8} | {'uncached':>9} | {'memoized cold':>13} | {'memoized warm':>13} | {'speedup (warm)':>14}")
+    memoized_key = services.version_sort_key
+    for count in counts:
+        entries = make_feed(count)
+        # The previous behaviour: parse a packaging Version on every comparison
+        services.version_sort_key = services._parse_version
+        try:
+            legacy_seconds, legacy_result = time_normalize(entries)
+        finally:
+            services.version_sort_key = memoized_key
+        services._interned_version.cache_clear()
+        cold_seconds, cold_result = time_normalize(entries)
+        warm_seconds, _ = time_normalize(entries)
+        assert [(p['name'], p['latest_absolute_version'], p['latest_official_version']) for p in legacy_result] == \
+               [(p['name'], p['latest_absolute_version'], p['latest_official_version']) for p in cold_result]
+        print(f"{count:>8} | {legacy_seconds:>8.3f}s | {cold_seconds:>12.3f}s | {warm_seconds:>12.3f}s | {legacy_seconds / warm_seconds:>13.1f}x")
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or DEFAULT_COUNTS)
@@ -5,11 +5,17 @@ import json
 import tarfile
 import shutil
 import io
+import http.server
+import tempfile
+import threading
+import zipfile
+import functools
 import requests
 from unittest.mock import patch, MagicMock, mock_open, call
 from flask import Flask, session
 from flask.testing import FlaskClient
 from datetime import datetime, timezone
+from types import SimpleNamespace
 
 # Add the parent directory (/app) to sys.path
 APP_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
@@ -240,8 +246,9 @@ class TestFHIRFlareIGToolkit(unittest.TestCase):
 
     @patch('os.path.exists', return_value=True)
     @patch('tarfile.open')
-    @patch('requests.put')
-    def test_30_load_ig_to_hapi_success(self, mock_requests_put, mock_tarfile_open, mock_os_exists):
+    @patch('app.get_http_session')
+    def test_30_load_ig_to_hapi_success(self, mock_get_http_session, mock_tarfile_open, mock_os_exists):
+        mock_requests_put = mock_get_http_session.return_value.put
         pkg_name = 'hl7.fhir.us.core'
         pkg_version = '6.1.0'
         filename = f'{pkg_name}-{pkg_version}.tgz'
@@ -282,8 +289,9 @@ class TestFHIRFlareIGToolkit(unittest.TestCase):
         self.assertEqual(data['error'], 'Package not found')
 
     @patch('os.path.exists', return_value=True)
-    @patch('requests.post')
-    def test_32_api_validate_sample_hapi_success(self, mock_requests_post, mock_os_exists):
+    @patch('services.get_http_session')
+    def test_32_api_validate_sample_hapi_success(self, mock_get_http_session, mock_os_exists):
+        mock_requests_post = mock_get_http_session.return_value.post
         pkg_name = 'hl7.fhir.us.core'
         pkg_version = '6.1.0'
         sample_resource = {
@@ -323,9 +331,10 @@ class TestFHIRFlareIGToolkit(unittest.TestCase):
         )
 
     @patch('os.path.exists', return_value=True)
-    @patch('requests.post', side_effect=requests.ConnectionError("HAPI down"))
+    @patch('services.get_http_session')
     @patch('services.navigate_fhir_path')
-    def test_33_api_validate_sample_hapi_fallback(self, mock_navigate_fhir_path, mock_requests_post, mock_os_exists):
+    def test_33_api_validate_sample_hapi_fallback(self, mock_navigate_fhir_path, mock_get_http_session, mock_os_exists):
+        mock_get_http_session.return_value.post.side_effect = requests.ConnectionError("HAPI down")
         pkg_name = 'hl7.fhir.us.core'
         pkg_version = '6.1.0'
         sample_resource = {
@@ -510,7 +519,7 @@ class TestFHIRFlareIGToolkit(unittest.TestCase):
     @patch('os.path.exists', return_value=True)
     @patch('app.services.get_package_metadata')
     @patch('tarfile.open')
-    @patch('requests.Session')
+    @patch('services.get_http_session')
     def test_50_api_push_ig_success(self, mock_session, mock_tarfile_open, mock_get_metadata, mock_os_exists):
         pkg_name = 'push.test.pkg'
         pkg_version = '1.0.0'
@@ -567,7 +576,7 @@ class TestFHIRFlareIGToolkit(unittest.TestCase):
     @patch('os.path.exists', return_value=True)
     @patch('app.services.get_package_metadata')
     @patch('tarfile.open')
-    @patch('requests.Session')
+    @patch('services.get_http_session')
     def test_51_api_push_ig_with_failures(self, mock_session, mock_tarfile_open, mock_get_metadata, mock_os_exists):
         pkg_name = 'push.fail.pkg'
         pkg_version = '1.0.0'
@@ -599,7 +608,7 @@ class TestFHIRFlareIGToolkit(unittest.TestCase):
         mock_fail_http_response.json.return_value = {'resourceType': 'OperationOutcome', 'issue': [{'severity': 'error', 'diagnostics': 'Validation failed'}]}
         mock_fail_exception = requests.exceptions.HTTPError(response=mock_fail_http_response)
         mock_fail_http_response.raise_for_status.side_effect = mock_fail_exception
-        mock_session_instance.put.side_effect = [mock_ok_response, mock_fail_http_response]
+        mock_session_instance.put.side_effect = lambda url, **kwargs: mock_fail_http_response if url.endswith('/Observation/fail1') else mock_ok_response
         mock_session.return_value = mock_session_instance
         self.create_mock_tgz(filename, {'package/dummy.txt': 'content'})
         response = self.client.post(
@@ -630,7 +639,7 @@ class TestFHIRFlareIGToolkit(unittest.TestCase):
     @patch('os.path.exists', return_value=True)
     @patch('app.services.get_package_metadata')
     @patch('tarfile.open')
-    @patch('requests.Session')
+    @patch('services.get_http_session')
     def test_52_api_push_ig_with_dependency(self, mock_session, mock_tarfile_open, mock_get_metadata, mock_os_exists):
         main_pkg_name = 'main.dep.pkg'
         main_pkg_ver = '1.0'
@@ -784,5 +793,888 @@ class TestFHIRFlareIGToolkit(unittest.TestCase):
         data = json.loads(response.data)
         self.assertEqual(data.get('dependency_mode'), 'tree-shaking')
 
+    def test_65_member_index_sd_lookup(self):
+        pkg_name = 'index.test'
+        pkg_version = '1.0'
+        filename = f"{pkg_name}-{pkg_version}.tgz"
+        tgz_path = self.create_mock_tgz(filename, {
+            'package/package.json': {'name': pkg_name, 'version': pkg_version, 'dependencies': {'hl7.fhir.r4.core': '4.0.1'}},
+            'package/StructureDefinition-other.json': {'resourceType': 'StructureDefinition', 'id': 'other', 'type': 'Observation', 'url': 'http://example.org/StructureDefinition/other'},
+            'package/StructureDefinition-my-patient.json': {'resourceType': 'StructureDefinition', 'id': 'my-patient', 'type': 'Patient', 'url': 'http://example.org/StructureDefinition/my-patient', 'text': {'div': '<div/>'}},
+            'package/SearchParameter-patient-foo.json': {'resourceType': 'SearchParameter', 'id': 'patient-foo', 'code': 'foo', 'base': ['Patient']}
+        })
+        member_index = services.get_package_member_index(tgz_path)
+        self.assertEqual(member_index['package_name'], pkg_name)
+        self.assertEqual(member_index['dependencies'], {'hl7.fhir.r4.core': '4.0.1'})
+        self.assertTrue(os.path.exists(services.construct_member_index_path(tgz_path)))
+        extracted_dir = services.get_extracted_package_dir(tgz_path)
+        self.assertTrue(os.path.isfile(os.path.join(extracted_dir, 'package', 'StructureDefinition-my-patient.json')))
+        with patch('tarfile.open', side_effect=AssertionError("archive should not be rescanned")):
+            sd_data, sd_path = services.find_and_extract_sd(tgz_path, 'Patient', profile_url='http://example.org/StructureDefinition/my-patient')
+            self.assertEqual(sd_path, 'package/StructureDefinition-my-patient.json')
+            self.assertEqual(sd_data['id'], 'my-patient')
+            self.assertNotIn('text', sd_data)
+            search_params = services.find_and_extract_search_params(tgz_path, 'Patient')
+            self.assertEqual([sp['code'] for sp in search_params], ['foo'])
+            self.assertEqual(services.extract_dependencies(tgz_path), ({'hl7.fhir.r4.core': '4.0.1'}, None))
+
+    def test_66_sd_cache_hits_and_invalidation(self):
+        filename = "cache.test-1.0.tgz"
+        tgz_path = self.create_mock_tgz(filename, {
+            'package/package.json': {'name': 'cache.test', 'version': '1.0'},
+            'package/StructureDefinition-cached.json': {'resourceType': 'StructureDefinition', 'id': 'cached', 'type': 'Patient', 'url': 'http://example.org/StructureDefinition/cached'}
+        })
+        services.invalidate_sd_cache()
+        before = services.get_sd_cache_stats()
+        with patch('services.find_and_extract_sd', wraps=services.find_and_extract_sd) as mock_find:
+            first, _ = services.get_cached_sd(tgz_path, 'Patient', 'http://example.org/StructureDefinition/cached')
+            second, _ = services.get_cached_sd(tgz_path, 'Patient', 'http://example.org/StructureDefinition/cached')
+            self.assertIs(first, second)
+            self.assertEqual(mock_find.call_count, 1)
+            services.invalidate_sd_cache(tgz_path)
+            services.get_cached_sd(tgz_path, 'Patient', 'http://example.org/StructureDefinition/cached')
+            self.assertEqual(mock_find.call_count, 2)
+        stats = services.get_sd_cache_stats()
+        self.assertEqual(stats['hits'] - before['hits'], 1)
+        self.assertEqual(stats['misses'] - before['misses'], 2)
+        self.assertEqual(stats['entries'], 1)
+
+    def test_67_compiled_profile_validator(self):
+        sd_data = {
+            'resourceType': 'StructureDefinition', 'id': 'compiled', 'type': 'Patient', 'url': 'http://example.org/StructureDefinition/compiled',
+            'snapshot': {'element': [
+                {'path': 'Patient'},
+                {'path': 'Patient.identifier', 'min': 1, 'slicing': {'discriminator': [{'type': 'value', 'path': 'system'}]}},
+                {'path': 'Patient.name', 'mustSupport': True},
+                {'path': 'Patient.gender'}
+            ]}
+        }
+        validator = services.CompiledProfileValidator(sd_data)
+        self.assertEqual(len(validator.checks), 2)
+        self.assertEqual((validator.required_count, validator.must_support_count, validator.slicing_count), (1, 1, 1))
+        for resource, expected_errors, expected_warnings in [
+            ({'resourceType': 'Patient', 'id': 'a', 'identifier': [{'system': 'urn:a'}], 'name': [{'family': 'A'}]}, [], []),
+            ({'resourceType': 'Patient', 'id': 'b'}, ['Required element Patient.identifier missing'], ['Must Support element Patient.name missing or empty']),
+        ]:
+            result = {'valid': True, 'errors': [], 'warnings': [], 'details': [], 'profile': sd_data['url']}
+            validator.validate(resource, result)
+            self.assertEqual(result['errors'], expected_errors)
+            self.assertEqual(result['warnings'], expected_warnings)
+            self.assertEqual(result['valid'], not expected_errors)
+        tgz_path = self.create_mock_tgz("compiled.test-1.0.tgz", {'package/package.json': {'name': 'compiled.test', 'version': '1.0'}})
+        first = services.get_compiled_validator(tgz_path, sd_data, 'package/StructureDefinition-compiled.json')
+        self.assertIs(services.get_compiled_validator(tgz_path, sd_data, 'package/StructureDefinition-compiled.json'), first)
+        services.invalidate_sd_cache(tgz_path)
+        self.assertIsNot(services.get_compiled_validator(tgz_path, sd_data, 'package/StructureDefinition-compiled.json'), first)
+
+    def test_68_parallel_bundle_validation_matches_serial(self):
+        pkg_name = 'parallel.test'
+        pkg_version = '1.0'
+        self.create_mock_tgz(f"{pkg_name}-{pkg_version}.tgz", {
+            'package/package.json': {'name': pkg_name, 'version': pkg_version},
+            'package/StructureDefinition-patient.json': {
+                'resourceType': 'StructureDefinition', 'id': 'patient', 'type': 'Patient', 'url': 'http://example.org/StructureDefinition/patient',
+                'snapshot': {'element': [{'path': 'Patient'}, {'path': 'Patient.name', 'min': 1}, {'path': 'Patient.gender', 'mustSupport': True}]}
+            }
+        })
+        bundle = {'resourceType': 'Bundle', 'type': 'collection', 'entry': [
+            {'resource': {'resourceType': 'Patient', 'id': f'p{i}', 'name': [{'family': 'X'}] if i % 2 else [], 'managingOrganization': {'reference': f'Organization/o{i}'}}}
+            for i in range(12)
+        ]}
+        serial = services.validate_bundle_against_profile(pkg_name, pkg_version, bundle, max_workers=1)
+        parallel = services.validate_bundle_against_profile(pkg_name, pkg_version, bundle, max_workers=4)
+        self.assertEqual(list(parallel['results'].keys()), [f'Patient/p{i}' for i in range(12)])
+        self.assertEqual(parallel['errors'], serial['errors'])
+        self.assertEqual(parallel['details'], serial['details'])
+        self.assertEqual(parallel['warnings'], serial['warnings'])
+        self.assertEqual(parallel['summary']['failed_resources'], 6)
+        self.assertEqual({k: v for k, v in parallel['summary'].items() if k != 'profiles_validated'},
+                         {k: v for k, v in serial['summary'].items() if k != 'profiles_validated'})
+
+    @patch('services.get_http_session')
+    def test_69_batch_validate_with_hapi(self, mock_get_session):
+        profile = 'http://example.org/StructureDefinition/batch-patient'
+        resources = [
+            {'resourceType': 'Patient', 'id': 'a', 'meta': {'profile': [profile]}},
+            {'resourceType': 'Patient', 'id': 'b'},
+            {'resourceType': 'Patient', 'id': 'c', 'meta': {'profile': [profile]}}
+        ]
+        mock_get_session.return_value.post.return_value = MagicMock(status_code=200, json=lambda: {
+            'resourceType': 'Bundle', 'type': 'batch-response', 'entry': [
+                {'resource': {'resourceType': 'OperationOutcome', 'issue': [{'severity': 'warning', 'diagnostics': 'warn a'}]}, 'response': {'status': '200 OK'}},
+                {'response': {'status': '412 Precondition Failed'}}
+            ]
+        })
+        outcomes = services.batch_validate_with_hapi(resources, batch_size=10)
+        mock_get_session.return_value.post.assert_called_once()
+        sent_bundle = mock_get_session.return_value.post.call_args.kwargs['json']
+        self.assertEqual(sent_bundle['type'], 'batch')
+        self.assertEqual([e['request']['url'] for e in sent_bundle['entry']], ['Patient/$validate', 'Patient/$validate'])
+        self.assertEqual(outcomes[0]['issue'][0]['diagnostics'], 'warn a')
+        self.assertIsNone(outcomes[1])
+        self.assertIsInstance(outcomes[2], requests.HTTPError)
+        mock_get_session.return_value.post.reset_mock()
+        result = services.validate_resource_against_profile('batch.test', '1.0', resources[0], hapi_outcome=outcomes[0])
+        mock_get_session.return_value.post.assert_not_called()
+        self.assertTrue(result['valid'])
+        self.assertEqual(result['warnings'], ['warn a'])
+        self.assertEqual(services.batch_validate_with_hapi(resources, batch_size=1), [None, None, None])
+
+    @patch('services.get_http_session')
+    def test_70_concurrent_dependency_import(self, mock_get_session):
+        graph = {'root.pkg': {'dep.a': '1.0', 'dep.b': '1.0'}, 'dep.a': {'dep.c': '1.0'}, 'dep.b': {'dep.c': '1.0'}, 'dep.c': {}}
+        tgz_bytes = {}
+        for name, deps in graph.items():
+            path = self.create_mock_tgz(f"build-{name}.tgz", {'package/package.json': {'name': name, 'version': '1.0', 'dependencies': deps}})
+            with open(path, 'rb') as f:
+                tgz_bytes[name] = f.read()
+            os.remove(path)
+
+        def fake_get(url, timeout=None, stream=False):
+            name = url.rstrip('/').split('/')[-2]
+            response = MagicMock()
+            response.__enter__.return_value = response
+            if name == 'dep.c':
+                response.raise_for_status.side_effect = requests.exceptions.HTTPError("500 Server Error", response=MagicMock(status_code=500))
+            response.iter_content.return_value = [tgz_bytes[name][:10], tgz_bytes[name][10:]]
+            return response
+        mock_get_session.return_value.get.side_effect = fake_get
+
+        results = services.import_package_and_dependencies('root.pkg', '1.0', dependency_mode='recursive')
+        self.assertEqual(set(results['downloaded']), {('root.pkg', '1.0'), ('dep.a', '1.0'), ('dep.b', '1.0')})
+        self.assertEqual(results['all_dependencies'][('root.pkg', '1.0')], graph['root.pkg'])
+        self.assertEqual(len(results['errors']), 1)
+        self.assertIn('dep.c#1.0', results['errors'][0])
+        self.assertEqual(mock_get_session.return_value.get.call_count, 4)
+        leftovers = [f for f in os.listdir(self.test_packages_dir) if f.endswith('.part') or f.startswith('dep.c')]
+        self.assertEqual(leftovers, [])
+
+    def test_71_shared_package_cache(self):
+        shared_dir = os.path.join(self.test_packages_dir, 'shared-cache')
+        tgz_path = self.create_mock_tgz('shared.pkg-2.0.tgz', {
+            'package/package.json': {'name': 'shared.pkg', 'version': '2.0', 'dependencies': {'hl7.fhir.r4.core': '4.0.1'}},
+            'package/StructureDefinition-shared.json': {'resourceType': 'StructureDefinition', 'id': 'shared'}
+        })
+        with patch.dict(app.config, {'FHIR_SHARED_PACKAGE_CACHE': shared_dir}):
+            services.publish_package_to_shared_cache('shared.pkg', '2.0', tgz_path)
+            self.assertTrue(os.path.isfile(os.path.join(shared_dir, 'shared.pkg#2.0', 'package', 'StructureDefinition-shared.json')))
+            os.remove(tgz_path)
+            with patch('services.get_http_session', side_effect=AssertionError("registry should not be contacted")), \
+                 patch('services.build_package_member_index', wraps=services.build_package_member_index) as mock_build_index:
+                save_path, errors = services.download_package('shared.pkg', '2.0')
+        self.assertEqual(errors, [])
+        mock_build_index.assert_called_once_with(tgz_path)  # The restored archive is hashed and scanned once
+        self.assertEqual(save_path, tgz_path)
+        self.assertEqual(services.extract_dependencies(save_path), ({'hl7.fhir.r4.core': '4.0.1'}, None))
+        # Locks and temporary entries stay out of the cache root, and the package store reads the shared files in place
+        self.assertEqual(sorted(os.listdir(shared_dir)), ['.fhirflare', 'shared.pkg#2.0'])
+        store_dir = services.get_extracted_package_dir(save_path, extract=False)
+        self.assertEqual(os.path.realpath(os.path.join(store_dir, 'package')), os.path.realpath(os.path.join(shared_dir, 'shared.pkg#2.0', 'package')))
+        with patch.dict(app.config, {'FHIR_SHARED_PACKAGE_CACHE': ''}):
+            self.assertFalse(services.restore_package_from_shared_cache('shared.pkg', '2.0', tgz_path))
+
+    @patch('services.get_http_session')
+    def test_72_incremental_registry_refresh(self, mock_get_http_session):
+        mock_get = mock_get_http_session.return_value.get
+        from app import perform_cache_refresh_and_log, CachedPackage, RegistryFeedState
+        feed_url = 'https://example.org/feed.json'
+        bodies = {
+            services.FEED_REGISTRY_URL: {'feeds': [{'name': 'Example', 'url': feed_url}]},
+            feed_url: {'packages': [{'name': 'example.pkg', 'version': '1.0.0', 'author': 'A', 'fhirVersion': '4.0.1',
+                                     'versions': [{'version': '1.0.0', 'pubDate': '2024-01-01'}]}]}
+        }
+
+        def fake_get(url, timeout=None, headers=None, stream=False):
+            if headers and headers.get('If-None-Match') == f'"etag-{url}"':
+                return MagicMock(status_code=304, headers={})
+            body = json.dumps(bodies[url])
+            return MagicMock(status_code=200, text=body, iter_content=lambda chunk_size: iter([body.encode()]), headers={'ETag': f'"etag-{url}"'})
+        mock_get.side_effect = fake_get
+
+        def clear_tables():
+            for model in (CachedPackage, RegistryFeedState):
+                model.query.delete()
+            db.session.commit()
+        clear_tables()
+        self.addCleanup(clear_tables)
+
+        perform_cache_refresh_and_log()
+        rows = CachedPackage.query.all()
+        self.assertEqual([(r.package_name, r.version, r.author) for r in rows], [('example.pkg', '1.0.0', 'A')])
+        self.assertEqual(RegistryFeedState.query.count(), 2)
+        first_row_id = rows[0].id
+
+        mock_get.reset_mock()
+        perform_cache_refresh_and_log()
+        self.assertEqual(mock_get.call_count, 2)
+        for call_args in mock_get.call_args_list:
+            self.assertIn('If-None-Match', call_args.kwargs['headers'])
+        db.session.expire_all()
+        rows = CachedPackage.query.all()
+        self.assertEqual([(r.id, r.package_name) for r in rows], [(first_row_id, 'example.pkg')])
+        self.assertEqual(app.config['MANUAL_PACKAGE_CACHE'][0]['name'], 'example.pkg')
+
+        bodies[feed_url]['packages'][0]['author'] = 'B'
+        perform_cache_refresh_and_log(full_refresh=True)
+        db.session.expire_all()
+        self.assertEqual([(r.id, r.author) for r in CachedPackage.query.all()], [(first_row_id, 'B')])
+
+    @patch('services.get_http_session')
+    def test_73_parallel_feed_fetch_with_timing_report(self, mock_get_http_session):
+        mock_get = mock_get_http_session.return_value.get
+        import threading
+        feeds = [{'name': f'Feed{i}', 'url': f'https://example.org/feed{i}.json'} for i in range(3)]
+        barrier = threading.Barrier(3, timeout=5)
+
+        def fake_get(url, timeout=None, headers=None, stream=False):
+            if url == services.FEED_REGISTRY_URL:
+                return MagicMock(status_code=200, text=json.dumps({'feeds': feeds}), headers={})
+            barrier.wait() # Only passes if all three feeds are requested concurrently
+            if url.endswith('feed2.json'):
+                raise requests.exceptions.Timeout("read timed out")
+            index = url[-6]
+            body = json.dumps({'packages': [{'name': 'shared.pkg', 'version': f'{index}.0.0'}]})
+            return MagicMock(status_code=200, text=body, content=body.encode(), iter_content=lambda chunk_size: iter([body.encode()]), headers={})
+        mock_get.side_effect = fake_get
+
+        with patch.dict(app.config, {'REGISTRY_FEED_MAX_WORKERS': 3}), self.assertLogs('services', level='INFO') as logs:
+            packages = services.fetch_packages_from_registries()
+        self.assertEqual(len(packages), 1)
+        self.assertEqual([v['version'] for v in packages[0]['versions']], ['0.0.0', '1.0.0'])
+        report_lines = [line for line in logs.output if 'status=' in line]
+        self.assertEqual(len(report_lines), 3)
+        self.assertTrue(any('Feed2: status=timeout' in line for line in report_lines))
+        self.assertTrue(any('Feed timing report (3 feeds' in line for line in logs.output))
+
+    def test_74_cache_packages_bulk_upsert(self):
+        from app import CachedPackage
+
+        def clear_table():
+            CachedPackage.query.delete()
+            db.session.commit()
+        clear_table()
+        self.addCleanup(clear_table)
+
+        def package(name, author):
+            return {'name': name, 'version': '1.0.0', 'author': author, 'fhir_version': '4.0.1', 'version_count': 1, 'url': '',
+                    'all_versions': [{'version': '1.0.0', 'pubDate': ''}], 'dependencies': [], 'latest_absolute_version': '1.0.0',
+                    'latest_official_version': '1.0.0', 'canonical': '', 'registry': ''}
+        services.cache_packages([package('bulk.a', 'A'), package('bulk.b', 'B')], db, CachedPackage)
+        services.cache_packages([package('bulk.a', 'A2'), package('bulk.c', 'C'), package('bulk.c', 'C2')], db, CachedPackage)
+        db.session.expire_all()
+        rows = {(r.package_name, r.author, r.version_count) for r in CachedPackage.query.all()}
+        self.assertEqual(rows, {('bulk.a', 'A2', 1), ('bulk.b', 'B', 1), ('bulk.c', 'C2', 1)})
+        self.assertEqual(CachedPackage.query.filter_by(package_name='bulk.a').one().all_versions, [{'version': '1.0.0', 'pubDate': ''}])
+
+    def test_75_package_catalog_search_and_dependents(self):
+        packages = [
+            {'name': 'hl7.fhir.au.core', 'author': 'HL7 Australia', 'latest_absolute_version': '1.1.0-preview', 'latest_official_version': '1.0.0',
+             'dependencies': [{'name': 'hl7.fhir.au.base', 'version': '5.0.0'}], 'all_versions': [{'version': '1.0.0', 'pubDate': ''}]},
+            {'name': 'hl7.fhir.au.base', 'author': 'HL7 Australia', 'latest_absolute_version': '5.0.0', 'latest_official_version': None,
+             'dependencies': [{'name': 'hl7.fhir.r4.core', 'version': '4.0.1'}], 'all_versions': [{'version': '5.0.0', 'pubDate': ''}]},
+            {'name': 'example.ips', 'author': 'Example Org', 'latest_absolute_version': '2.0.0', 'latest_official_version': '2.0.0',
+             'dependencies': [{'name': 'HL7.FHIR.AU.BASE', 'version': '5.0.0'}], 'all_versions': [{'version': '2.0.0', 'pubDate': ''}]},
+        ]
+        self.addCleanup(app.config.pop, 'PACKAGE_CATALOG', None)
+        self.addCleanup(app.config.__setitem__, 'MANUAL_PACKAGE_CACHE', app.config.get('MANUAL_PACKAGE_CACHE'))
+        with app.test_request_context():
+            catalog = services.publish_package_catalog(packages)
+            self.assertIs(services.get_package_catalog(), catalog)
+            for term in ['', 'a', 'au', 'fhir', 'au.co', 'australia', 'example org', 'missing']:
+                expected = [p['name'] for p in packages if term in p['name'].lower() or term in p['author'].lower()]
+                self.assertEqual([p['name'] for p in catalog.search(term)], expected, term)
+            self.assertEqual([p['name'] for p in catalog.get('HL7.FHIR.AU.CORE')], ['hl7.fhir.au.core'])
+            self.assertEqual([d['name'] for d in catalog.dependents('hl7.fhir.au.base')], ['hl7.fhir.au.core', 'example.ips'])
+            self.assertEqual(catalog.get('hl7.fhir.au.base')[0]['display_version'], '5.0.0')
+            self.assertNotIn('display_version', packages[0])
+            # Replacing the cache list without publishing rebuilds the catalog on next access
+            app.config['MANUAL_PACKAGE_CACHE'] = packages[:1]
+            self.assertEqual(len(services.get_package_catalog()), 1)
+        app.config['MANUAL_PACKAGE_CACHE'] = packages
+        response = self.client.get('/api/search-packages?search=AUSTRALIA')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'hl7.fhir.au.core', response.data)
+        self.assertNotIn(b'example.ips', response.data)
+        response = self.client.get('/dependents/hl7.fhir.au.base')
+        self.assertIn(b'example.ips', response.data)
+
+    def test_76_dependency_graph_transitive_and_persisted(self):
+        from app import CachedPackage, PackageDependency, load_package_dependency_graph, save_package_dependency_graph, publish_cached_package_catalog
+
+        def clear_tables():
+            CachedPackage.query.delete()
+            PackageDependency.query.delete()
+            db.session.commit()
+        clear_tables()
+        self.addCleanup(clear_tables)
+        self.addCleanup(app.config.pop, 'PACKAGE_CATALOG', None)
+        self.addCleanup(app.config.__setitem__, 'MANUAL_PACKAGE_CACHE', app.config.get('MANUAL_PACKAGE_CACHE'))
+
+        def package(name, *dependencies):
+            return {'name': name, 'version': '1.0.0', 'author': 'Graph', 'fhir_version': '4.0.1', 'version_count': 1, 'url': '',
+                    'all_versions': [{'version': '1.0.0', 'pubDate': ''}], 'latest_absolute_version': '1.0.0',
+                    'latest_official_version': '1.0.0', 'canonical': '', 'registry': '',
+                    'dependencies': [{'name': dependency, 'version': '1.0.0'} for dependency in dependencies]}
+        packages = [package('graph.core'), package('graph.base', 'graph.core'), package('graph.ig', 'Graph.Base'), package('graph.other', 'graph.ig', 'graph.core')]
+        graph = services.PackageDependencyGraph.from_packages(packages)
+        self.assertEqual(graph.dependents('graph.core'), ['graph.base', 'graph.other'])
+        self.assertEqual(graph.dependents('GRAPH.CORE', transitive=True), ['graph.base', 'graph.ig', 'graph.other'])
+        self.assertEqual(graph.dependencies('graph.other', transitive=True), ['graph.base', 'graph.core', 'graph.ig'])
+
+        services.cache_packages(packages, db, CachedPackage)
+        save_package_dependency_graph(graph)
+        db.session.commit()
+        restored = load_package_dependency_graph()
+        self.assertEqual(sorted(restored.edges()), sorted(graph.edges()))
+        # Saving again only touches edges that changed
+        self.assertEqual(save_package_dependency_graph(graph), {'added': 0, 'updated': 0, 'removed': 0, 'unchanged': 4})
+        changed = services.PackageDependencyGraph.from_packages(packages[:3] + [package('graph.other', 'graph.ig')])
+        self.assertEqual(save_package_dependency_graph(changed), {'added': 0, 'updated': 0, 'removed': 1, 'unchanged': 3})
+        db.session.commit()
+        self.assertEqual(sorted(load_package_dependency_graph().edges()), sorted(changed.edges()))
+        save_package_dependency_graph(graph)
+        db.session.commit()
+
+        # A restarted process serves dependents from the database without refetching
+        app.config['MANUAL_PACKAGE_CACHE'] = None
+        publish_cached_package_catalog()
+        response = self.client.get('/dependents/graph.core?transitive=true')
+        self.assertIn(b'graph.ig', response.data)
+        response = self.client.get('/dependents/graph.core')
+        self.assertNotIn(b'graph.ig', response.data)
+
+    def test_77_version_sort_key_matches_parsed_versions(self):
+        versions = ['1.0.0', '1.0.0-ballot', '1.0.0-ballot2', '1.0.0-snapshot', '1.0.0-cibuild', '1.0.0-rc1',
+                    '1.0', '1.0.0.dev1', '1.0.0.post1', '1.0.0+local.1', '2.0.0a1', 'current', None, '0.1.0', '1!0.1']
+        self.assertEqual(sorted(versions, key=services.version_sort_key), sorted(versions, key=services.safe_parse_version))
+        self.assertEqual(services.version_sort_key('1.0'), services.version_sort_key('1.0.0'))
+        self.assertLess(services.version_sort_key('1.0.0-cibuild'), services.version_sort_key('1.0.0-ballot'))
+        self.assertLess(services.version_sort_key('1.0.0-ballot'), services.version_sort_key('1.0.0-ballot2'))
+        self.assertLess(services.version_sort_key('1.0.0-ballot2'), services.version_sort_key('1.0.0'))
+        hits_before = services._interned_version.cache_info().hits
+        services.version_sort_key('1.0.0-ballot2')
+        services.safe_parse_version('1.0.0-ballot2')
+        self.assertEqual(services._interned_version.cache_info().hits, hits_before + 2)
+
+    def test_78_streaming_feed_parser(self):
+        feed = {'name': 'Stream', 'url': 'https://example.org/package-feed.xml'}
+        rss = (b'<?xml version="1.0"?><rss xmlns:fhir="http://hl7.org/fhir/feed" xmlns:dc="http://purl.org/dc/elements/1.1/" version="2.0"><channel>'
+               + b''.join(f'<item><title>stream.pkg{i}#1.0.{i}</title><link>https://example.org/{i}.tgz</link><dc:creator>HL7</dc:creator>'
+                          f'<fhir:version>4.0.1</fhir:version><pubDate>Mon, 01 Jan 2024 00:00:00 GMT</pubDate></item>'.encode() for i in range(50))
+               + b'</channel></rss>')
+        response = MagicMock(iter_content=lambda chunk_size: (rss[i:i + 100] for i in range(0, len(rss), 100)))
+        entries, stream = services.iter_feed_packages(feed, response, search_term='pkg4')
+        packages = list(entries)
+        self.assertEqual([p['name'] for p in packages], ['stream.pkg4'] + [f'stream.pkg{i}' for i in range(40, 50)])
+        self.assertEqual((packages[0]['version'], packages[0]['author'], packages[0]['fhirVersion'], packages[0]['url']),
+                         ('1.0.4', 'HL7', '4.0.1', 'https://example.org/4.tgz'))
+        self.assertEqual(stream.bytes_read, len(rss))
+
+        body = json.dumps({'packages': [{'name': 'json.pkg', 'version': '1.0.0'}, {'version': 'nameless'}]}).encode()
+        entries, _ = services.iter_feed_packages(feed, MagicMock(iter_content=lambda chunk_size: iter([body[:10], body[10:]])))
+        self.assertEqual([p['name'] for p in entries], ['json.pkg'])
+        with patch('services.ijson', None):
+            entries, stream = services.iter_feed_packages(feed, MagicMock(iter_content=lambda chunk_size: (body[i:i + 7] for i in range(0, len(body), 7))))
+            self.assertEqual([p['name'] for p in entries], ['json.pkg'])
+        self.assertEqual(stream.bytes_read, len(body))
+
+        # A feed the incremental parser rejects is refetched and parsed in full
+        broken = b'<rss><channel><item><title>loose.pkg#1.0.0&nbsp;</title></item></channel></rss>'
+        responses = [MagicMock(status_code=200, iter_content=lambda chunk_size: iter([broken]), headers={}),
+                     MagicMock(status_code=200, text=broken.decode(), content=broken, headers={})]
+        with patch('services.get_http_session') as mock_get_http_session:
+            mock_get_http_session.return_value.get.side_effect = responses
+            packages, report = services._fetch_feed(feed, {})
+        self.assertEqual(report['status'], 200)
+        self.assertEqual(len(packages), 1)
+        self.assertTrue(packages[0]['name'].startswith('loose.pkg'))
+
+    def test_79_shared_http_session_pools_and_metrics(self):
+        services.reset_http_session()
+        self.addCleanup(services.reset_http_session)
+        with patch.dict(app.config, {'HTTP_POOL_MAXSIZE': 7, 'HTTP_MAX_RETRIES': 2, 'HTTP_CONNECT_TIMEOUT': 3}):
+            session = services.get_http_session()
+        self.assertIs(services.get_http_session(), session)
+        adapter = session.get_adapter('https://packages.fhir.org')
+        self.assertEqual(adapter._pool_maxsize, 7)
+        self.assertEqual(adapter.max_retries.total, 2)
+        self.assertIn(503, adapter.max_retries.status_forcelist)
+        self.assertNotIn('POST', adapter.max_retries.allowed_methods)
+
+        sent = {}
+        def fake_send(prepared, **kwargs):
+            sent['timeout'] = kwargs.get('timeout')
+            response = requests.Response()
+            response.status_code = 200
+            response.url = prepared.url
+            response.headers['Set-Cookie'] = 'JSESSIONID=abc; Path=/'
+            return response
+        with patch.object(adapter, 'send', side_effect=fake_send):
+            session.get('https://stats.example.org/fhir/metadata', timeout=30)
+        with patch.object(adapter, 'send', side_effect=requests.ConnectionError("down")):
+            with self.assertRaises(requests.ConnectionError):
+                session.get('https://stats.example.org/fhir/metadata', timeout=30)
+        self.assertEqual(sent['timeout'], (3.0, 30))
+        self.assertEqual(len(session.cookies), 0)
+        stats = services.get_http_client_stats()['stats.example.org']
+        self.assertEqual((stats['requests'], stats['errors']), (2, 1))
+        response = self.client.get('/api/http-client-stats')
+        self.assertIn('stats.example.org', json.loads(response.data))
+
+    def test_80_streaming_fhir_proxy(self):
+        body = json.dumps({'resourceType': 'Bundle', 'entry': [{'fullUrl': f'urn:uuid:{i}'} for i in range(200)]}).encode()
+        upstream = requests.Response()
+        upstream.status_code = 200
+        upstream.raw = io.BytesIO(body)
+        upstream.headers['Content-Type'] = 'application/fhir+json'
+        upstream.headers['Content-Length'] = str(len(body))
+        upstream.close = MagicMock(wraps=upstream.close)
+        forwarded = {}
+        def fake_request(**kwargs):
+            forwarded.update(kwargs)
+            forwarded['body'] = b''.join(kwargs['data'])
+            return upstream
+        payload = json.dumps({'resourceType': 'Patient', 'id': 'p1'}).encode()
+        with patch('app.get_http_session') as mock_get_http_session, \
+             patch.dict(app.config, {'FHIR_PROXY_STREAMING': True, 'FHIR_PROXY_CHUNK_SIZE': 512}):
+            mock_get_http_session.return_value.request.side_effect = fake_request
+            response = self.client.put('/fhir/Patient/p1', data=payload, content_type='application/fhir+json')
+            self.assertTrue(response.is_streamed)
+            self.assertEqual(response.data, body)
+        self.assertTrue(forwarded['stream'])
+        self.assertEqual(forwarded['data'].len, len(payload))
+        self.assertEqual(forwarded['body'], payload)
+        self.assertEqual(response.headers['Content-Length'], str(len(body)))
+        self.assertEqual(response.headers['Content-Type'], 'application/fhir+json')
+        self.assertFalse(upstream._content)
+        upstream.close.assert_called_once()
+
+    def test_81_proxy_response_cache(self):
+        services.reset_proxy_cache()
+        self.addCleanup(services.reset_proxy_cache)
+        def upstream(status, body=b'', **headers):
+            response = requests.Response()
+            response.status_code = status
+            response.raw = io.BytesIO(body)
+            response.headers.update(headers)
+            return response
+        metadata = json.dumps({'resourceType': 'CapabilityStatement'}).encode()
+        patient = json.dumps({'resourceType': 'Patient', 'id': 'p1'}).encode()
+        with patch('app.get_http_session') as mock_get_http_session, patch.dict(app.config, {'FHIR_PROXY_CACHE_ENABLED': True}):
+            mock_request = mock_get_http_session.return_value.request
+            mock_request.side_effect = [
+                upstream(200, metadata, **{'Content-Type': 'application/fhir+json', 'Cache-Control': 'max-age=300', 'ETag': 'W/"1"'}),
+                upstream(200, patient, **{'Content-Type': 'application/fhir+json', 'Cache-Control': 'no-cache', 'ETag': 'W/"3"'}),
+                upstream(304, ETag='W/"3"'),
+                upstream(200, metadata, **{'Cache-Control': 'max-age=300'}),
+                upstream(200, b'{}', **{'Content-Type': 'application/fhir+json'}),
+                upstream(200, patient, **{'Cache-Control': 'no-cache', 'ETag': 'W/"4"'}),
+                upstream(200, metadata, **{'Cache-Control': 'max-age=300', 'Set-Cookie': 'session=first'}),
+                upstream(200, metadata, **{'Cache-Control': 'max-age=300', 'Set-Cookie': 'session=second'}),
+            ]
+            first = self.client.get('/fhir/metadata')
+            self.assertEqual((first.headers['X-Cache'], first.data), ('MISS', metadata))
+            second = self.client.get('/fhir/metadata')
+            self.assertEqual((second.headers['X-Cache'], second.data), ('HIT', metadata))
+            self.assertEqual(second.headers['Content-Type'], 'application/fhir+json')
+            self.assertEqual(mock_request.call_count, 1)
+
+            miss = self.client.get('/fhir/Patient/p1')
+            self.assertEqual((miss.headers['X-Cache'], miss.data), ('MISS', patient))
+            revalidated = self.client.get('/fhir/Patient/p1')
+            self.assertEqual((revalidated.headers['X-Cache'], revalidated.data), ('REVALIDATED', patient))
+            self.assertEqual(mock_request.call_args.kwargs['headers']['If-None-Match'], 'W/"3"')
+
+            # Auth is part of the key, and writes invalidate cached reads of the resource type
+            other_user = self.client.get('/fhir/metadata', headers={'Authorization': 'Bearer other'})
+            self.assertEqual((other_user.headers['X-Cache'], other_user.data), ('MISS', metadata))
+            self.assertEqual(self.client.put('/fhir/Patient/p1', data=patient, content_type='application/fhir+json').status_code, 200)
+            after_write = self.client.get('/fhir/Patient/p1')
+            self.assertEqual(after_write.headers['X-Cache'], 'MISS')
+            self.assertNotIn('If-None-Match', mock_request.call_args.kwargs['headers'])
+            self.assertEqual(mock_request.call_count, 6)
+            stats = json.loads(self.client.get('/api/proxy-cache-stats').data)
+            self.assertEqual((stats['hits'], stats['revalidated'], stats['invalidated']), (1, 1, 1))
+
+            # Responses that set a cookie are relayed but never replayed to other clients
+            for expected_cookie in ('session=first', 'session=second'):
+                with_cookie = self.client.get('/fhir/CodeSystem/c1')
+                self.assertEqual((with_cookie.headers['X-Cache'], with_cookie.headers['Set-Cookie'], with_cookie.data), ('MISS', expected_cookie, metadata))
+
+        self.assertIsNone(services.proxy_cache_lifetime({'Cache-Control': 'no-store', 'ETag': 'x'}))
+        self.assertIsNone(services.proxy_cache_lifetime({'Cache-Control': 'max-age=0'}))
+        self.assertIsNone(services.proxy_cache_lifetime({'Cache-Control': 'max-age=60', 'Set-Cookie': 'session=abc'}))
+        self.assertEqual(services.proxy_cache_lifetime({'Cache-Control': 'max-age=60', 'Age': '20'}), 40)
+        spill_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spill_dir, True)
+        cache = services.ProxyResponseCache(max_bytes=3000, max_entry_bytes=3000, spill_dir=spill_dir)
+        for i in range(2):
+            cache.store(f'k{i}', services.build_proxy_cache_entry(f'http://x/fhir/Patient/{i}', 200, {}, {}, b'x' * 1000, {}, 60))
+        self.assertEqual(cache.get_stats()['spilled_entries'], 1)
+        self.assertEqual(cache.lookup('k0', {})['body'], b'x' * 1000)
+        self.assertEqual(cache.get_stats()['spilled_entries'], 1)
+        self.assertEqual(cache.invalidate('http://x/fhir/Patient'), 2)
+        self.assertEqual(os.listdir(spill_dir), [])
+
+    def test_82_retrieve_bundles_follows_next_links(self):
+        proxy, hapi = 'http://localhost:5000/fhir', 'http://localhost:8080/fhir'
+        def page(resources, next_url=None):
+            bundle = {'resourceType': 'Bundle', 'type': 'searchset', 'entry': [{'resource': r} for r in resources]}
+            if next_url:
+                bundle['link'] = [{'relation': 'self', 'url': 'ignored'}, {'relation': 'next', 'url': next_url}]
+            return MagicMock(status_code=200, json=MagicMock(return_value=bundle))
+        pages = {
+            f'{proxy}/Patient?_count=2': page([{'resourceType': 'Patient', 'id': 'p1'}, {'resourceType': 'Patient', 'id': 'p2'}],
+                                               f'{hapi}?_getpages=abc&_getpagesoffset=2&_count=2'),
+            f'{proxy}?_getpages=abc&_getpagesoffset=2&_count=2': page([{'resourceType': 'Patient', 'id': 'p3', 'managingOrganization': {'reference': 'Organization/o1'}}],
+                                                                       f'{hapi}?_getpages=abc&_getpagesoffset=4&_count=2'),
+            f'{proxy}/Organization?_id=o1&_count=1': page([{'resourceType': 'Organization', 'id': 'o1'}]),
+        }
+        requested = []
+        def fake_get(url, **kwargs):
+            requested.append(url)
+            return pages[url]
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir, True)
+        with patch('services.get_http_session') as mock_get_http_session:
+            mock_get_http_session.return_value.get.side_effect = fake_get
+            for page_format in ('bundle', 'ndjson'):
+                output_zip = os.path.join(temp_dir, f'{page_format}.zip')
+                messages = [json.loads(line) for line in services.retrieve_bundles('/fhir', ['Patient'], output_zip, validate_references=True,
+                                                                                 page_size=2, max_pages=2, page_format=page_format, direct=False)]
+                self.assertTrue(any('Stopped Patient after 2 pages' in m['message'] for m in messages))
+                self.assertFalse([m for m in messages if m['type'] == 'error'])
+                with zipfile.ZipFile(output_zip) as zipf:
+                    names = sorted(zipf.namelist())
+                    if page_format == 'bundle':
+                        self.assertEqual(names, ['Patient_bundle.json', 'Patient_bundle_p2.json', 'ref_Organization_o1.json'])
+                        self.assertEqual(json.loads(zipf.read('Patient_bundle_p2.json'))['entry'][0]['resource']['id'], 'p3')
+                    else:
+                        self.assertEqual(names, ['Organization.ndjson', 'Patient.ndjson'])
+                        self.assertEqual([json.loads(line)['id'] for line in zipf.read('Patient.ndjson').splitlines()], ['p1', 'p2', 'p3'])
+        self.assertEqual(requested, list(pages) * 2)
+
+        # References are deduplicated page by page instead of after the whole export
+        references = set()
+        ref_pages = [(n, {'entry': [{'resource': {'resourceType': 'Observation', 'id': f'o{n}', 'subject': {'reference': 'Patient/p1'},
+                                                   'contained': [{'reference': '#c1'}]}}]}) for n in (1, 2)]
+        with zipfile.ZipFile(io.BytesIO(), 'w') as zipf:
+            list(services._save_bundle_pages(iter(ref_pages), 'Observation', 'Observation_bundle', zipf, 2, references=references))
+        self.assertEqual(references, {'Patient/p1'})
+
+    def test_83_batched_concurrent_reference_resolution(self):
+        proxy = 'http://localhost:5000/fhir'
+        def bundle(*resources):
+            return MagicMock(status_code=200, json=MagicMock(return_value={'resourceType': 'Bundle', 'entry': [{'resource': r} for r in resources]}))
+        responses = {
+            f'{proxy}/Patient?_id=p1,p2&_count=2': bundle({'resourceType': 'Patient', 'id': 'p2'}, {'resourceType': 'Patient', 'id': 'p1'}),
+            f'{proxy}/Patient?_id=p3&_count=1': bundle(),
+            f'{proxy}/Practitioner?_id=d1&_count=1': MagicMock(status_code=500, text='boom'),
+        }
+        threads = set()
+        def fake_get(url, **kwargs):
+            threads.add(threading.current_thread().name)
+            return responses[url]
+        references = ['Patient/p3', 'Practitioner/d1', 'Patient/p1', 'Patient/p2']
+        with patch('services.get_http_session') as mock_get_http_session:
+            mock_get_http_session.return_value.get.side_effect = fake_get
+            resolved = list(services.iter_resolved_references(proxy, references, {}, batch_size=2, max_workers=3))
+        self.assertEqual(sorted(mock_get_http_session.return_value.get.call_args_list, key=str),
+                         sorted([call(url, headers={}, timeout=60) for url in responses], key=str))
+        self.assertTrue(all(name.startswith('refs') for name in threads))
+        self.assertEqual([ref for ref, _, _ in resolved], sorted(references))
+        self.assertEqual(resolved[0][1]['resource']['id'], 'p1')
+        self.assertEqual(resolved[1][1]['resource']['id'], 'p2')
+        self.assertEqual(resolved[2][1:], (None, None))
+        self.assertIsNone(resolved[3][1])
+        self.assertIn('HTTP 500', str(resolved[3][2]))
+        # Pending markers precede each batch's results, and unexpected errors stay per reference
+        responses[f'{proxy}/Practitioner?_id=d1&_count=1'] = MagicMock(status_code=200, json=MagicMock(side_effect=RuntimeError('bad body')))
+        with patch('services.get_http_session') as mock_get_http_session:
+            mock_get_http_session.return_value.get.side_effect = fake_get
+            resolved = list(services.iter_resolved_references(proxy, references, {}, batch_size=2, max_workers=3, report_pending=True))
+        self.assertEqual([(ref, entry is services.REFERENCE_PENDING) for ref, entry, _ in resolved], [
+            ('Patient/p1', True), ('Patient/p2', True), ('Patient/p1', False), ('Patient/p2', False),
+            ('Patient/p3', True), ('Patient/p3', False), ('Practitioner/d1', True), ('Practitioner/d1', False)])
+        self.assertIsInstance(resolved[-1][2], RuntimeError)
+
+    def test_84_retrieve_bundles_direct_upstream(self):
+        server = 'https://fhir.example.org/r4'
+        def page(next_url=None):
+            bundle = {'resourceType': 'Bundle', 'entry': [{'resource': {'resourceType': 'Observation', 'id': 'o1'}}]}
+            if next_url:
+                bundle['link'] = [{'relation': 'next', 'url': next_url}]
+            return MagicMock(status_code=200, json=MagicMock(return_value=bundle))
+        pages = {
+            f'{server}/Observation?_count=100': page(f'{server}/Observation?_count=100&_offset=100'),
+            f'{server}/Observation?_count=100&_offset=100': page('https://elsewhere.example.com/fhir/Observation?page=3'),
+        }
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir, True)
+        with patch('services.get_http_session') as mock_get_http_session, patch.dict(app.config, {'RETRIEVE_DIRECT_UPSTREAM': True}):
+            mock_get_http_session.return_value.get.side_effect = lambda url, **kwargs: pages[url]
+            messages = [json.loads(line) for line in services.retrieve_bundles(server, ['Observation'], os.path.join(temp_dir, 'out.zip'),
+                                                                             auth_type='bearer', auth_token='Bearer secret')]
+        requested = mock_get_http_session.return_value.get.call_args_list
+        self.assertEqual([c.args[0] for c in requested], list(pages))
+        self.assertEqual(requested[0].kwargs['headers'], {'Accept': services.FHIR_DEFAULT_ACCEPT, 'Authorization': 'Bearer secret'})
+        self.assertIn('Fetching bundle for Observation directly...', [m['message'] for m in messages])
+        self.assertTrue(any('keeping 2 page(s)' in m['message'] and 'elsewhere.example.com' in m['message'] for m in messages))
+        self.assertEqual(services.build_upstream_headers({'Host': 'app', 'X-Target-FHIR-Server': server, 'Content-Length': '5', 'Prefer': 'return=minimal'}),
+                         {'Prefer': 'return=minimal', 'Accept': services.FHIR_DEFAULT_ACCEPT})
+
+    def test_85_split_bundles_streams_between_zips(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir, True)
+        input_zip, output_zip = os.path.join(temp_dir, 'in.zip'), os.path.join(temp_dir, 'out.zip')
+        with zipfile.ZipFile(input_zip, 'w') as zipf:
+            for name, ids in (('a.json', ['p1', 'p2']), ('b.json', ['p3'])):
+                zipf.writestr(name, json.dumps({'resourceType': 'Bundle', 'entry': [{'resource': {'resourceType': 'Patient', 'id': i}} for i in ids]}, indent=2))
+            zipf.writestr('not-a-bundle.json', json.dumps({'resourceType': 'Patient'}))
+            zipf.writestr('readme.txt', 'ignored')
+        with patch('services.tempfile.mkdtemp', side_effect=AssertionError('no staging directory expected')):
+            messages = [json.loads(line) for line in services.split_bundles(input_zip, output_zip)]
+        self.assertEqual(messages[-1]['data'], {'total_resources': 3})
+        self.assertIn('Skipping not-a-bundle.json: Not a Bundle', [m['message'] for m in messages])
+        with zipfile.ZipFile(output_zip) as zipf:
+            self.assertEqual(sorted(zipf.namelist()), ['Patient-1.json', 'Patient-2.json', 'Patient-3.json'])
+            self.assertEqual(zipf.read('Patient-3.json'), b'{"resourceType":"Patient","id":"p3"}')
+
+    def test_86_read_json_bundle_yields_entries(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir, True)
+        bundle_path, resource_path = os.path.join(temp_dir, 'bundle.json'), os.path.join(temp_dir, 'patient.json')
+        entries = [{'fullUrl': f'urn:uuid:{i}', 'resource': {'resourceType': 'Observation', 'id': f'o{i}', 'valueQuantity': {'value': 1.5}}} for i in range(3)]
+        with open(bundle_path, 'wb') as f:
+            f.write(b'\xef\xbb\xbf' + json.dumps({'resourceType': 'Bundle', 'type': 'collection', 'entry': entries}).encode())
+        with open(resource_path, 'w') as f:
+            json.dump({'resourceType': 'Patient', 'id': 'p1'}, f)
+        bundle_entries, document = services.read_json_bundle(lambda: open(bundle_path, 'rb'))
+        self.assertIsNone(document)
+        self.assertEqual(list(bundle_entries), entries)
+        self.assertEqual(services.read_json_bundle(lambda: open(resource_path, 'rb')), (None, {'resourceType': 'Patient', 'id': 'p1'}))
+        with open(bundle_path, 'wb') as f:
+            f.write(b'{"resourceType": "Bundle", "entry": [')
+        with self.assertRaises(ValueError):
+            bundle_entries, _ = services.read_json_bundle(lambda: open(bundle_path, 'rb'))
+            list(bundle_entries)
+
+    def test_87_ndjson_export_and_ingest(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir, True)
+        writer = services.NdjsonExportWriter(compress=True)
+        try:
+            self.assertTrue(writer.add({'resourceType': 'Patient', 'id': 'p1'}))
+            self.assertFalse(writer.add({'resourceType': 'Patient', 'id': 'p1'}))
+            self.assertFalse(writer.add({'resourceType': '../Patient', 'id': 'p2'}))
+            self.assertTrue(writer.add({'resourceType': 'Observation', 'id': 'o1'}))
+            export_zip = os.path.join(temp_dir, 'export.zip')
+            with zipfile.ZipFile(export_zip, 'w', zipfile.ZIP_DEFLATED) as zipf:
+                self.assertEqual(writer.write_to_zip(zipf), {'Patient': 1, 'Observation': 1})
+                zipf.writestr('Encounter.ndjson', '{"resourceType": "Encounter", "id": "e1"}\nnot json\n\n')
+        finally:
+            writer.close()
+        with zipfile.ZipFile(export_zip) as zipf:
+            self.assertEqual(sorted(zipf.namelist()), ['Encounter.ndjson', 'Observation.ndjson.gz', 'Patient.ndjson.gz'])
+            self.assertEqual(zipf.getinfo('Patient.ndjson.gz').compress_type, zipfile.ZIP_STORED)
+            with zipf.open('Patient.ndjson.gz') as fp:
+                self.assertEqual(list(services.iter_ndjson_resources(fp, compressed=True)), [(1, {'resourceType': 'Patient', 'id': 'p1'})])
+        output_zip = os.path.join(temp_dir, 'split.zip')
+        messages = [json.loads(line) for line in services.split_bundles(export_zip, output_zip)]
+        self.assertEqual([m['message'] for m in messages if m['type'] == 'error'], ['Invalid resource in Encounter.ndjson at line 2'])
+        with zipfile.ZipFile(output_zip) as zipf:
+            self.assertEqual(sorted(zipf.namelist()), ['Encounter-3.json', 'Observation-1.json', 'Patient-2.json'])
+        upload_dir = os.path.join(temp_dir, 'upload')
+        os.makedirs(upload_dir)
+        with open(os.path.join(upload_dir, 'Encounter.ndjson'), 'w') as f:
+            f.write('{"resourceType": "Encounter", "id": "e1"}\n{"resourceType": "Encounter"}\n')
+        with patch('services.get_http_session') as mock_get_http_session:
+            mock_get_http_session.return_value.put.return_value = MagicMock(status_code=201, json=MagicMock(return_value={}))
+            messages = [json.loads(line) for line in services.process_and_upload_test_data(
+                {'url': 'http://fhir.example/fhir', 'auth_type': 'none'},
+                {'upload_mode': 'individual', 'error_handling': 'continue'}, upload_dir)]
+        self.assertIn('Skipping invalid line #2 in NDJSON Encounter.ndjson.', [m.get('message') for m in messages])
+        self.assertEqual(mock_get_http_session.return_value.put.call_args[0][0], 'http://fhir.example/fhir/Encounter/e1')
+
+    def test_88_push_uploads_waves_concurrently_in_order(self):
+        base = 'http://fhir.example/fhir'
+        files = {
+            'package/package.json': {'name': 'wave.pkg', 'version': '1.0.0'},
+            'package/Patient-p1.json': {'resourceType': 'Patient', 'id': 'p1'},
+            'package/StructureDefinition-sd.json': {'resourceType': 'StructureDefinition', 'id': 'sd', 'url': 'http://x/sd'},
+            'package/ValueSet-vs.json': {'resourceType': 'ValueSet', 'id': 'vs', 'url': 'http://x/vs'},
+            'package/CodeSystem-cs1.json': {'resourceType': 'CodeSystem', 'id': 'cs1', 'url': 'http://x/cs1'},
+            'package/CodeSystem-cs2.json': {'resourceType': 'CodeSystem', 'id': 'cs2', 'url': 'http://x/cs2'},
+            'package/CodeSystem-cs2-copy.json': {'resourceType': 'CodeSystem', 'id': 'cs2-copy', 'url': 'http://x/cs2'},
+        }
+        self.create_mock_tgz('wave.pkg-1.0.0.tgz', files)
+        waves = services.plan_push_waves([{'data': data} for name, data in files.items() if name != 'package/package.json'])
+        self.assertEqual([[w['data']['id'] for w in wave] for wave in waves], [['cs1', 'cs2'], ['cs2-copy'], ['vs'], ['sd'], ['p1']])
+        barrier = threading.Barrier(2, timeout=5)
+        uploads, lock = [], threading.Lock()
+        def fake_get(url, params=None, **kwargs):
+            if params:
+                return MagicMock(status_code=200, json=MagicMock(return_value={'resourceType': 'Bundle', 'entry': []}))
+            return MagicMock(status_code=404)
+        def fake_post(url, json=None, **kwargs):
+            if json['resourceType'] == 'CodeSystem' and json['id'] != 'cs2-copy':
+                barrier.wait()  # Both code systems of the first wave must be in flight together
+            with lock:
+                uploads.append(json['id'])
+            return MagicMock(status_code=201, headers={'Location': f"{url}/{json['id']}/_history/1"})
+        with patch('services.get_http_session') as mock_get_http_session:
+            mock_get_http_session.return_value.get.side_effect = fake_get
+            mock_get_http_session.return_value.post.side_effect = fake_post
+            mock_get_http_session.return_value.put.return_value = MagicMock(status_code=201)
+            messages = [json.loads(line) for line in services.generate_push_stream(
+                'wave.pkg', '1.0.0', base, False, 'none', None, None, None, False, False, False,
+                app.config['FHIR_PACKAGES_DIR'], max_workers=4)]
+        self.assertEqual(sorted(uploads[:2]), ['cs1', 'cs2'])
+        self.assertEqual(uploads[2:], ['cs2-copy', 'vs', 'sd'])
+        successes = [m['message'].split(' for ')[1].split(' ')[0] for m in messages if m['type'] == 'success']
+        self.assertEqual(successes, ['CodeSystem/cs1', 'CodeSystem/cs2', 'CodeSystem/cs2-copy', 'ValueSet/vs', 'StructureDefinition/sd', 'Patient/p1'])
+        summary = messages[-1]['data']
+        self.assertEqual((summary['status'], summary['post_count'], summary['put_count'], summary['success_count']), ('success', 5, 1, 6))
+        self.assertEqual(summary['pushed_packages_summary'], [{'id': 'wave.pkg#1.0.0', 'resource_count': 6}])
+
+    def test_89_version_sort_key_without_packaging(self):
+        fallback = SimpleNamespace(parse=str, InvalidVersion=ValueError)  # Stand-in for BasicVersion's string comparison
+        services._interned_version.cache_clear()
+        self.addCleanup(services._interned_version.cache_clear)
+        with patch('services.HAS_PACKAGING_LIB', False), patch('services.pkg_version', fallback):
+            self.assertEqual(services.version_sort_key('1.0.0'), ('1.0.0',))
+            self.assertLess(services.version_sort_key('1.0.0'), services.version_sort_key('1.1.0'))
+            normalized = services.normalize_package_data([
+                {'name': 'fallback.pkg', 'version': '1.0.0'}, {'name': 'fallback.pkg', 'version': '1.1.0'}])
+        self.assertEqual(normalized[0]['latest_absolute_version'], '1.1.0')
+
+    def test_90_proxy_does_not_retry_streamed_bodies(self):
+        received = []
+        class Upstream(http.server.BaseHTTPRequestHandler):
+            def do_PUT(self):
+                received.append(len(self.rfile.read(int(self.headers['Content-Length']))))
+                status = 503 if len(received) == 1 else 200
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/fhir+json')
+                self.send_header('Content-Length', '2')
+                self.end_headers()
+                self.wfile.write(b'{}')
+            def log_message(self, *args):
+                pass
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Upstream)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        services.reset_http_session()
+        self.addCleanup(services.reset_http_session)
+        payload = json.dumps({'resourceType': 'Patient', 'id': 'p1', 'text': 'x' * 5000}).encode()
+        upstream_url = f'http://127.0.0.1:{server.server_port}/fhir'
+        with patch.dict(app.config, {'HAPI_FHIR_URL': upstream_url, 'FHIR_PROXY_STREAMING': True}):
+            response = self.client.put('/fhir/Patient/p1', data=payload, content_type='application/fhir+json')
+            response.data
+        # The streamed body was sent once; the 503 is relayed instead of resending a consumed stream
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(received, [len(payload)])
+        received.clear()
+        with patch.dict(app.config, {'HAPI_FHIR_URL': upstream_url, 'FHIR_PROXY_STREAMING': False}):
+            response = self.client.put('/fhir/Patient/p1', data=payload, content_type='application/fhir+json')
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(received, [len(payload), len(payload)])
+
+    @patch('services.get_http_session')
+    def test_91_batch_validate_tolerates_malformed_meta(self, mock_get_session):
+        profile = 'http://example.org/StructureDefinition/batch-patient'
+        resources = [
+            {'resourceType': 'Patient', 'id': 'a', 'meta': {'profile': []}},
+            {'resourceType': 'Patient', 'id': 'b', 'meta': None},
+            {'resourceType': 'Patient', 'id': 'c', 'meta': {'profile': [profile]}}
+        ]
+        mock_get_session.return_value.post.return_value = MagicMock(status_code=200, json=lambda: {
+            'resourceType': 'Bundle', 'entry': [{'resource': {'resourceType': 'OperationOutcome', 'issue': []}, 'response': {'status': '200 OK'}}]})
+        outcomes = services.batch_validate_with_hapi(resources, batch_size=10)
+        self.assertEqual(outcomes, [None, None, {'resourceType': 'OperationOutcome', 'issue': []}])
+        self.assertIsNone(services.validate_resource_against_profile('batch.test', '1.0', resources[0], hapi_outcome=outcomes[0])['profile'])
+        with patch('services.batch_validate_with_hapi', side_effect=AttributeError('boom')):
+            self.assertEqual(services._batch_validate_or_fallback(resources, 10), [None, None, None])
+
+    def test_92_ndjson_retrieval_counts_only_new_references(self):
+        hapi = 'http://localhost:8080/fhir'
+        def page(*resources):
+            return MagicMock(status_code=200, json=MagicMock(return_value={'resourceType': 'Bundle', 'entry': [{'resource': r} for r in resources]}))
+        organization = {'resourceType': 'Organization', 'id': 'o1'}
+        pages = {
+            f'{hapi}/Patient?_count=100': page({'resourceType': 'Patient', 'id': 'p1', 'managingOrganization': {'reference': 'Organization/o1'}}),
+            f'{hapi}/Organization?_count=100': page(organization),
+            f'{hapi}/Organization?_id=o1&_count=1': page(organization),
+        }
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir, True)
+        output_zip = os.path.join(temp_dir, 'ndjson.zip')
+        with patch('services.get_http_session') as mock_get_http_session:
+            mock_get_http_session.return_value.get.side_effect = lambda url, **kwargs: pages[url]
+            messages = [json.loads(line) for line in services.retrieve_bundles('/fhir', ['Patient', 'Organization'], output_zip,
+                                                                             validate_references=True, page_format='ndjson', direct=True)]
+        self.assertIn('Referenced resource Organization/o1 already exported, skipping.', [m['message'] for m in messages])
+        self.assertFalse([m for m in messages if m['message'] == 'Saved referenced resource Organization/o1'])
+        self.assertEqual(messages[-1]['data']['fetched_individual_references'], 0)
+        with zipfile.ZipFile(output_zip) as zipf:
+            self.assertEqual(zipf.read('Organization.ndjson').decode().splitlines(), [json.dumps(organization, separators=(',', ':'))])
+
+    @unittest.skipUnless(services.ijson, "ijson not installed")
+    def test_93_feed_parser_streams_json_with_ijson(self):
+        feed = {'name': 'Json', 'url': 'https://example.org/package-feed.json'}
+        body = json.dumps({'packages': [{'name': f'json.pkg{i}', 'version': '1.0.0'} for i in range(3000)]}).encode()
+        chunks = [body[i:i + 4096] for i in range(0, len(body), 4096)]
+        response = MagicMock(iter_content=lambda chunk_size: iter(chunks))
+        entries, stream = services.iter_feed_packages(feed, response)
+        self.assertEqual(next(entries)['name'], 'json.pkg0')
+        self.assertLess(stream.bytes_read, len(body))  # The first entry arrives before the body is read
+        self.assertEqual(len(list(entries)), 2999)
+
+        truncated = body[:len(body) // 2]
+        entries, _ = services.iter_feed_packages(feed, MagicMock(iter_content=lambda chunk_size: iter([truncated])))
+        with self.assertRaises(ValueError):
+            list(entries)
+        # A JSON feed the incremental parser rejects is refetched and parsed in full
+        responses = [MagicMock(status_code=200, iter_content=lambda chunk_size: iter([truncated]), headers={}),
+                     MagicMock(status_code=200, text=body.decode(), content=body, headers={})]
+        with patch('services.get_http_session') as mock_get_http_session:
+            mock_get_http_session.return_value.get.side_effect = responses
+            packages, report = services._fetch_feed(feed, {})
+        self.assertEqual(report['status'], 200)
+        self.assertEqual(len(packages), 3000)
+
+    @unittest.skipUnless(services.ijson, "ijson not installed")
+    def test_94_read_json_bundle_streams_with_ijson(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir, True)
+        bundle_path = os.path.join(temp_dir, 'bundle.json')
+        entries = [{'resource': {'resourceType': 'Observation', 'id': f'o{i}', 'valueQuantity': {'value': 1.5}}} for i in range(3000)]
+        # resourceType after the entries still identifies a Bundle
+        with open(bundle_path, 'wb') as f:
+            f.write(b'\xef\xbb\xbf' + json.dumps({'type': 'collection', 'entry': entries, 'resourceType': 'Bundle'}).encode())
+        opened = []
+        def open_bundle():
+            opened.append(open(bundle_path, 'rb'))
+            return opened[-1]
+        bundle_entries, document = services.read_json_bundle(open_bundle)
+        self.assertIsNone(document)
+        self.assertEqual(next(bundle_entries), entries[0])
+        self.assertLess(opened[-1].tell(), os.path.getsize(bundle_path))  # Entries are parsed as the file is read
+        self.assertEqual(list(bundle_entries), entries[1:])
+
+        zip_path = os.path.join(temp_dir, 'bundles.zip')
+        with zipfile.ZipFile(zip_path, 'w') as zipf:
+            zipf.writestr('list.json', json.dumps([{'resourceType': 'Patient', 'id': 'p1'}]))
+        with zipfile.ZipFile(zip_path) as zipf:
+            self.assertEqual(services.read_json_bundle(functools.partial(zipf.open, 'list.json')), (None, [{'resourceType': 'Patient', 'id': 'p1'}]))
+
+        for malformed in (b'{"entry": [}, "resourceType": "Bundle"}', b'{"resourceType": "Bundle", "entry": [{"resource": {}}, {"res'):
+            with open(bundle_path, 'wb') as f:
+                f.write(malformed)
+            with self.assertRaises(ValueError):
+                bundle_entries, _ = services.read_json_bundle(lambda: open(bundle_path, 'rb'))
+                list(bundle_entries)
+
 if __name__ == '__main__':
     unittest.main()